@@ -0,0 +1,69 @@
+# Benchmark ingest and query throughput of the MySQL and SQLite backends.
+# MySQL runs against the database configured in db.yaml, SQLite against a
+# fresh file under results/bench/. Benchmark rows are deleted afterwards, but
+# point db.yaml at a scratch database anyway.
+import os, yaml, time
+from src.dbpool import create_pool
+from src.schema import migrate
+from scripts.expr_util import generate_logs, clean_up, BENCH_ACTOR
+
+# Parameters
+log_counts = [1000, 10000, 100000]
+page_size = 500
+lookups = 200
+sqlite_path = "results/bench/bench.db"
+data_filename = "results/bench/backends.csv"
+
+def ingest(db, logs):
+    db.add_activity_logs(logs)
+    return len(logs)
+
+def page_walk(db, logs):
+    '''Read all logs page by page, as /fetch_drive_log does'''
+    rows, cursor = 0, None
+    while True:
+        page, cursor = db.extract_logs_page("2024-01-01", cursor, page_size)
+        rows += len(page)
+        if cursor is None:
+            return rows
+
+def stream(db, logs):
+    return sum(len(rows) for rows in db.stream_logs_date("2024-01-01"))
+
+def constraint_lookups(db, logs):
+    '''Look up past activity as retroactive detection does'''
+    rows = 0
+    for i in range(lookups):
+        rows += len(db.extract_logs_for_constraint(["doc" + str(i % 400)], "Edit", [BENCH_ACTOR]))
+    return rows
+
+with open('db.yaml') as config_file:
+    db_config = yaml.load(config_file, Loader=yaml.SafeLoader)
+os.makedirs(os.path.dirname(data_filename), exist_ok=True)
+for suffix in ["", "-wal", "-shm"]:
+    if os.path.exists(sqlite_path + suffix):
+        os.remove(sqlite_path + suffix)
+
+backends = [("sqlite", create_pool(dict(db_config, db_backend="sqlite", sqlite_path=sqlite_path, db_pool_size=1)))]
+if 'mysql_host' in db_config:
+    backends.append(("mysql", create_pool(dict(db_config, db_backend="mysql", db_pool_size=1))))
+methods = [("ingest", ingest), ("page_walk", page_walk), ("stream", stream), ("constraint_lookups", constraint_lookups)]
+
+data_file = open(data_filename, "w+")
+data_file.write("backend,log_count,method,seconds,rows_per_sec\n")
+for backend, db_pool in backends:
+    with db_pool.connection() as db:
+        migrate(db)
+        for count in log_counts:
+            logs = generate_logs(count)
+            clean_up(db)
+            for name, method in methods:
+                t0 = time.perf_counter()
+                rows = method(db, logs)
+                t1 = time.perf_counter()
+                print(backend, count, name, round(t1 - t0, 3), "s", round(rows / (t1 - t0)), "rows/s")
+                data_file.write(",".join([backend, str(count), name, str(t1 - t0), str(rows / (t1 - t0))]) + "\n")
+        clean_up(db)
+    db_pool.close()
+
+data_file.close()
@@ -0,0 +1,78 @@
+# Benchmark conflict detection over a range of logs in Python and in SQL.
+# Uses the constraints in tests/sample_constraints.txt and generated logs on
+# their documents. SQLite runs against a fresh file under results/bench/, and
+# MySQL against the database configured in db.yaml if it names a MySQL host.
+# Benchmark rows are deleted afterwards, but point db.yaml at a scratch database.
+import os, yaml, time, json, random
+from src.dbpool import create_pool
+from src.schema import migrate
+from src.detection import ConflictDetectionEngine
+from src.sqldetection import SQLDetectionEngine
+
+# Parameters
+log_counts = [10000, 100000, 1000000]
+unconstrained_share = 0.8
+sqlite_path = "results/bench/bench_detection.db"
+data_filename = "results/bench/detection.csv"
+bench_actor_id = "bench"
+
+with open("tests/sample_constraints.txt") as file:
+    constraints = json.load(file)
+
+def generate_logs(count, rng):
+    '''Generate logs on constrained documents and, mostly, on others'''
+    doc_ids = [doc_id for constraint in constraints for doc_id in constraint[1]]
+    actors = [actor for constraint in constraints for actor in constraint[4]] + ["other@accord.foundation"]
+    # No moves: the sample has a "not in" move constraint, and moves have no true value
+    actions = ["Edit", "Delete", "Rename", "Create",
+               "Permission Change-to:can_view-from:none-for:other@accord.foundation",
+               "Permission Change-to:none-from:can_view-for:other@accord.foundation"]
+    for i in range(count):
+        doc_id = "unconstrained" + str(i % 1000) if rng.random() < unconstrained_share else rng.choice(doc_ids)
+        time_str = "2024-%02d-%02dT%02d:%02d:%02d.%03dZ" % (1 + i % 12, 1 + i % 28, i % 24, i % 60, (i // 60) % 60, i % 1000)
+        yield (time_str, rng.choice(actions), doc_id, "Document", bench_actor_id, rng.choice(actors))
+
+def python_detection(db, engine):
+    '''Stream every log in the range to Python and check it'''
+    return sum(1 for log in engine.iter_conflicts(db.stream_logs_date("2024-01-01", chunk_size=10000)))
+
+def sql_detection(db, engine):
+    return sum(len(rows) for rows in SQLDetectionEngine(engine).iter_conflicts(db, "2024-01-01", chunk_size=10000))
+
+def clean_up(db):
+    db.cursor.execute("DELETE FROM activity_log WHERE actor_id = %s", (bench_actor_id,))
+    db.commit()
+
+with open('db.yaml') as config_file:
+    db_config = yaml.load(config_file, Loader=yaml.SafeLoader)
+os.makedirs(os.path.dirname(data_filename), exist_ok=True)
+for suffix in ["", "-wal", "-shm"]:
+    if os.path.exists(sqlite_path + suffix):
+        os.remove(sqlite_path + suffix)
+
+backends = [("sqlite", create_pool(dict(db_config, db_backend="sqlite", sqlite_path=sqlite_path, db_pool_size=1)))]
+if 'mysql_host' in db_config:
+    backends.append(("mysql", create_pool(dict(db_config, db_backend="mysql", db_pool_size=1))))
+engine = ConflictDetectionEngine(constraints)
+
+data_file = open(data_filename, "w+")
+data_file.write("backend,log_count,engine,seconds,logs_per_sec,conflicts\n")
+for backend, db_pool in backends:
+    with db_pool.connection() as db:
+        migrate(db)
+        for count in log_counts:
+            clean_up(db)
+            logs = list(generate_logs(count, random.Random(count)))
+            for i in range(0, count, 10000):
+                db.cursor.executemany("INSERT INTO activity_log (activity_time, action, doc_id, doc_name, actor_id, actor_name) VALUES (%s,%s,%s,%s,%s,%s)", logs[i:i + 10000])
+            db.commit()
+            for name, method in [("python", python_detection), ("sql", sql_detection)]:
+                t0 = time.perf_counter()
+                conflicts = method(db, engine)
+                t1 = time.perf_counter()
+                print(backend, count, name, round(t1 - t0, 3), "s", round(count / (t1 - t0)), "logs/s", conflicts, "conflicts")
+                data_file.write(",".join([backend, str(count), name, str(t1 - t0), str(count / (t1 - t0)), str(conflicts)]) + "\n")
+        clean_up(db)
+    db_pool.close()
+
+data_file.close()
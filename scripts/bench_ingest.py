@@ -0,0 +1,55 @@
+# Benchmark activity log insertion paths against a local MySQL database.
+# Inserts into activity_log of the database configured in db.yaml and deletes
+# the benchmark rows afterwards, so point db.yaml at a scratch database.
+import os, yaml, time, tempfile
+import MySQLdb
+from src.sqlconnector import DatabaseQuery
+from scripts.expr_util import generate_logs, clean_up
+
+# Parameters
+log_counts = [1000, 10000, 100000]
+batch_sizes = [100, 1000, 5000]
+data_filename = "results/bench/ingest.csv"
+
+def insert_row_at_a_time(db, logs):
+    '''Baseline: one INSERT round trip per log, as before bulk insertion'''
+    for log in reversed(logs):
+        log = log.split(',')
+        db.cursor.execute("INSERT INTO activity_log (activity_time, action, doc_id, doc_name, actor_id, actor_name) VALUES (%s,%s,%s,%s,%s,%s)", tuple(log))
+    db.commit()
+
+def load_data(db, logs):
+    with tempfile.NamedTemporaryFile("w", suffix=".csv") as log_file:
+        log_file.write("Activity_Time,Action,Doc_ID,Doc_Name,Actor_ID,Actor_Name\n")
+        log_file.write("\n".join(logs) + "\n")
+        log_file.flush()
+        db.load_activity_logs(log_file.name)
+
+with open('db.yaml') as config_file:
+    db_config = yaml.load(config_file, Loader=yaml.SafeLoader)
+connection = MySQLdb.connect(host=db_config['mysql_host'], user=db_config['mysql_user'],
+                             password=db_config['mysql_password'], database=db_config['mysql_db'],
+                             local_infile=1)
+db = DatabaseQuery(connection, connection.cursor())
+
+methods = [("row_at_a_time", insert_row_at_a_time)]
+for batch_size in batch_sizes:
+    methods.append(("executemany_" + str(batch_size), lambda db, logs, batch_size=batch_size: db.add_activity_logs(logs, batch_size=batch_size)))
+methods.append(("load_data", load_data))
+
+os.makedirs(os.path.dirname(data_filename), exist_ok=True)
+data_file = open(data_filename, "w+")
+data_file.write("log_count,method,seconds,rows_per_sec\n")
+for count in log_counts:
+    logs = generate_logs(count)
+    for name, method in methods:
+        clean_up(db)
+        t0 = time.perf_counter()
+        method(db, logs)
+        t1 = time.perf_counter()
+        print(count, name, round(t1 - t0, 3), "s", round(count / (t1 - t0)), "rows/s")
+        data_file.write(",".join([str(count), name, str(t1 - t0), str(count / (t1 - t0))]) + "\n")
+    clean_up(db)
+
+data_file.close()
+connection.close()
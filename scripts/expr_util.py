@@ -27,6 +27,9 @@ CONSTRAINT_TYPES = [("Can Create", "Create"),
                     ("Update Permission", "Permission Change")]
 PERMISSION_OPERATORS = ["not in", "in"]
 
+# Actor of the logs benchmarks insert, deleted by clean_up
+BENCH_ACTOR = "bench@accord.foundation"
+
 def increase_selectivity(ac, users, resources):
     """Add one elemnent to the Resource, User, or Targets attribute on an AC.
 
@@ -107,6 +110,22 @@ def decrease_selectivity(ac, users, resources):
         actors = actors[1:]
     return ((resource_names, resource_ids, action, action_type, actors, listlike, operator, owner, targets), True)
 
+def generate_logs(count):
+    """Generate BENCH_ACTOR log strings in extractDriveLog format, newest first"""
+    logs = []
+    for i in range(count, 0, -1):
+        seconds = i % 60
+        minutes = (i // 60) % 60
+        hours = (i // 3600) % 24
+        time_str = "2024-01-01T%02d:%02d:%02d.%03dZ" % (hours, minutes, seconds, i % 1000)
+        logs.append(",".join([time_str, "Edit", "doc" + str(i % 400), "Document " + str(i % 400), "100000000000000000000", BENCH_ACTOR]))
+    return logs
+
+def clean_up(db):
+    """Delete the logs inserted by benchmarks from activity_log"""
+    db.cursor.execute("DELETE FROM activity_log WHERE actor_name = %s", (BENCH_ACTOR,))
+    db.commit()
+
 def actions_selected_by_ac(constraints, actions):
     """Return the number of actions that this AC selects.
 
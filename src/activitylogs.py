@@ -1,6 +1,6 @@
-from src.sqlconnector import DatabaseQuery
-from src.logextraction import extractDriveLog
+from src.logextraction import fetchDriveLogPages, parseDriveActivities
 from datetime import datetime, timedelta
+from src.metrics import ROWS_INGESTED
 
 # Method to update Activity Logs in the database
 class Logupdater():
@@ -10,14 +10,19 @@ class Logupdater():
     Admin SDK Reports API service. Parse logs and insert into logs table
     in database.
 
+    Logs are committed one API page at a time, together with a checkpoint
+    holding the token of the next page and the most recent activity time
+    seen in the run. An interrupted run resumes from the checkpoint instead
+    of fetching everything since the last log date again.
+
     Attributes:
-        mysql: flask_mysqldb.MySQL
+        db_pool: ConnectionPool
         reportsAPI_service: googleapiclient.discovery.Resource, for
             interacting with Admin SDK Reports API
     '''
 
-    def __init__(self, mysql, reportsAPI_service):
-        self.mysql = mysql
+    def __init__(self, db_pool, reportsAPI_service):
+        self.db_pool = db_pool
         self.reportsAPI_service = reportsAPI_service
 
     def updateLogs_database(self):
@@ -27,36 +32,19 @@ class Logupdater():
             Number of added activity logs.
         '''
         try:
-            db = DatabaseQuery(self.mysql.connection, self.mysql.connection.cursor())
-
-            # Extract last log date from the database
-            last_log_date = db.extract_lastLog_date()
             totalLogs = 0
-            
-            if(last_log_date != None):
-                # Extract the activity logs from the Google cloud from lastlog Date
-                activity_logs = extractDriveLog(last_log_date, self.reportsAPI_service)
-                activity_logs.pop(0) # Remove header row
-
-                # Update the log Database table when the new activities are recorded
-                if(len(activity_logs) > 1):
-                    new_log_date = activity_logs[0].split(',')[0]
-
-                    # Parse the string into a datetime object
-                    date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
-                    log_datetime = datetime.strptime(new_log_date, date_format)
-
-                    # Subtract 4 hours to convert to EDT time zone
-                    updated_datetime = log_datetime
-
-                    # Format it back to a string if needed
-                    updated_log_date = updated_datetime.strftime(date_format)
+            with self.db_pool.connection() as db:
+                # Resume an interrupted run, or start from the last log date in the database
+                start_time, page_token, watermark = self.resume_point(db)
 
-                    db.add_activity_logs(activity_logs)
-                    db.update_log_date(updated_log_date)
-                    totalLogs = len(activity_logs)-1
+                if(start_time != None):
+                    # Extract the activity logs from the Google cloud page by page
+                    for activities, next_page_token in fetchDriveLogPages(start_time, self.reportsAPI_service, page_token):
+                        activity_logs = parseDriveActivities(activities)
+                        watermark = self.latest_log_time(activity_logs, watermark)
+                        self.commit_logs(db, activity_logs, start_time, next_page_token, watermark)
+                        totalLogs += len(activity_logs)
 
-            del db
             return totalLogs
 
         except LookupError as le:
@@ -64,4 +52,50 @@ class Logupdater():
         except ValueError as ve:
             return "Error in Value Entered !!\n" + str(ve)
         except TypeError as te:
-            return "Error in Type matching !!\n" + str(te)  
\ No newline at end of file
+            return "Error in Type matching !!\n" + str(te)
+
+    @staticmethod
+    def resume_point(db):
+        '''Return (start_time, page_token, watermark) to continue ingestion from'''
+        checkpoint = db.extract_log_checkpoint()
+        if(checkpoint != None):
+            return checkpoint
+        else:
+            return db.extract_lastLog_date(), None, None
+
+    @staticmethod
+    def latest_log_time(activity_logs, watermark):
+        '''Return the most recent activity time among logs and watermark'''
+        for log in activity_logs:
+            log_time = log.split(',')[0]
+            if(watermark == None or log_time > watermark):
+                watermark = log_time
+        return watermark
+
+    @classmethod
+    def commit_logs(cls, db, activity_logs, start_time, next_page_token, watermark):
+        '''Insert logs and commit them together with the position to resume from
+
+        Args:
+            db: DatabaseQuery
+            activity_logs: str list, logs from one or more pages
+            start_time: str, start time of the ingestion run
+            next_page_token: str | None, page after the logs, None when run is complete
+            watermark: str | None, most recent activity time ingested in the run
+        '''
+        db.add_activity_logs(activity_logs, commit=False)
+        if(next_page_token != None):
+            db.save_log_checkpoint(start_time, next_page_token, watermark)
+        else:
+            db.clear_log_checkpoint()
+            if(watermark != None):
+                db.update_log_date(cls.format_log_date(watermark), commit=False)
+        db.commit()
+        ROWS_INGESTED.inc(len(activity_logs))
+
+    @staticmethod
+    def format_log_date(log_date):
+        '''Normalize activity time to the last log date format'''
+        date_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+        log_datetime = datetime.strptime(log_date, date_format)
+        return log_datetime.strftime(date_format)
@@ -1,30 +1,166 @@
-from flask import Flask, render_template, request, session, flash, jsonify
-from flask_mysqldb import MySQL
-import yaml, os, time
+from flask import Flask, render_template, request, session, flash, jsonify, Response, stream_with_context
+import yaml, os, time, json, base64, tempfile, shutil
 from datetime import datetime
-from math import floor
 from functools import wraps
-from src.serviceAPI import create_reportsAPI_service
-from src.detection import detectmain
-from src.sqlconnector import DatabaseQuery
-from src.activitylogs import Logupdater
-from src.logextraction import extractDriveLog
+from src.serviceAPI import create_reportsAPI_service, shared_request
+from src.servicecache import ServiceCache
+from src.incremental import IncrementalDetector, RetroactiveDetector
+from src.detection import check_constraint
+from src.enginecache import EngineCache
+from src.engineregistry import EngineRegistry
+from src.profiling import EngineProfiler
+from src.jobs import JobManager
+from src.sqldetection import SQLDetectionEngine
+from src.dbpool import create_pool
+from src.ingestion import IngestionScheduler
+from src.metrics import REGISTRY, PhaseTimer, render_families, merge_families
+from src.prefork import ChangeSignal, WorkerStats, serve_preforked
 
 
-# Dictionary to store the user services
-user_services = {}
+
+# Page sizes for paginated log and conflict routes
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+
+# Rows per line of streamed NDJSON responses
+STREAM_CHUNK_SIZE = 200
 
 app = Flask(__name__, static_folder='../static', template_folder='../templates')
 app.secret_key = os.urandom(24)
 
 # Load database configuration
 db_config = yaml.load(open('db.yaml'), Loader=yaml.SafeLoader)
-app.config['MYSQL_HOST'] = db_config['mysql_host']
-app.config['MYSQL_USER'] = db_config['mysql_user']
-app.config['MYSQL_PASSWORD'] = db_config['mysql_password']
-app.config['MYSQL_DB'] = db_config['mysql_db']
 
-mysql = MySQL(app)
+# Google API services built once per token file, with tokens refreshed
+# ahead of expiry, and the services of signed in users
+api_services = ServiceCache(shared_request(),
+                            refresh_margin=db_config.get('token_refresh_margin', 300),
+                            idle_timeout=db_config.get('service_idle_timeout', 3600))
+
+# Connections are shared by requests and background threads
+db_pool = create_pool(db_config)
+
+# Detection engine shared by requests and background ingestion, updated
+# with constraint changes instead of rebuilt. With detection_profiling, its
+# checks record hot spots for /detection_profile. With serve_workers, the
+# engine is loaded before forking and shared by the workers, which signal
+# each other when one finds constraint changes; profiler sampling then
+# starts in each worker.
+serve_workers = db_config.get('serve_workers', 1)
+engine_profiler = None
+if db_config.get('detection_profiling', False):
+    engine_profiler = EngineProfiler(sample_interval=db_config.get('detection_profiling_sample_interval'),
+                                     start=serve_workers <= 1)
+engine_cache = EngineCache(profiler=engine_profiler,
+                           refresh_interval=db_config.get('engine_refresh_interval', 0),
+                           change_signal=ChangeSignal() if serve_workers > 1 else None)
+
+# Engines with the constraints of one tenant (owner domain) each, evicted
+# least recently used first beyond engine_memory_budget_mb
+engine_registry = EngineRegistry(budget_bytes=db_config.get('engine_memory_budget_mb', 256) * 1024 * 1024,
+                                 snapshot_dir=db_config.get('engine_snapshot_dir'),
+                                 profiler=engine_profiler)
+
+# Background log ingestion, started once the Reports API service is
+# available. Processes sharing the database take turns through a lease.
+ingestion_scheduler = IngestionScheduler(db_pool,
+                                         interval=db_config.get('ingestion_interval', 300),
+                                         jitter=db_config.get('ingestion_jitter', 30),
+                                         pipelined=db_config.get('ingestion_pipeline', False),
+                                         retention_months=db_config.get('log_retention_months'),
+                                         archive_dir=db_config.get('log_archive_dir', 'archive'),
+                                         engine_cache=engine_cache)
+
+# Background detection jobs over wide date ranges, stored in the database
+# so that any process can report and cancel them
+detection_jobs = JobManager(db_pool, engine_cache, workers=db_config.get('detection_workers', 2),
+                            stale_after=db_config.get('detection_job_stale_seconds', 300))
+
+# Component statistics exposed as gauges on /metrics
+REGISTRY.register_stats("accord_db_pool", "Database connection pool utilization and waits", db_pool.metrics)
+REGISTRY.register_stats("accord_ingestion", "Last background ingestion pass", ingestion_scheduler.status)
+REGISTRY.register_stats("accord_pipeline", "Ingestion pipeline stage throughput in the last pass", lambda: ingestion_scheduler.status().get('pipeline'), label="stage")
+REGISTRY.register_stats("accord_engine_cache", "Detection engine cache loads and refreshes", lambda: engine_cache.stats)
+REGISTRY.register_stats("accord_engine_registry", "Per-tenant detection engines, evictions and estimated bytes", lambda: engine_registry.stats)
+REGISTRY.register_stats("accord_api_services", "Google API service cache and token refreshes", lambda: api_services.stats)
+
+# With serve_workers, set before forking: workers share their metrics and
+# stats through snapshot files, so that any worker answers for all of them
+worker_stats = None
+
+def gather(name, stats):
+    '''Return {pid: stats()} of this process, or the stats every worker shares as name'''
+    if worker_stats is None:
+        return {os.getpid(): stats()}
+    return worker_stats.read(name)
+
+def encode_cursor(cursor):
+    '''Encode (activity_time, id) page cursor as an opaque URL-safe string'''
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps([str(cursor[0]), cursor[1]]).encode()).decode()
+
+class InvalidCursor(ValueError):
+    '''Page cursor not made by encode_cursor'''
+
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(error):
+    return jsonify(error=str(error)), 400
+
+def decode_cursor(cursor):
+    '''Decode page cursor from encode_cursor, None for the first page
+
+    Raises: InvalidCursor, answered with 400 Bad Request
+    '''
+    if not cursor:
+        return None
+    try:
+        activity_time, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(activity_time), int(log_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid page cursor: " + cursor) from e
+
+class InvalidConstraint(ValueError):
+    '''Action constraint not in detection format'''
+
+@app.errorhandler(InvalidConstraint)
+def invalid_constraint(error):
+    return jsonify(error=str(error)), 400
+
+def request_constraint():
+    '''Return the action constraint posted as JSON {"constraint": [...]}
+
+    Raises: InvalidConstraint, answered with 400 Bad Request
+    '''
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or 'constraint' not in body:
+        raise InvalidConstraint('Expected JSON body {"constraint": [...]}')
+    try:
+        check_constraint(body['constraint'])
+    except ValueError as e:
+        raise InvalidConstraint(str(e)) from e
+    return body['constraint']
+
+def page_args(args):
+    '''Return (cursor, limit) page arguments from request args or form'''
+    limit = args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return decode_cursor(args.get('cursor')), max(1, min(limit, MAX_PAGE_SIZE))
+
+def wants_ndjson():
+    '''Return True if the client asked for a streamed NDJSON response'''
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+def ndjson_response(lines):
+    '''Stream dicts yielded by lines as newline-delimited JSON
+
+    The generator runs while the response is sent, so it may hold a pooled
+    connection and stream rows from it; the connection is released when the
+    generator finishes or the client disconnects.
+    '''
+    def generate():
+        for line in lines:
+            yield json.dumps(line, default=str) + "\n"
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 def simplify_datetime(datetime_str):
     '''Parse datetime string into "DD MM YYYY, HH:MM:SS" format'''
@@ -78,102 +214,258 @@ def add_no_cache(response):
 @app.route('/')
 def index():
     session['username'] = 'admin@accord.foundation'
-    # Store services in the global services dictionary
-    reportsAPI_service = create_reportsAPI_service("token.json")
+    reportsAPI_service = start_ingestion()
     if reportsAPI_service:
-        user_services[session['username']] = {'reports': reportsAPI_service}
+        api_services.set_user_service(session['username'], 'reports', reportsAPI_service)
     else:
         return "<h1>Unabled to connect to Google Reports API</h1>", 400
 
     return render_template('index.html')
 
+def start_ingestion():
+    '''Start background ingestion in this process with the admin's Reports API service
+
+    Services are built on first use and reused after.
+
+    Returns: service, None if it can't be created
+    '''
+    reportsAPI_service = create_reportsAPI_service("token.json", cache=api_services)
+    if reportsAPI_service:
+        ingestion_scheduler.start(reportsAPI_service)
+    return reportsAPI_service
+
+def ingestion_status_all():
+    '''Return the ingestion status of every process, combined'''
+    return IngestionScheduler.merge_status(list(gather('ingestion', ingestion_scheduler.status).values()))
+
 # Routes for Log Extraction 
 @app.route('/refresh_logs', methods=['POST'])
 def refresh_logs():
-    '''Fetch activity logs & update database. Returns number of logs in response'''
-    # Fetch and Update the logs database
-    activity_logs = Logupdater(mysql, user_services[session['username']]['reports'])
-    total_logs = activity_logs.updateLogs_database() 
-    del activity_logs
-
-    return jsonify(len=str(total_logs))
+    '''Request a background ingestion pass. Returns logs added by the last pass in response'''
+    # A worker that hasn't served the index page has no scheduler running yet
+    if ingestion_scheduler.reportsAPI_service is None and not start_ingestion():
+        return jsonify(error="Unable to connect to Google Reports API"), 400
+    ingestion_scheduler.trigger()
+    status = ingestion_status_all()
+
+    return jsonify(len=str(status['last_run_rows']), status=status)
+
+@app.route('/ingestion_status', methods=['GET'])
+def ingestion_status():
+    '''Return latency, lag and throughput of background log ingestion'''
+    return jsonify(ingestion_status_all())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    '''Return latency histograms, counters and component statistics in the Prometheus text format'''
+    if worker_stats is None:
+        text = REGISTRY.render()
+    else:
+        text = render_families(merge_families(worker_stats.read('metrics')))
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/detection_profile', methods=['GET'])
+def detection_profile():
+    '''Return probes and hits per constraint tree level, hot constraints,
+    parse and match time and sampled stacks of detection checks'''
+    if engine_profiler is None:
+        return jsonify(error="Detection profiling is disabled, set detection_profiling in db.yaml"), 404
+    states = list(gather('profile', engine_profiler.state).values())
+    return jsonify(EngineProfiler.merge(states, top=request.args.get('top', 20, type=int)))
+
+@app.route('/db_pool_status', methods=['GET'])
+def db_pool_status():
+    '''Return utilization and wait statistics of the database connection pool'''
+    return jsonify(db_pool.metrics())
+
+def display_log(logV):
+    '''Return the table row of an activity log'''
+    return {'time':simplify_datetime(logV[0]), 'activity':process_logs(logV), 'actor': logV[5].split('@')[0].capitalize(), 'resource':logV[3]}
+
+def stream_drive_log(startTime):
+    '''Yield all logs since startTime, STREAM_CHUNK_SIZE table rows per line'''
+    with db_pool.connection() as db:
+        for rows in db.stream_logs_date(startTime, STREAM_CHUNK_SIZE):
+            yield {'logs': [display_log(row) for row in rows]}
 
 @app.route('/fetch_drive_log', methods=['GET'])
 def fetch_drive_log():
-    '''Fetch activity logs since specified time.'''
+    '''Fetch one page of activity logs since specified time from the database,
+    or all of them as NDJSON if the client accepts application/x-ndjson'''
     startTime = request.args.get('time') # retrieve time from the GET parameters
+    cursor, limit = page_args(request.args)
+
+    if(startTime != None and wants_ndjson()):
+        return ndjson_response(stream_drive_log(startTime))
 
     totalLogs = []
+    next_cursor = None
 
     if(startTime != None):
-        # Extract the activity logs from the Google cloud from lastlog Date
-        activity_logs = extractDriveLog(startTime, user_services[session['username']]['reports'])
-
-        # Update the log Database table when the new activities are recorded
-        if(len(activity_logs) > 1):
-            activity_logs.pop(0)
-            for logitem in reversed(activity_logs):
-                logV = logitem.split(',')
-                totalLogs.append({'time':simplify_datetime(logV[0]), 'activity':process_logs(logV), 'actor': logV[5].split('@')[0].capitalize(), 'resource':logV[3]})
+        # Logs are kept up to date by the background ingestion
+        with db_pool.connection() as db:
+            rows, next_cursor = db.extract_logs_page(startTime, cursor, limit)
+        totalLogs = [display_log(row[:1] + row[2:]) for row in rows]
 
-    return jsonify(totalLogs)
+    return jsonify(logs=totalLogs, next_cursor=encode_cursor(next_cursor))
 
 # Routes for conflict detection
+def conflicts_page(db, currentDateTime, cursor, limit):
+    '''Return display rows, logs, conflict ids and next cursor of a page of conflicts'''
+    rows, next_cursor = db.extract_conflict_logs_page(currentDateTime, cursor, limit)
+    return conflict_rows(rows) + (encode_cursor(next_cursor),)
+
+def conflict_rows(rows):
+    '''Return display rows, logs and conflict ids of conflict log rows'''
+    conflictLogs, briefLogs, conflictID = [], [], []
+    for row in rows:
+        event = list(row[:1]) + list(row[2:7])
+        conflictLogs.append([simplify_datetime(event[0]),event[1].split(':')[0].split('-')[0],event[3],event[5].split('@')[0].capitalize()])
+        briefLogs.append(event)
+        conflictID.append(str(row[7]))
+    return conflictLogs, briefLogs, conflictID
+
+def detect_new_conflicts(db, currentDateTime, timer):
+    '''Check logs not checked yet for conflicts
+
+    Conflicts are detected as logs are ingested, so only logs not checked yet
+    need detection.
+
+    Returns: (int, str), number of logs since date and detection time label
+    '''
+    engine = engine_cache.get(db, timer)
+    detected = IncrementalDetector(engine).detect_new(db, timeout=60, timer=timer)
+    newLogs = detected[0] if detected else 0
+    detectSeconds = sum(timer.seconds.values())
+    with timer.phase("count"):
+        totalLogs = db.count_logs_date(currentDateTime)
+    if(totalLogs == 0):
+        return totalLogs, "No Activites Found for the selected filters"
+    return totalLogs, "Time taken to detect conflicts in "+str(newLogs)+" new activity logs on constrained documents: "+str(round(detectSeconds,3))+" seconds. Conflicts among "+str(totalLogs)+" activity logs since the selected date:"
+
+def stream_conflicts(currentDateTime, detect=False):
+    '''Yield stored conflicts since date, STREAM_CHUNK_SIZE per line
+
+    With detect, logs not checked yet are checked first and the first line
+    carries detectTimeLabel, the number of logs since date and the time
+    breakdown of detection.
+    '''
+    with db_pool.connection() as db:
+        if detect:
+            timer = PhaseTimer()
+            totalLogs, detectTimeLabel = detect_new_conflicts(db, currentDateTime, timer)
+            yield {'detectTimeLabel': detectTimeLabel, 'totalLogs': totalLogs, 'timings': timer.to_dict()}
+            if(totalLogs == 0):
+                return
+        for rows in db.stream_conflict_logs_date(currentDateTime, STREAM_CHUNK_SIZE):
+            conflictLogs, briefLogs, conflictID = conflict_rows(rows)
+            yield {'logs': conflictLogs, 'briefLogs': briefLogs, 'conflictID': conflictID}
+
 @app.route('/detect_conflicts_demo', methods=['POST'])
 def detect_conflicts_demo():
-    '''Detect function for demo: Detect conflicts in logs since date'''
+    '''Detect function for demo: Return first page of conflicts in logs since date,
+    or all of them as NDJSON if the client accepts application/x-ndjson'''
     currentDateTime = request.form.get('current_date')
+    cursor, limit = page_args(request.form)
 
-    # Extract Logs from databse with the filter parameters and also extract all the action constraints
-    db = DatabaseQuery(mysql.connection, mysql.connection.cursor())
-    logs = db.extract_logs_date(currentDateTime)
-
-    actionConstraints = db.extract_action_constraints("LIKE '%'")
-    del db
-
-    conflictID = []
-    if(logs != None and len(logs)>1):
-        headers = logs.pop(0)
-        conflictLogs = []
-        logs = logs[::-1]
-
-        # Calculate time taken by the detection Engine to detect conflicts
-        T0 = time.time()
-        result = detectmain(logs,actionConstraints)
-        T1 = time.time()
-
-        # Update the display table only with Conflicts and calculate detection time
-        totalLogs = len(result)
-        conflictsCount = 0
-        briefLogs = []
-        db = DatabaseQuery(mysql.connection, mysql.connection.cursor())
-
-        for i in range(totalLogs):
-            # Extract only the logs that have conflict
-            if(result[i]):
-                event = logs[i]
-                conflictLogs.append([simplify_datetime(event[0]),event[1].split(':')[0].split('-')[0],event[3],event[5].split('@')[0].capitalize()])
-                briefLogs.append(event)
-                conflictsCount += 1
-                conflictID.append(str(totalLogs - i))
-
-                # Add conflicts to the conflicts table to track resolved conflicts
-                db.add_conflict_resolution(event[0], event[1])
-
-        del db
-
-        if(T1 == T0):
-            speed = "Inf"
-        else:
-            speed = floor(conflictsCount/(T1-T0))
+    if wants_ndjson():
+        return ndjson_response(stream_conflicts(currentDateTime, detect=True))
 
-        detectTimeLabel = "Time taken to detect "+str(conflictsCount)+" conflicts from "+str(totalLogs)+" activity logs: "+str(round(T1-T0,3))+" seconds. Speed = "+str(speed)+" conflicts/sec"
+    timer = PhaseTimer()
+    with db_pool.connection() as db:
+        totalLogs, detectTimeLabel = detect_new_conflicts(db, currentDateTime, timer)
+        if(totalLogs > 0):
+            with timer.phase("conflict_fetch"):
+                conflictLogs, briefLogs, conflictID, next_cursor = conflicts_page(db, currentDateTime, cursor, limit)
 
-        return jsonify(logs=conflictLogs, detectTimeLabel=detectTimeLabel, briefLogs=briefLogs, conflictID = conflictID)
+    if(totalLogs > 0):
+        return jsonify(logs=conflictLogs, detectTimeLabel=detectTimeLabel, briefLogs=briefLogs, conflictID = conflictID, next_cursor=next_cursor, timings=timer.to_dict())
 
     else:
-        detectTimeLabel = "No Activites Found for the selected filters"
-        return jsonify(logs=[], detectTimeLabel=detectTimeLabel, briefLogs=[], conflictID = conflictID)
+        return jsonify(logs=[], detectTimeLabel=detectTimeLabel, briefLogs=[], conflictID = [], next_cursor=None, timings=timer.to_dict())
+
+@app.route('/fetch_conflicts', methods=['GET'])
+def fetch_conflicts():
+    '''Return one page of stored conflicts in logs since date, or all of them as NDJSON'''
+    currentDateTime = request.args.get('time')
+    cursor, limit = page_args(request.args)
+
+    if wants_ndjson():
+        return ndjson_response(stream_conflicts(currentDateTime))
+
+    with db_pool.connection() as db:
+        conflictLogs, briefLogs, conflictID, next_cursor = conflicts_page(db, currentDateTime, cursor, limit)
+
+    return jsonify(logs=conflictLogs, briefLogs=briefLogs, conflictID = conflictID, next_cursor=next_cursor)
+
+@app.route('/detect_conflicts_retroactive', methods=['POST'])
+def detect_conflicts_retroactive():
+    '''Detect past conflicts with a new action constraint and store them'''
+    constraint = request_constraint()
+
+    with db_pool.connection() as db:
+        T0 = time.perf_counter()
+        conflicts = RetroactiveDetector().detect_constraint(db, constraint)
+        T1 = time.perf_counter()
+
+    conflictLogs = [[simplify_datetime(event[0]),event[1].split(':')[0].split('-')[0],event[3],event[5].split('@')[0].capitalize()] for event in conflicts]
+    detectTimeLabel = "Time taken to detect "+str(len(conflicts))+" past conflicts with the new constraint: "+str(round(T1-T0,3))+" seconds"
+
+    return jsonify(logs=conflictLogs, detectTimeLabel=detectTimeLabel, briefLogs=conflicts)
+
+@app.route('/audit_conflicts', methods=['POST'])
+def audit_conflicts():
+    '''Detect and store conflicts in all logs of a time range inside the database,
+    with the constraints of one tenant (owner domain) if given'''
+    since = request.form.get('since')
+    until = request.form.get('until')
+    tenant = request.form.get('tenant')
+
+    with db_pool.connection() as db:
+        T0 = time.perf_counter()
+        engine = engine_registry.get(db, tenant.lower()) if tenant else engine_cache.get(db)
+        conflicts = SQLDetectionEngine(engine).detect(db, since, until)
+        T1 = time.perf_counter()
+
+    detectTimeLabel = "Time taken to audit logs for "+str(conflicts)+" conflicts: "+str(round(T1-T0,3))+" seconds"
+    return jsonify(conflicts=conflicts, detectTimeLabel=detectTimeLabel)
+
+@app.route('/detection_jobs', methods=['POST'])
+def submit_detection_job():
+    '''Queue detection of conflicts in logs between since and until (optional)'''
+    since = request.form.get('since')
+    if since is None:
+        return jsonify(error="since is required"), 400
+    job = detection_jobs.submit(since, request.form.get('until'))
+    return jsonify(job.progress()), 202
+
+@app.route('/detection_jobs/<job_id>', methods=['GET'])
+def detection_job_progress(job_id):
+    '''Return status, rows scanned and conflicts found of a detection job'''
+    job = detection_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job.progress())
+
+@app.route('/detection_jobs/<job_id>/results', methods=['GET'])
+def detection_job_results(job_id):
+    '''Return a page of the conflicts a detection job has found so far'''
+    job = detection_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    after_id = max(0, request.args.get('cursor', 0, type=int))
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    events, next_id = detection_jobs.results(job, after_id, limit)
+    conflictLogs = [[simplify_datetime(event[0]),event[1].split(':')[0].split('-')[0],event[3],event[5].split('@')[0].capitalize()] for event in events]
+    return jsonify(logs=conflictLogs, briefLogs=events, status=job.status, next_cursor=next_id)
+
+@app.route('/detection_jobs/<job_id>/cancel', methods=['POST'])
+def cancel_detection_job(job_id):
+    '''Stop a queued or running detection job'''
+    job = detection_jobs.cancel(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job.progress())
 
 # Routes for Action Constraints
 @app.route('/fetch_actionConstraints', methods=['POST'])
@@ -183,52 +475,74 @@ def fetch_action_constraints():
     data = request.get_json()
     date = data.get('date')
 
-    db = DatabaseQuery(mysql.connection, mysql.connection.cursor())
-    constraints = db.fetch_action_constraints(date)
-
     ## Process the constraints and create a dictionary
     processed_constraints = []  # List to hold all processed constraints dictionaries
-    if(constraints != None):
-        # Iterate over each constraint skipping the header
-        for constraint in constraints[1:]:
-
-            # Unpack each constraint row into variables
-            doc_name, doc_id, action, action_type, constraint_target, action_value, comparator, constraint_owner, allowed_value, time_stamp = constraint
-
-            # Initialize the dictionary to store the processed constraint
-            constraint_dict = {
-                "TimeStamp": time_stamp,
-                "ConstraintOwner": constraint_owner,
-                "ConstraintTarget": constraint_target,
-                "File": doc_name
-            }
-
-            # Determine the Constraint value based on Action Value and Action Type
-            if action_type == "Add Permission":
-                constraint_value = "Cannot Add users"
-            elif action_type == "Remove Permission":
-                constraint_value = "Cannot Remove users"
-            elif action_type == "Update Permission":
-                constraint_value = "Cannot Update user Permissions"
-            elif action_type == "Can Move":
-                constraint_value = "Cannot Move file"
-            elif action_type == "Can Delete":
-                constraint_value = "Cannot Delete the file"
-            elif action_type == "Can Edit":
-                constraint_value = "Cannot Edit file"
-            elif action_type == "Time Limit Edit":
-                constraint_value = "Time constraint on Edit"
-            else:
-                constraint_value = "Undefined Action"  # Default message if no specific action type matched
-
-            # Set the 'Constraint' key in the dictionary
-            constraint_dict['Constraint'] = constraint_value + "," + comparator + "," + allowed_value
-
-            # Append the constructed dictionary to the list
-            processed_constraints.append(constraint_dict)
+    with db_pool.connection() as db:
+        for constraints in db.stream_action_constraints_date(date):
+            for constraint in constraints:
+
+                # Unpack each constraint row into variables
+                doc_name, doc_id, action, action_type, constraint_target, action_value, comparator, constraint_owner, allowed_value, time_stamp = constraint
+
+                # Initialize the dictionary to store the processed constraint
+                constraint_dict = {
+                    "TimeStamp": time_stamp,
+                    "ConstraintOwner": constraint_owner,
+                    "ConstraintTarget": constraint_target,
+                    "File": doc_name
+                }
+
+                # Determine the Constraint value based on Action Value and Action Type
+                if action_type == "Add Permission":
+                    constraint_value = "Cannot Add users"
+                elif action_type == "Remove Permission":
+                    constraint_value = "Cannot Remove users"
+                elif action_type == "Update Permission":
+                    constraint_value = "Cannot Update user Permissions"
+                elif action_type == "Can Move":
+                    constraint_value = "Cannot Move file"
+                elif action_type == "Can Delete":
+                    constraint_value = "Cannot Delete the file"
+                elif action_type == "Can Edit":
+                    constraint_value = "Cannot Edit file"
+                elif action_type == "Time Limit Edit":
+                    constraint_value = "Time constraint on Edit"
+                else:
+                    constraint_value = "Undefined Action"  # Default message if no specific action type matched
+
+                # Set the 'Constraint' key in the dictionary
+                constraint_dict['Constraint'] = constraint_value + "," + comparator + "," + allowed_value
+
+                # Append the constructed dictionary to the list
+                processed_constraints.append(constraint_dict)
 
     return jsonify(processed_constraints)
 
 
+def preload():
+    '''Load the detection engine before forking workers'''
+    with db_pool.connection() as db:
+        engine_cache.get(db)
+    # Workers open their own connections
+    db_pool.close()
+
+def after_fork():
+    '''Start the threads of a worker, which don't survive fork'''
+    if engine_profiler is not None:
+        engine_profiler.start()
+    worker_stats.start()
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    if serve_workers > 1:
+        worker_stats = WorkerStats(tempfile.mkdtemp(prefix="accord-workers-"), interval=db_config.get('worker_stats_interval', 5))
+        worker_stats.register('metrics', REGISTRY.collect)
+        worker_stats.register('ingestion', ingestion_scheduler.status)
+        if engine_profiler is not None:
+            worker_stats.register('profile', engine_profiler.state)
+        try:
+            serve_preforked(app, host=db_config.get('serve_host', '127.0.0.1'), port=db_config.get('serve_port', 5000),
+                            workers=serve_workers, preload=preload, after_fork=after_fork)
+        finally:
+            shutil.rmtree(worker_stats.directory, ignore_errors=True)
+    else:
+        app.run(debug=True)
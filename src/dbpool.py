@@ -0,0 +1,189 @@
+import threading, time
+from contextlib import contextmanager
+from src.sqlconnector import DatabaseQuery
+
+def mysql_connector(db_config):
+    '''Return a function opening MySQL connections configured by db.yaml'''
+    import MySQLdb
+
+    def connect():
+        return MySQLdb.connect(host=db_config['mysql_host'],
+                               user=db_config['mysql_user'],
+                               password=db_config['mysql_password'],
+                               database=db_config['mysql_db'])
+    return connect
+
+def create_pool(db_config):
+    '''Return a ConnectionPool on the database backend selected in db.yaml
+
+    db_backend is "mysql" (default) or "sqlite", see sqlite_connector.
+    '''
+    if db_config.get('db_backend', 'mysql') == 'sqlite':
+        from src.sqliteconnector import sqlite_connector, SQLiteQuery
+        return ConnectionPool(sqlite_connector(db_config), size=db_config.get('db_pool_size', 8), query_class=SQLiteQuery)
+    return ConnectionPool(mysql_connector(db_config), size=db_config.get('db_pool_size', 8))
+
+class ConnectionPool():
+    '''Share a bounded set of open database connections between threads.
+
+    Each checked out connection is wrapped in a DatabaseQuery that keeps the
+    statements prepared on that connection, so hot queries are parsed once
+    per connection instead of once per request.
+
+    Attributes:
+        connect: function returning a new DB-API connection
+        size: int, maximum number of open connections
+        timeout: float, seconds to wait for a free connection
+        recycle: float, seconds a connection may stay idle before it is
+            checked with a ping
+        query_class: class wrapping connections, DatabaseQuery or a subclass
+        prepare: bool, prepare hot queries on pooled connections
+    '''
+
+    def __init__(self, connect, size=8, timeout=30, recycle=300, query_class=DatabaseQuery, prepare=True):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.query_class = query_class
+        self.prepare = prepare
+        self._idle = [] # (connection, prepared statements, time returned)
+        self._open = 0
+        self._condition = threading.Condition()
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_seconds': 0.0, 'connects': 0, 'discarded': 0, 'timeouts': 0}
+
+    def metrics(self):
+        '''Return pool utilization and wait statistics'''
+        with self._condition:
+            in_use = self._open - len(self._idle)
+            metrics = dict(self._stats)
+            metrics.update({
+                'size': self.size,
+                'open': self._open,
+                'in_use': in_use,
+                'idle': len(self._idle),
+                'utilization': round(in_use / self.size, 3),
+            })
+            metrics['wait_seconds'] = round(metrics['wait_seconds'], 3)
+            return metrics
+
+    @contextmanager
+    def connection(self):
+        '''Check out a connection for the duration of a with block
+
+        Yields: DatabaseQuery (or query_class) on a pooled connection. An
+            uncommitted transaction is rolled back when the block exits.
+
+        Raises: TimeoutError if no connection frees up within timeout
+        '''
+        (connection, prepared), = self._checkout(1)
+        try:
+            yield self.query_class(connection, connection.cursor(), prepared if self.prepare else None)
+        finally:
+            self._checkin(connection, prepared)
+
+    @contextmanager
+    def connections(self, count):
+        '''Check out count connections together for the duration of a with block
+
+        Threads that need several connections at once wait until all are
+        free, instead of holding one while waiting for the next, which can
+        leave each of them holding one until they time out.
+
+        Yields: list of DatabaseQuery (or query_class), as connection
+
+        Raises: TimeoutError if the connections don't free up within timeout
+        '''
+        checked_out = self._checkout(count)
+        try:
+            yield [self.query_class(connection, connection.cursor(), prepared if self.prepare else None)
+                   for connection, prepared in checked_out]
+        finally:
+            for connection, prepared in checked_out:
+                self._checkin(connection, prepared)
+
+    def close(self):
+        '''Close idle connections'''
+        with self._condition:
+            for connection, _, _ in self._idle:
+                self._close(connection)
+            self._open -= len(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+    def _checkout(self, count):
+        '''Return list of count (connection, prepared statements)'''
+        if count > self.size:
+            raise ValueError("Can't check out " + str(count) + " connections from a pool of " + str(self.size))
+        with self._condition:
+            self._stats['checkouts'] += 1
+            free = lambda: len(self._idle) + self.size - self._open >= count
+            if not free():
+                self._stats['waits'] += 1
+                T0 = time.perf_counter()
+                available = self._condition.wait_for(free, self.timeout)
+                self._stats['wait_seconds'] += time.perf_counter() - T0
+                if not available:
+                    self._stats['timeouts'] += 1
+                    raise TimeoutError("No database connection available after " + str(self.timeout) + " seconds")
+            taken = [self._idle.pop() for _ in range(min(count, len(self._idle)))]
+            self._open += count - len(taken)
+
+        slots = taken + [(None, None, None)] * (count - len(taken))
+        checked_out = []
+        try:
+            for connection, prepared, returned in slots:
+                checked_out.append(self._open_connection(connection, prepared, returned))
+        except BaseException:
+            for connection, prepared in checked_out:
+                self._checkin(connection, prepared)
+            for connection, _, _ in slots[len(checked_out) + 1:]:
+                if connection is not None:
+                    self._close(connection)
+            with self._condition:
+                self._open -= count - len(checked_out)
+                self._condition.notify_all()
+            raise
+        return checked_out
+
+    def _open_connection(self, connection, prepared, returned):
+        '''Return (connection, prepared statements) of a checked out slot,
+        replacing its connection if idle too long and broken, or opening one
+        if None'''
+        if connection is not None and time.monotonic() - returned > self.recycle:
+            try:
+                connection.ping()
+            except Exception:
+                self._close(connection)
+                connection = None
+                with self._condition:
+                    self._stats['discarded'] += 1
+        if connection is None:
+            connection = self.connect()
+            prepared = {}
+            with self._condition:
+                self._stats['connects'] += 1
+        return connection, prepared
+
+    def _checkin(self, connection, prepared):
+        try:
+            connection.rollback()
+        except Exception:
+            # Broken connection, or a result left unread: don't reuse it
+            self._close(connection)
+            with self._condition:
+                self._open -= 1
+                self._stats['discarded'] += 1
+                # Waiters may need different numbers of connections
+                self._condition.notify_all()
+            return
+        with self._condition:
+            self._idle.append((connection, prepared, time.monotonic()))
+            self._condition.notify_all()
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
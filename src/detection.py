@@ -1,5 +1,6 @@
 from abc import abstractmethod
 from datetime import datetime
+from src.metrics import NULL_TIMER
 class ConstraintNode:
     @abstractmethod
     def add_constraint(self, constraint):
@@ -164,35 +165,117 @@ class ConflictDetectionEngine:
 
     Attributes:
         constraint_tree: ConstraintNode
+        profiler: EngineProfiler | None, records hot spots of checks when set
     '''
 
-    def __init__(self, action_constraints=[]):
-        '''Initialize internal data structures and store constraints'''
+    def __init__(self, action_constraints=[], timer=None):
+        '''Initialize internal data structures and store constraints
+
+        Args:
+            action_constraints: List[List[str]]
+            timer: PhaseTimer | None, counts building in phase "engine_build"
+        '''
         self.constraint_tree = DocumentNode()
-        self.load_constraints(action_constraints)
+        self.profiler = None
+        self.load_constraints(action_constraints, timer)
 
-    def load_constraints(self, action_constraints):
+    def load_constraints(self, action_constraints, timer=None):
         '''Parse and store an additional list of constraints'''
-        for constraint in action_constraints:
-            self.constraint_tree.add_constraint(constraint)
+        with (timer or NULL_TIMER).phase("engine_build"):
+            for constraint in action_constraints:
+                self.constraint_tree.add_constraint(constraint)
+
+    def load_grouped(self, doc_groups, timer=None):
+        '''Store constraints grouped by document, as from stream_constraints_by_doc
+
+        Args:
+            doc_groups: iterable of (doc_id, constraints on that document)
+            timer: PhaseTimer | None, counts reading doc_groups in phase
+                "constraint_fetch" and building in phase "engine_build"
+        '''
+        timer = timer or NULL_TIMER
+        with timer.phase("engine_build"):
+            for doc_id, constraints in timer.iterate(doc_groups, "constraint_fetch"):
+                for constraint in constraints:
+                    self.constraint_tree.add_constraint(constraint)
+
+    def constrained_docs(self):
+        '''Return ids of documents with constraints'''
+        return list(self.constraint_tree.constraints)
+
+    def constrained_action_types(self):
+        '''Return action types with constraints on any document'''
+        return {action_type for actions in self.constraint_tree.constraints.values() for action_type in actions.constraints}
+
+    def check_conflicts(self, activities, timer=None):
+        '''Flag which activities are conflicts using stored constraints
+
+        Args:
+            activities: List[List[str]], activities in log format
+            timer: PhaseTimer | None, counts parsing logs into Activity in
+                phase "parse" and checking them in phase "check"
+        '''
+        if self.profiler is not None:
+            with (timer or NULL_TIMER).phase("check"):
+                return self.profiler.check_conflicts(self, activities)
+        if timer is not None:
+            with timer.phase("parse"):
+                parsed = [Activity(activity) for activity in activities]
+            with timer.phase("check"):
+                return [self.constraint_tree.check(activity) for activity in parsed]
 
-    def check_conflicts(self, activities):
-        '''Flag which activities are conflicts using stored constraints'''
         results = []
         for activity in activities:
             results.append(self.constraint_tree.check(Activity(activity)))
 
         return results
 
-def detectmain(logdata, action_constraints):
+    def iter_conflicts(self, activity_chunks):
+        '''Yield activities that are conflicts from an iterable of activity lists'''
+        for activities in activity_chunks:
+            if self.profiler is not None:
+                yield from (activity for activity, conflict in zip(activities, self.check_conflicts(activities)) if conflict)
+                continue
+            for activity in activities:
+                if self.constraint_tree.check(Activity(activity)):
+                    yield activity
+
+def detectmain(logdata, action_constraints, timer=None):
     '''Detect which activities in logs are conflicts.
 
     Args:
         logdata: List[List[str]], activity descriptions in log format
         action_constraints: List[List[str]], action constraints
+        timer: PhaseTimer | None, records time to build the engine, parse
+            logs and check them
 
     Returns: list of booleans equal in length to logdata, indicating if each
         activity was a conflict
     '''
-    engine = ConflictDetectionEngine(action_constraints)
-    return engine.check_conflicts(logdata)
+    engine = ConflictDetectionEngine(action_constraints, timer)
+    return engine.check_conflicts(logdata, timer)
+
+# Fields of an action constraint in detection format, with their types;
+# doc ids and actors are also required to be non-empty
+CONSTRAINT_FIELDS = [('doc names', list), ('doc ids', list), ('action', str), ('action type', str),
+                     ('actors', list), ('action value', str), ('comparator', str), ('owner', str),
+                     ('allowed values', (list, str))]
+
+def check_constraint(constraint):
+    '''Check that an action constraint is in detection format.
+
+    Args:
+        constraint: List, action constraint as given to ConflictDetectionEngine
+
+    Raises: ValueError, naming the first field that is missing or malformed
+    '''
+    if not isinstance(constraint, list):
+        raise ValueError("Action constraint must be a list")
+    if len(constraint) < len(CONSTRAINT_FIELDS):
+        raise ValueError("Action constraint needs %d fields, got %d" % (len(CONSTRAINT_FIELDS), len(constraint)))
+    for (name, kind), value in zip(CONSTRAINT_FIELDS, constraint):
+        if not isinstance(value, kind) or (isinstance(value, list) and not all(isinstance(item, str) for item in value)):
+            raise ValueError("Invalid %s in action constraint: %r" % (name, value))
+    for index, name in ((1, 'doc ids'), (4, 'actors')):
+        if not constraint[index]:
+            raise ValueError("Action constraint has no %s" % name)
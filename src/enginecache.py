@@ -0,0 +1,195 @@
+import threading, time
+from datetime import datetime, timedelta
+from src.detection import ConflictDetectionEngine, DocumentNode
+from src.incremental import load_engine
+from src.metrics import ENGINE_BUILD_SECONDS, CACHE_HITS, NULL_TIMER
+
+def change_time(value):
+    '''Return a change time read from the database as a datetime'''
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+class EngineCache():
+    '''Keep one ConflictDetectionEngine per process, up to date with the
+    action constraints in the database.
+
+    The engine is built once. Later calls to get only read constraints
+    changed or deleted since the previous refresh and rebuild the subtrees of
+    the documents those constraints are on. The refreshed engine shares all
+    other subtrees with the previous one and replaces it with a single
+    assignment, so requests still using the previous engine see a consistent
+    tree.
+
+    Change times are read back margin seconds before the latest one seen,
+    so that changes committed late with an earlier time are not missed;
+    changes already applied are recognized by their time and skipped.
+
+    Attributes:
+        engine: ConflictDetectionEngine | None, current engine
+        margin: float, seconds re-read before the latest change time
+        profiler: EngineProfiler | None, attached to every engine built
+        owner_domain: str | None, only load constraints whose owner's email
+            is in this domain. A constraint moved to an owner in another
+            domain stays in the engine until it is loaded again.
+        refresh_interval: float, seconds between checks for constraint
+            changes, 0 to check on every get
+        change_signal: ChangeSignal | None, shared by caches in preforked
+            workers: a cache that finds changes on its own signals the others
+            to check on their next get
+        stats: dict, number of full loads and of refreshes that changed the
+            engine, rebuilt documents and duration of the last refresh
+    '''
+
+    def __init__(self, margin=5.0, profiler=None, owner_domain=None, refresh_interval=0.0, change_signal=None):
+        self.engine = None
+        self.margin = margin
+        self.profiler = profiler
+        self.owner_domain = owner_domain
+        self.refresh_interval = refresh_interval
+        self.change_signal = change_signal
+        self._checked_at = None
+        self._generation = change_signal.generation if change_signal else None
+        self.stats = {'loads': 0, 'refreshes': 0, 'rebuilt_docs': 0, 'last_refresh_seconds': None}
+        self._versions = {} # constraint id: change time
+        self._docs = {} # constraint id: document ids
+        self._changed_since = None
+        self._deleted_since = None
+        self._lock = threading.Lock()
+
+    def get(self, db, timer=None):
+        '''Return the current engine after applying constraint changes
+
+        Only the first call waits for the engine to be built. While another
+        thread refreshes the engine, the current one is returned.
+
+        Args:
+            db: DatabaseQuery
+            timer: PhaseTimer | None, records time to read constraints
+                ("constraint_fetch") and build the engine ("engine_build")
+        '''
+        if self.engine is None:
+            with self._lock:
+                if self.engine is None:
+                    self.load(db, timer)
+                    self._checked_at = time.monotonic()
+        elif self._due() and self._lock.acquire(blocking=False):
+            try:
+                generation = self.change_signal.generation if self.change_signal else None
+                signalled = generation != self._generation
+                self._checked_at = time.monotonic()
+                if self.refresh(db, timer):
+                    if self.change_signal and not signalled:
+                        generation = self.change_signal.bump(generation)
+                else:
+                    CACHE_HITS.inc(cache="engine")
+                self._generation = generation
+            finally:
+                self._lock.release()
+        else:
+            CACHE_HITS.inc(cache="engine")
+        return self.engine
+
+    def _due(self):
+        '''Return True if constraint changes should be checked for'''
+        if self.change_signal and self.change_signal.generation != self._generation:
+            return True
+        return self._checked_at is None or time.monotonic() - self._checked_at >= self.refresh_interval
+
+    def load(self, db, timer=None):
+        '''Build the engine from all constraints'''
+        with (timer or NULL_TIMER).phase("constraint_fetch"):
+            changes = db.extract_constraint_changes(owner_domain=self.owner_domain)
+            deleted = db.extract_deleted_constraints()
+        engine = load_engine(db, timer=timer, owner_domain=self.owner_domain)
+        with (timer or NULL_TIMER).phase("constraint_fetch"):
+            self._docs = db.extract_constraint_docs(owner_domain=self.owner_domain)
+        self._versions = dict(changes)
+        self._changed_since = self._since(changes)
+        self._deleted_since = self._since(deleted)
+        engine.profiler = self.profiler
+        self.engine = engine
+        self.stats['loads'] += 1
+
+    def refresh(self, db, timer=None):
+        '''Apply constraints changed or deleted since the last refresh
+
+        Returns: bool, True if the engine changed
+        '''
+        T0 = time.perf_counter()
+        phases = timer or NULL_TIMER
+        with phases.phase("constraint_fetch"):
+            changes = db.extract_constraint_changes(self._format(self._changed_since), self.owner_domain)
+            deleted = db.extract_deleted_constraints(self._format(self._deleted_since))
+        changed = [constraint_id for constraint_id, updated_at in changes if self._versions.get(constraint_id) != updated_at]
+        removed = [constraint_id for constraint_id, deleted_at in deleted if constraint_id in self._versions]
+        self._changed_since = self._since(changes, self._changed_since)
+        self._deleted_since = self._since(deleted, self._deleted_since)
+        if not changed and not removed:
+            return False
+
+        with phases.phase("constraint_fetch"):
+            new_docs = db.extract_constraint_docs(changed)
+        affected = set()
+        for constraint_id in changed + removed:
+            affected.update(self._docs.get(constraint_id, []))
+        for doc_ids in new_docs.values():
+            affected.update(doc_ids)
+
+        rebuilt = ConflictDetectionEngine()
+        rebuilt.load_grouped(db.stream_constraints_by_doc(sorted(affected), owner_domain=self.owner_domain), timer)
+        with phases.phase("engine_build"):
+            tree = DocumentNode()
+            tree.constraints = {doc_id: node for doc_id, node in self.engine.constraint_tree.constraints.items() if doc_id not in affected}
+            tree.constraints.update(rebuilt.constraint_tree.constraints)
+            engine = ConflictDetectionEngine()
+            engine.constraint_tree = tree
+            engine.profiler = self.profiler
+
+        versions = dict(changes)
+        for constraint_id in changed:
+            self._versions[constraint_id] = versions[constraint_id]
+            self._docs[constraint_id] = new_docs.get(constraint_id, [])
+        for constraint_id in removed:
+            self._versions.pop(constraint_id, None)
+            self._docs.pop(constraint_id, None)
+        self.engine = engine
+
+        self.stats['refreshes'] += 1
+        self.stats['rebuilt_docs'] += len(affected)
+        self.stats['last_refresh_seconds'] = round(time.perf_counter() - T0, 6)
+        ENGINE_BUILD_SECONDS.observe(time.perf_counter() - T0, kind="refresh")
+        return True
+
+    def snapshot(self):
+        '''Return the engine and change tracking state, to restore with restore
+        instead of loading all constraints again. None before the first load.'''
+        with self._lock:
+            if self.engine is None:
+                return None
+            engine = ConflictDetectionEngine()
+            engine.constraint_tree = self.engine.constraint_tree
+            return {'engine': engine, 'versions': dict(self._versions), 'docs': dict(self._docs),
+                    'changed_since': self._changed_since, 'deleted_since': self._deleted_since}
+
+    def restore(self, state):
+        '''Resume from a snapshot; the next get applies changes made since'''
+        with self._lock:
+            self._versions = state['versions']
+            self._docs = state['docs']
+            self._changed_since = state['changed_since']
+            self._deleted_since = state['deleted_since']
+            state['engine'].profiler = self.profiler
+            self.engine = state['engine']
+
+    def _since(self, rows, previous=None):
+        '''Return the time to read changes from next, margin before the latest'''
+        times = [change_time(row[1]) for row in rows if row[1] is not None]
+        if not times:
+            return previous
+        since = max(times) - timedelta(seconds=self.margin)
+        return since if previous is None or since > previous else previous
+
+    @staticmethod
+    def _format(since):
+        return None if since is None else since.strftime("%Y-%m-%d %H:%M:%S.%f")
@@ -0,0 +1,142 @@
+import hashlib, os, pickle, sys, threading
+from collections import OrderedDict
+from src.enginecache import EngineCache
+
+def tenant_of(email):
+    '''Return the tenant of a user or constraint owner: the domain of their email'''
+    return email.rsplit('@', 1)[-1].lower()
+
+def engine_size(engine):
+    '''Estimate the memory held by the constraint tree of an engine, in bytes
+
+    Counts the tree's dicts, nodes, condition lists and values; strings
+    shared with other objects are counted once per reference.
+    '''
+    size = sys.getsizeof(engine.constraint_tree.constraints)
+    for doc_id, action_node in engine.constraint_tree.constraints.items():
+        size += sys.getsizeof(doc_id) + sys.getsizeof(action_node) + sys.getsizeof(action_node.constraints)
+        for action_type, actor_node in action_node.constraints.items():
+            size += sys.getsizeof(actor_node) + sys.getsizeof(actor_node.constraints)
+            for actor, condition_node in actor_node.constraints.items():
+                size += sys.getsizeof(actor) + sys.getsizeof(condition_node) + sys.getsizeof(condition_node.conditions)
+                for comparator, values in condition_node.conditions:
+                    size += sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+    return size
+
+class EngineRegistry():
+    '''Keep one EngineCache per tenant within a memory budget.
+
+    A tenant's engine holds only the constraints whose owner is in the
+    tenant's domain, and is built on the tenant's first request. When the
+    estimated size of all engines exceeds budget_bytes, the least recently
+    used engines are evicted. With snapshot_dir, an evicted engine is saved
+    there and later restored from the snapshot and brought up to date with
+    the constraint changes made since, instead of being loaded from all
+    constraints again. Snapshot files are pickles: keep the directory
+    private to the application.
+
+    Attributes:
+        budget_bytes: int, estimated bytes all cached engines may hold
+        snapshot_dir: str | None
+        margin: float, passed to each EngineCache
+        profiler: EngineProfiler | None, passed to each EngineCache
+        stats: dict, hits, loads, restores from snapshots, evictions,
+            cached tenants and their estimated bytes
+    '''
+
+    def __init__(self, budget_bytes=256 * 1024 * 1024, snapshot_dir=None, margin=5.0, profiler=None):
+        self.budget_bytes = budget_bytes
+        self.snapshot_dir = snapshot_dir
+        self.margin = margin
+        self.profiler = profiler
+        self.stats = {'hits': 0, 'loads': 0, 'restores': 0, 'evictions': 0, 'tenants': 0, 'bytes': 0}
+        self._entries = OrderedDict() # tenant: entry dict, least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, db, tenant):
+        '''Return the up to date engine of a tenant, building it if not cached
+
+        Args:
+            db: DatabaseQuery
+            tenant: str, domain of the constraint owners
+        '''
+        with self._lock:
+            entry = self._entries.get(tenant)
+            if entry is None:
+                entry = {'cache': EngineCache(self.margin, self.profiler, owner_domain=tenant), 'size': 0, 'engine': None,
+                         'lock': threading.Lock()}
+                self._entries[tenant] = entry
+            else:
+                self._entries.move_to_end(tenant)
+                self.stats['hits'] += 1
+
+        # Built outside the registry lock, so other tenants are served meanwhile
+        with entry['lock']:
+            cache = entry['cache']
+            if cache.engine is None:
+                self._restore(tenant, cache)
+            engine = cache.get(db)
+            if engine is not entry['engine']:
+                entry['size'] = engine_size(engine)
+                entry['engine'] = engine
+
+        with self._lock:
+            evicted = self._evict(keep=tenant)
+        for evicted_tenant, evicted_entry in evicted:
+            self._save(evicted_tenant, evicted_entry['cache'])
+        return engine
+
+    def evict(self, tenant):
+        '''Drop the engine of a tenant, saving a snapshot if configured'''
+        with self._lock:
+            entry = self._entries.pop(tenant, None)
+            self._update_stats()
+        if entry is not None:
+            self._save(tenant, entry['cache'])
+
+    def _evict(self, keep):
+        '''Evict least recently used engines until within budget. Called
+        with the lock held.
+
+        Returns: list of (tenant, entry) evicted, to save without the lock
+        '''
+        evicted = []
+        while sum(entry['size'] for entry in self._entries.values()) > self.budget_bytes:
+            tenant = next((tenant for tenant in self._entries if tenant != keep), None)
+            if tenant is None:
+                break
+            evicted.append((tenant, self._entries.pop(tenant)))
+            self.stats['evictions'] += 1
+        self._update_stats()
+        return evicted
+
+    def _update_stats(self):
+        self.stats['tenants'] = len(self._entries)
+        self.stats['bytes'] = sum(entry['size'] for entry in self._entries.values())
+
+    def _snapshot_path(self, tenant):
+        return os.path.join(self.snapshot_dir, "engine-" + hashlib.sha256(tenant.encode()).hexdigest()[:16] + ".pickle")
+
+    def _save(self, tenant, cache):
+        if self.snapshot_dir is None:
+            return
+        state = cache.snapshot()
+        if state is None:
+            return
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = self._snapshot_path(tenant)
+        with open(path + ".tmp", "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def _restore(self, tenant, cache):
+        '''Restore cache from the tenant's snapshot if any, else it loads on get'''
+        if self.snapshot_dir is not None and os.path.exists(self._snapshot_path(tenant)):
+            try:
+                with open(self._snapshot_path(tenant), "rb") as file:
+                    cache.restore(pickle.load(file))
+                self.stats['restores'] += 1
+                return
+            except Exception as e:
+                print("Unable to restore engine snapshot of " + tenant + ": " + str(e))
+        self.stats['loads'] += 1
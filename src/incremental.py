@@ -0,0 +1,143 @@
+import time
+from src.detection import ConflictDetectionEngine
+from src.metrics import timed, ENGINE_BUILD_SECONDS, DETECTION_SECONDS, CONFLICTS_FOUND, NULL_TIMER
+
+@timed(ENGINE_BUILD_SECONDS, kind="full")
+def load_engine(db, doc_ids=None, timer=None, owner_domain=None):
+    '''Build a ConflictDetectionEngine from action constraints in database
+
+    Args:
+        db: DatabaseQuery
+        doc_ids: list of str | None, only load constraints on these documents
+        timer: PhaseTimer | None, records time to read and load constraints
+        owner_domain: str | None, only load constraints owned in this domain
+    '''
+    engine = ConflictDetectionEngine()
+    engine.load_grouped(db.stream_constraints_by_doc(doc_ids, owner_domain=owner_domain), timer)
+    return engine
+
+class IncrementalDetector():
+    '''Detect conflicts only in activity logs not checked yet.
+
+    The id of the last checked log is persisted in detection_watermark, and
+    committed together with the conflicts found in each chunk, so every log
+    is checked once no matter how often detection runs.
+
+    Attributes:
+        engine: ConflictDetectionEngine
+        chunk_size: int, logs checked per transaction
+    '''
+
+    LOCK_NAME = "accord_conflict_detection"
+
+    def __init__(self, engine, chunk_size=1000):
+        self.engine = engine
+        self.chunk_size = chunk_size
+
+    def detect_new(self, db, timeout=0, timer=None):
+        '''Check logs added since the watermark and store their conflicts
+
+        Only logs on documents with constraints, with an action some
+        constraint applies to, are read from the database; the watermark
+        still moves past the others.
+
+        Args:
+            db: DatabaseQuery
+            timeout: int, seconds to wait for a detection run in progress
+            timer: PhaseTimer | None, records time to read logs ("log_fetch"),
+                parse and check them, and store conflicts ("persist")
+
+        Returns: (int, int), number of checked logs and of conflicts, None if
+            another detection run held the lock. Logs filtered out in the
+            query are not counted as checked.
+        '''
+        if not db.acquire_lock(self.LOCK_NAME, timeout):
+            return None
+
+        T0 = time.perf_counter()
+        phases = timer or NULL_TIMER
+        checked, conflicts = 0, 0
+        doc_ids, actions = log_filter(self.engine)
+        try:
+            with phases.phase("log_fetch"):
+                last_log_id = db.extract_detection_watermark()
+                # Logs inserted after this point are left for the next run
+                max_log_id = db.extract_max_log_id()
+            while last_log_id < max_log_id:
+                rows = []
+                with phases.phase("log_fetch"):
+                    if doc_ids:
+                        rows = db.extract_logs_after_id(last_log_id, self.chunk_size, max_log_id, doc_ids, actions)
+                logs = [list(row[1:]) for row in rows]
+                result = self.engine.check_conflicts(logs, timer)
+                found = [(log[0], log[1]) for log, conflict in zip(logs, result) if conflict]
+                conflicts += len(found)
+
+                # A short chunk means no matching logs are left up to max_log_id
+                last_log_id = rows[-1][0] if len(rows) == self.chunk_size else max_log_id
+                with phases.phase("persist"):
+                    db.add_conflicts(found, commit=False)
+                    db.update_detection_watermark(last_log_id, commit=False)
+                    db.commit()
+                checked += len(rows)
+        finally:
+            db.release_lock(self.LOCK_NAME)
+
+        DETECTION_SECONDS.observe(time.perf_counter() - T0, mode="incremental")
+        CONFLICTS_FOUND.inc(conflicts, mode="incremental")
+        return checked, conflicts
+
+def constraint_action_filter(action_type):
+    '''Return the logged action an action type applies to, mirroring Activity
+
+    Args:
+        action_type: str, action type of a constraint
+
+    Returns: (str, bool), action and whether it must match exactly, or is a prefix
+    '''
+    if action_type in ("Add Permission", "Remove Permission", "Update Permission"):
+        return "Per", False
+    elif action_type == "Can Move":
+        return "Mov", False
+    elif action_type == "Time Limit Edit":
+        return "Edit", True
+    else:
+        return action_type[len("Can "):], True
+
+def log_filter(engine):
+    '''Return the filters of logs that can conflict with engine's constraints
+
+    Returns: (list of str, list of (str, bool)), document ids and the
+        actions as returned by constraint_action_filter
+    '''
+    actions = {constraint_action_filter(action_type) for action_type in engine.constrained_action_types()}
+    return engine.constrained_docs(), sorted(actions)
+
+class RetroactiveDetector():
+    '''Find past activities that violate a newly added constraint.
+
+    Instead of checking the whole activity_log, only logs on the constraint's
+    documents, by its actors, with a matching action are fetched through the
+    (doc_id, action, actor_name) index and checked against the constraint.
+    '''
+
+    def detect_constraint(self, db, constraint):
+        '''Check past logs against one constraint and store their conflicts
+
+        Args:
+            db: DatabaseQuery
+            constraint: List, action constraint in detection format
+
+        Returns: list of logs that conflict with the constraint
+        '''
+        T0 = time.perf_counter()
+        action, exact = constraint_action_filter(constraint[3])
+        logs = db.extract_logs_for_constraint(constraint[1], action, constraint[4], exact)
+        engine = ConflictDetectionEngine([constraint])
+        result = engine.check_conflicts(logs)
+
+        conflicts = [log for log, conflict in zip(logs, result) if conflict]
+        db.add_conflicts([(log[0], log[1]) for log in conflicts])
+        DETECTION_SECONDS.observe(time.perf_counter() - T0, mode="retroactive")
+        CONFLICTS_FOUND.inc(len(conflicts), mode="retroactive")
+        return conflicts
@@ -0,0 +1,202 @@
+import os, random, socket, threading, time
+from datetime import datetime
+from src.activitylogs import Logupdater
+from src.pipeline import IngestionPipeline
+from src.incremental import IncrementalDetector, load_engine
+from src.sqlconnector import next_month
+
+class IngestionScheduler():
+    '''Run log ingestion in a background thread.
+
+    A pass runs Logupdater every interval seconds, plus up to jitter seconds
+    so that several app processes don't poll the Reports API in lockstep.
+    Passes never overlap: a thread lock guards this process, and a named
+    database lock guards other processes sharing the database. Processes
+    running a scheduler each also take their turn through a lease in
+    scheduler_leases, which records the last pass: a process skips a pass
+    if another one ran a pass within interval, so the Reports API is polled
+    once per interval however many processes poll. Triggered passes run
+    regardless.
+
+    Attributes:
+        db_pool: ConnectionPool
+        interval: float, seconds between passes
+        jitter: float, maximum random seconds added to each interval
+        pipelined: bool, run passes with IngestionPipeline, which detects
+            conflicts in each new batch as it is committed. Otherwise
+            conflicts in new logs are detected after the pass.
+        retention_months: int | None, months of logs kept in activity_log
+            besides the current one; older months are moved to archive_dir
+            after a pass. None keeps all logs.
+        archive_dir: str, directory of archived logs
+        engine_cache: EngineCache | None, engine to detect conflicts with,
+            a new engine is loaded for each pass if None
+        reportsAPI_service: googleapiclient.discovery.Resource | None
+        stats: dict, metrics about the most recent pass, and the error of
+            partition maintenance after it, if it failed
+    '''
+
+    LOCK_NAME = "accord_log_ingestion"
+
+    def __init__(self, db_pool, interval=300, jitter=30, pipelined=False, retention_months=None, archive_dir="archive", engine_cache=None):
+        self.db_pool = db_pool
+        self.interval = interval
+        self.jitter = jitter
+        self.pipelined = pipelined
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.engine_cache = engine_cache
+        self.reportsAPI_service = None
+        self.stats = {
+            'running': False,
+            'last_run': None,
+            'last_run_latency': None,
+            'last_run_rows': 0,
+            'last_run_conflicts': 0,
+            'rows_per_sec': None,
+            'lag_seconds': None,
+            'last_error': None,
+            'skipped_runs': 0,
+            'pipeline': None,
+            'archived': [],
+            'partition_error': None,
+        }
+        self._pass_lock = threading.Lock()
+        self._force = False
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, reportsAPI_service):
+        '''Start polling with provided service. Later calls only replace the service.'''
+        self.reportsAPI_service = reportsAPI_service
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="log-ingestion", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''Stop polling after the current pass'''
+        self._stop.set()
+        self._wake.set()
+
+    def trigger(self):
+        '''Request a pass now without waiting for it'''
+        self._force = True
+        self._wake.set()
+
+    def status(self):
+        '''Return a copy of ingestion stats'''
+        return dict(self.stats)
+
+    def _run(self):
+        while not self._stop.is_set():
+            force, self._force = self._force, False
+            self.run_once(force)
+            self._wake.wait(self.interval + random.uniform(0, self.jitter))
+            self._wake.clear()
+
+    def run_once(self, force=False):
+        '''Run one ingestion pass unless another one holds the lock, or,
+        unless forced, another process ran one within interval.
+
+        Returns: int | None, number of ingested logs, None if skipped or not due
+        '''
+        if self.reportsAPI_service is None or not self._pass_lock.acquire(blocking=False):
+            self.stats['skipped_runs'] += 1
+            return None
+
+        try:
+            with self.db_pool.connection() as db:
+                if not db.acquire_lock(self.LOCK_NAME):
+                    self.stats['skipped_runs'] += 1
+                    return None
+                try:
+                    owner = socket.gethostname() + ":" + str(os.getpid())
+                    if not db.claim_lease(self.LOCK_NAME, owner, time.time(), 0 if force else self.interval):
+                        return None
+                    self.stats['running'] = True
+                    T0 = time.perf_counter()
+                    if self.pipelined:
+                        pipeline = IngestionPipeline(self.db_pool, self.reportsAPI_service, engine_cache=self.engine_cache)
+                        try:
+                            total_logs = pipeline.run()
+                        finally:
+                            self.stats['pipeline'] = pipeline.metrics()
+                        self.stats['last_run_conflicts'] = pipeline.conflicts
+                    else:
+                        total_logs = Logupdater(self.db_pool, self.reportsAPI_service).updateLogs_database()
+                        engine = self.engine_cache.get(db) if self.engine_cache else load_engine(db)
+                        detected = IncrementalDetector(engine).detect_new(db, timeout=60)
+                        self.stats['last_run_conflicts'] = detected[1] if detected else 0
+                    T1 = time.perf_counter()
+                    self._record_pass(total_logs, T1 - T0, db.extract_lastLog_date())
+
+                    # Logs of the pass are committed: a maintenance failure doesn't fail the pass
+                    try:
+                        self.maintain_partitions(db)
+                        self.stats['partition_error'] = None
+                    except Exception as e:
+                        self.stats['partition_error'] = str(e)
+                finally:
+                    db.release_lock(self.LOCK_NAME)
+                    self.stats['running'] = False
+            return self.stats['last_run_rows']
+
+        except Exception as e:
+            self.stats['last_error'] = str(e)
+            return None
+        finally:
+            self._pass_lock.release()
+
+    def _record_pass(self, total_logs, seconds, last_log_date):
+        self.stats['last_run'] = datetime.utcnow().isoformat() + "Z"
+        self.stats['last_run_latency'] = round(seconds, 3)
+        if isinstance(total_logs, int):
+            self.stats['last_run_rows'] = total_logs
+            self.stats['rows_per_sec'] = round(total_logs / seconds, 1) if seconds > 0 else None
+            self.stats['last_error'] = None
+        else:
+            # Logupdater reports failures as a message
+            self.stats['last_run_rows'] = 0
+            self.stats['last_error'] = total_logs
+        self.stats['lag_seconds'] = self.lag_seconds(last_log_date)
+
+    def maintain_partitions(self, db, today=None):
+        '''Add activity_log partitions through next month and archive
+        months older than retention_months
+
+        Args:
+            db: DatabaseQuery
+            today: datetime.date | None, current date
+        '''
+        today = today or datetime.utcnow().date()
+        this_month = today.strftime("%Y-%m")
+        db.ensure_log_partitions(next_month(this_month))
+        if self.retention_months is not None:
+            months = today.year * 12 + today.month - 1 - self.retention_months
+            cutoff = "%04d-%02d" % (months // 12, months % 12 + 1)
+            archived = db.archive_logs_before(cutoff, self.archive_dir)
+            if archived:
+                self.stats['archived'] = self.stats['archived'] + [path for path, count in archived]
+
+    @staticmethod
+    def merge_status(statuses):
+        '''Combine the status of the schedulers of several processes
+
+        Returns: dict, status of the process that ran the last pass, running
+            if any process is, with skipped runs and archives of all
+        '''
+        merged = dict(max(statuses, key=lambda status: status['last_run'] or ""))
+        merged['running'] = any(status['running'] for status in statuses)
+        merged['skipped_runs'] = sum(status['skipped_runs'] for status in statuses)
+        merged['archived'] = sorted(set(path for status in statuses for path in status['archived']))
+        return merged
+
+    @staticmethod
+    def lag_seconds(last_log_date):
+        '''Return seconds between the most recent ingested log and now'''
+        if last_log_date is None:
+            return None
+        if isinstance(last_log_date, str):
+            last_log_date = datetime.strptime(last_log_date, "%Y-%m-%dT%H:%M:%S.%fZ")
+        return round((datetime.utcnow() - last_log_date).total_seconds(), 1)
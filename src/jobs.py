@@ -0,0 +1,253 @@
+import threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from src.metrics import DETECTION_SECONDS, CONFLICTS_FOUND
+
+class DetectionJob():
+    '''Conflict detection over a range of logs, run in the background
+
+    Attributes:
+        id: str
+        since: str, detect in logs after this time
+        until: str | None, and up to this time
+        status: str, "queued", "running", "done", "failed" or "cancelled"
+        total_rows: int | None, logs in the range, once counted
+        rows_scanned: int, logs checked so far
+        conflicts: int, conflicting logs found so far, stored in
+            detection_job_conflicts
+        error: str | None, why the job failed
+        submitted, started, finished: str | None, ISO times
+        cancel_requested: threading.Event
+        future: concurrent.futures.Future | None, of a job run by this process
+    '''
+
+    def __init__(self, since, until=None):
+        self.id = uuid.uuid4().hex
+        self.since = since
+        self.until = until
+        self.status = "queued"
+        self.total_rows = None
+        self.rows_scanned = 0
+        self.conflicts = 0
+        self.error = None
+        self.submitted = datetime.utcnow().isoformat() + "Z"
+        self.started = None
+        self.finished = None
+        self.cancel_requested = threading.Event()
+        self.future = None
+
+    @classmethod
+    def from_row(cls, row):
+        '''Return a job as stored in detection_jobs, see DatabaseQuery.extract_detection_job'''
+        job = cls(row[1], row[2])
+        (job.id, job.status, job.total_rows, job.rows_scanned, job.conflicts, job.error,
+         job.submitted, job.started, job.finished) = (row[0],) + tuple(row[3:11])
+        if row[11]:
+            job.cancel_requested.set()
+        return job
+
+    def progress(self):
+        '''Return status and progress counters'''
+        return {
+            'job_id': self.id,
+            'since': self.since,
+            'until': self.until,
+            'status': self.status,
+            'total_rows': self.total_rows,
+            'rows_scanned': self.rows_scanned,
+            'conflicts': self.conflicts,
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+    def finished_running(self):
+        return self.status not in ("queued", "running")
+
+class JobManager():
+    '''Run detection jobs on a bounded pool of worker threads.
+
+    A job streams the logs of its range through the cached engine in chunks,
+    stores the conflicts of each chunk, with the ids of their logs in
+    detection_job_conflicts for result pages, and updates its progress
+    between chunks, where it also stops if cancelled. Jobs wait in the
+    pool's queue while all workers are busy.
+
+    Jobs are stored in detection_jobs, and their progress is committed with
+    the conflicts of each chunk, so any process sharing the database can
+    report and cancel a job that another process runs. The most recent
+    max_jobs jobs are kept; older finished ones are deleted with their
+    results.
+
+    A background thread refreshes the heartbeat of the jobs queued and
+    running in this process every stale_after / 3 seconds, as do chunk
+    commits. Jobs whose heartbeat is older than stale_after, because their
+    process exited, are marked failed when a job is submitted or the job is
+    read.
+
+    A running job holds two connections, one streaming logs and one storing
+    conflicts, checked out together.
+
+    Attributes:
+        db_pool: ConnectionPool
+        engine_cache: EngineCache
+        chunk_size: int, logs checked between progress updates
+        max_jobs: int, jobs kept, oldest finished jobs are dropped first
+        stale_after: float, seconds without heartbeat after which a queued
+            or running job is failed
+    '''
+
+    STALE_ERROR = "worker exited"
+
+    def __init__(self, db_pool, engine_cache, workers=2, chunk_size=10000, max_jobs=100, stale_after=300):
+        self.db_pool = db_pool
+        self.engine_cache = engine_cache
+        self.chunk_size = chunk_size
+        self.max_jobs = max_jobs
+        self.stale_after = stale_after
+        self._running = {} # id: DetectionJob, queued or running in this process
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="detection-job")
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+
+    def submit(self, since, until=None):
+        '''Queue a detection job on logs after since, and up to until
+
+        Returns: DetectionJob
+        '''
+        job = DetectionJob(since, until)
+        with self.db_pool.connection() as db:
+            self._fail_stale(db)
+            db.add_detection_job(job.id, since, until, job.submitted, time.time(), commit=False)
+            db.expire_detection_jobs(self.max_jobs, commit=False)
+            db.commit()
+        with self._lock:
+            self._running[job.id] = job
+            if self._heartbeat_thread is None or not self._heartbeat_thread.is_alive():
+                # Started on first use, after any fork
+                self._stop.clear()
+                self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="detection-job-heartbeat", daemon=True)
+                self._heartbeat_thread.start()
+        job.future = self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        '''Return job with provided id as last committed, None if unknown or expired'''
+        with self.db_pool.connection() as db:
+            row = db.extract_detection_job(job_id)
+            if row and row[3] in ("queued", "running") and (row[12] or 0) < time.time() - self.stale_after:
+                self._fail_stale(db)
+                row = db.extract_detection_job(job_id)
+        return DetectionJob.from_row(row) if row else None
+
+    def results(self, job, after_id=0, limit=500):
+        '''Return a page of the logs a job found conflicting so far
+
+        Args:
+            job: DetectionJob
+            after_id: int, cursor returned with the previous page, 0 for the first
+            limit: int, maximum logs on the page
+
+        Returns: (list, int | None), logs in insertion order and the cursor
+            of the next page, None once the job has finished and there are
+            no more
+        '''
+        # Read the status first, so conflicts stored before it finished are on the page
+        finished = job.finished_running()
+        with self.db_pool.connection() as db:
+            rows, next_id = db.extract_job_conflicts_page(job.id, after_id, limit)
+        if next_id is None and not finished:
+            # More may be found: continue after this page
+            next_id = rows[-1][0] if rows else after_id
+        return [row[1:] for row in rows], next_id
+
+    def cancel(self, job_id):
+        '''Cancel a queued or running job, run by any process
+
+        Returns: DetectionJob | None, None if unknown
+        '''
+        with self.db_pool.connection() as db:
+            db.cancel_detection_job(job_id, datetime.utcnow().isoformat() + "Z")
+        with self._lock:
+            job = self._running.get(job_id)
+        if job is not None:
+            job.cancel_requested.set()
+            if job.future is not None and job.future.cancel():
+                self._finish(job, "cancelled")
+        return self.get(job_id)
+
+    def shutdown(self):
+        '''Cancel the jobs of this process and wait for running ones to stop'''
+        with self._lock:
+            job_ids = list(self._running)
+        for job_id in job_ids:
+            self.cancel(job_id)
+        self._executor.shutdown(wait=True)
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+
+    def _fail_stale(self, db):
+        db.fail_stale_detection_jobs(time.time() - self.stale_after, datetime.utcnow().isoformat() + "Z", self.STALE_ERROR)
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.stale_after / 3):
+            with self._lock:
+                job_ids = list(self._running)
+            if not job_ids:
+                continue
+            try:
+                with self.db_pool.connection() as db:
+                    db.touch_detection_jobs(job_ids, time.time())
+            except Exception as e:
+                print("Detection job heartbeat failed: " + str(e))
+
+    def _finish(self, job, status, db=None):
+        job.status = status
+        job.finished = datetime.utcnow().isoformat() + "Z"
+        if db is None:
+            with self.db_pool.connection() as db:
+                self._save_finished(job, db)
+        else:
+            self._save_finished(job, db)
+        with self._lock:
+            self._running.pop(job.id, None)
+
+    @staticmethod
+    def _save_finished(job, db):
+        db.update_detection_job(job.id, status=job.status, error=job.error, finished=job.finished)
+
+    def _run(self, job):
+        try:
+            # A streaming connection can't run other queries until the stream ends
+            with self.db_pool.connections(2) as (reader, writer):
+                job.started = datetime.utcnow().isoformat() + "Z"
+                # Cancelled while queued, possibly by another process
+                if job.cancel_requested.is_set() or not writer.start_detection_job(job.id, job.started):
+                    self._finish(job, "cancelled", writer)
+                    return
+                job.status = "running"
+                engine = self.engine_cache.get(writer)
+                job.total_rows = writer.count_logs_date(job.since, job.until)
+                writer.update_detection_job(job.id, total_rows=job.total_rows)
+                for rows in reader.stream_logs_date(job.since, self.chunk_size, job.until, with_id=True):
+                    if job.cancel_requested.is_set() or writer.extract_job_cancel_requested(job.id):
+                        job.cancel_requested.set()
+                        break
+                    T0 = time.perf_counter()
+                    flagged = engine.check_conflicts([row[1:] for row in rows])
+                    conflicts = [row for row, conflict in zip(rows, flagged) if conflict]
+                    writer.add_conflicts([(row[1], row[2]) for row in conflicts], commit=False)
+                    writer.add_job_conflicts(job.id, [row[0] for row in conflicts], commit=False)
+                    job.conflicts += len(conflicts)
+                    job.rows_scanned += len(rows)
+                    writer.update_detection_job(job.id, commit=False, rows_scanned=job.rows_scanned, conflicts=job.conflicts, heartbeat=time.time())
+                    writer.commit()
+                    DETECTION_SECONDS.observe(time.perf_counter() - T0, mode="job")
+                    CONFLICTS_FOUND.inc(len(conflicts), mode="job")
+                self._finish(job, "cancelled" if job.cancel_requested.is_set() else "done", writer)
+        except Exception as e:
+            job.error = str(e)
+            self._finish(job, "failed")
@@ -1,4 +1,5 @@
 from __future__ import print_function
+from src.metrics import REPORTS_API_SECONDS
 
 def get_doc_id(parameterList):
     '''Extract id from event parameters dict'''
@@ -21,38 +22,42 @@ def get_value(paramerterList, value_required, value):
             return item[value]
     return None
 
-def extractDriveLog(lastLogTime, service):
-    '''Fetch drive activity logs from API since provided time
+def fetchDriveLogPages(lastLogTime, service, pageToken=None):
+    '''Fetch drive activity logs from API one page at a time
 
     Args:
         lastLogTime: str, formatted date: "%Y-%m-%dT%H:%M:%S.%fZ"
         service: googleapiclient.discovery.Resource, for Admin SDK Reports API
+        pageToken: str | None, token of the page to resume from
 
-    Returns: list, formatted strings representing logs, first string has field labels
+    Yields: (list of raw activities, str | None), activities on the page and
+        the token of the following page, None on the last page
     '''
-    # Call the Admin SDK Reports API
-    try:
-        results = service.activities().list(
-            userKey='all',
-            applicationName='drive',
-            startTime = lastLogTime
-            ).execute()
-    except Exception as e:
-        raise Exception("Admin SDK Reports API call failed: " + str(e))
-
-    activities = results.get('items', [])
-    while 'nextPageToken' in results:
+    while True:
         try:
-            results = service.activities().list(
-                userKey='all',
-                applicationName='drive',
-                startTime = lastLogTime,
-                pageToken = results['nextPageToken']
-                ).execute()
+            with REPORTS_API_SECONDS.time(call="activities.list"):
+                results = service.activities().list(
+                    userKey='all',
+                    applicationName='drive',
+                    startTime = lastLogTime,
+                    pageToken = pageToken
+                    ).execute()
         except Exception as e:
             raise Exception("Admin SDK Reports API call failed: " + str(e))
-        activities += results.get('items', [])
-    logString = ["Activity_Time,Action,Doc_ID,Doc_Name,Actor_ID,Actor_Name"]
+        pageToken = results.get('nextPageToken')
+        yield results.get('items', []), pageToken
+        if not pageToken:
+            return
+
+def parseDriveActivities(activities):
+    '''Format raw Reports API activities as log strings
+
+    Args:
+        activities: list, activity resources returned by Admin SDK Reports API
+
+    Returns: list, formatted strings representing logs, without field labels
+    '''
+    logString = []
 
     for activity in activities:
         activityTime = activity['id']['time']
@@ -109,5 +114,20 @@ def extractDriveLog(lastLogTime, service):
 
     return logString
 
+def extractDriveLog(lastLogTime, service):
+    '''Fetch drive activity logs from API since provided time
+
+    Args:
+        lastLogTime: str, formatted date: "%Y-%m-%dT%H:%M:%S.%fZ"
+        service: googleapiclient.discovery.Resource, for Admin SDK Reports API
+
+    Returns: list, formatted strings representing logs, first string has field labels
+    '''
+    logString = ["Activity_Time,Action,Doc_ID,Doc_Name,Actor_ID,Actor_Name"]
+    for activities, _ in fetchDriveLogPages(lastLogTime, service):
+        logString += parseDriveActivities(activities)
+
+    return logString
+
 # Uncomment the following script for debugging purpose
 #print(extractDriveLog('2022-10-20T16:16:35.282Z'))
\ No newline at end of file
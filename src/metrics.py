@@ -0,0 +1,283 @@
+import threading, time, math
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+# Upper bounds in seconds of latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_labels(labels):
+    '''Format a dict of labels as a Prometheus label set, "" if empty'''
+    if not labels:
+        return ""
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels.items()]
+    return "{" + ",".join('%s="%s"' % label for label in escaped) + "}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class Metric():
+    '''A named metric with one value per combination of label values
+
+    Attributes:
+        name: str
+        help: str
+        labels: tuple of str, label names, every update must give all of them
+    '''
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {} # tuple of label values: value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(self.name + " takes labels " + ", ".join(self.labels))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        '''Return list of (name suffix, labels dict, value)'''
+        raise NotImplementedError
+
+class Counter(Metric):
+    '''Count of events, only going up'''
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [("", dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+class Histogram(Metric):
+    '''Distribution of observed values, usually durations in seconds, in
+    cumulative buckets with their sum and count'''
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if math.isnan(value):
+            return
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        '''Observe the duration of a with block'''
+        T0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - T0, **labels)
+
+    def count(self, **labels):
+        counts, total = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(("_bucket", dict(labels, le=format_value(float(bound))), cumulative))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, cumulative))
+        return samples
+
+def timed(histogram, **labels):
+    '''Decorate a function to observe its duration in histogram'''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Registry():
+    '''Metrics of the process, rendered in the Prometheus text format
+
+    Besides its own metrics, the registry renders the numbers in stats
+    dicts of other components, read when rendering, as gauges.
+    '''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix, help, stats, label=None):
+        '''Render the numeric values of a stats dict as gauges
+
+        Args:
+            prefix: str, gauge name prefix, followed by the key of each value
+            help: str
+            stats: function() -> dict
+            label: str | None, when given stats returns a dict of dicts, and
+                its keys are the values of this label
+        '''
+        self.collectors.append((prefix, help, stats, label))
+
+    def collect(self):
+        '''Return all metrics as JSON-serializable families, as render_families takes them'''
+        families = []
+        for metric in self.metrics:
+            families.append({'name': metric.name, 'help': metric.help, 'type': metric.type,
+                             'samples': [[metric.name + suffix, labels, value] for suffix, labels, value in metric.samples()]})
+        for prefix, help, stats, label in self.collectors:
+            gauges = {}
+            groups = stats() or {}
+            if label is None:
+                groups = {None: groups}
+            for group, values in groups.items():
+                for key, value in (values or {}).items():
+                    if isinstance(value, (int, float)):
+                        gauges.setdefault(prefix + "_" + key, []).append([prefix + "_" + key, {label: str(group)} if label else {}, float(value)])
+            for name, samples in gauges.items():
+                families.append({'name': name, 'help': help, 'type': "gauge", 'samples': samples})
+        return families
+
+    def render(self):
+        '''Return all metrics in the Prometheus text exposition format'''
+        return render_families(self.collect())
+
+def render_families(families):
+    '''Return metric families in the Prometheus text exposition format
+
+    Args:
+        families: list of dicts with name, help, type and samples, a list
+            of [sample name, labels dict, value]
+    '''
+    lines = []
+    for family in families:
+        lines.append("# HELP %s %s" % (family['name'], family['help']))
+        lines.append("# TYPE %s %s" % (family['name'], family['type']))
+        for name, labels, value in family['samples']:
+            lines.append(name + format_labels(labels) + " " + format_value(value))
+    return "\n".join(lines) + "\n"
+
+def merge_families(processes):
+    '''Combine the metric families collected by several processes
+
+    Counter and histogram samples with the same name and labels are summed.
+    Gauges, such as pool and cache statistics, are kept per process with a
+    worker label.
+
+    Args:
+        processes: dict, process id: families from Registry.collect
+
+    Returns: list of families
+    '''
+    merged = {} # name: family, in order of first appearance
+    for worker, families in processes.items():
+        for family in families:
+            target = merged.setdefault(family['name'], dict(family, samples={}))
+            for name, labels, value in family['samples']:
+                if family['type'] == "gauge":
+                    labels = dict(labels, worker=str(worker))
+                key = (name, tuple(sorted(labels.items())))
+                if key in target['samples']:
+                    target['samples'][key][2] += value
+                else:
+                    target['samples'][key] = [name, labels, value]
+    for family in merged.values():
+        family['samples'] = list(family['samples'].values())
+    return list(merged.values())
+
+class PhaseTimer():
+    '''Accumulate perf_counter durations of the phases of one request
+
+    Phases may nest: time spent in an inner phase is counted only for the
+    inner one, so the phase durations add up to the time measured.
+
+    Attributes:
+        seconds: dict, phase name: seconds, in order of first use
+    '''
+
+    def __init__(self):
+        self.seconds = {}
+        self._stack = [] # [start time, seconds in inner phases]
+
+    @contextmanager
+    def phase(self, name):
+        '''Count the duration of a with block in phase name'''
+        frame = [time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - frame[1]
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def iterate(self, iterable, name):
+        '''Yield from iterable, counting the time spent producing items in phase name'''
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def to_dict(self, digits=6):
+        '''Return rounded seconds per phase and their total'''
+        return {'phases': {name: round(seconds, digits) for name, seconds in self.seconds.items()},
+                'total': round(sum(self.seconds.values()), digits)}
+
+class NullTimer():
+    '''PhaseTimer that records nothing, for callers not asking for a breakdown'''
+
+    def phase(self, name):
+        return nullcontext()
+
+    def iterate(self, iterable, name):
+        return iterable
+
+NULL_TIMER = NullTimer()
+
+REGISTRY = Registry()
+
+ENGINE_BUILD_SECONDS = REGISTRY.histogram("accord_engine_build_seconds", "Time to build the detection engine from all constraints, or to apply constraint changes to it", ["kind"])
+DETECTION_SECONDS = REGISTRY.histogram("accord_detection_seconds", "Time to check logs for conflicts and store them", ["mode"])
+DB_FETCH_SECONDS = REGISTRY.histogram("accord_db_fetch_seconds", "Time to read logs and conflicts from the database", ["query"])
+CONFLICT_PERSIST_SECONDS = REGISTRY.histogram("accord_conflict_persist_seconds", "Time to store detected conflicts")
+REPORTS_API_SECONDS = REGISTRY.histogram("accord_reports_api_seconds", "Time of Admin SDK Reports API calls", ["call"])
+ROWS_INGESTED = REGISTRY.counter("accord_rows_ingested_total", "Activity logs committed by ingestion")
+CONFLICTS_FOUND = REGISTRY.counter("accord_conflicts_found_total", "Conflicting logs found", ["mode"])
+CACHE_HITS = REGISTRY.counter("accord_cache_hits_total", "Requests served from a cache without rebuilding", ["cache"])
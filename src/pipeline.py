@@ -0,0 +1,229 @@
+import queue, threading, time
+from src.activitylogs import Logupdater
+from src.logextraction import fetchDriveLogPages, parseDriveActivities
+from src.incremental import IncrementalDetector, load_engine
+
+# Marks the end of the stream passed between stages
+_END = object()
+
+class StageMetrics():
+    '''Throughput counters for one pipeline stage
+
+    Attributes:
+        items: int, batches handled
+        rows: int, logs handled
+        busy_seconds: float, time spent working, excluding queue waits
+        max_queue_depth: int, deepest input queue observed
+    '''
+
+    def __init__(self):
+        self.items = 0
+        self.rows = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def to_dict(self, input_queue=None):
+        metrics = {
+            'items': self.items,
+            'rows': self.rows,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'rows_per_sec': round(self.rows / self.busy_seconds, 1) if self.busy_seconds > 0 else None,
+            'max_queue_depth': self.max_queue_depth,
+        }
+        if input_queue is not None:
+            metrics['queue_depth'] = input_queue.qsize()
+        return metrics
+
+class IngestionPipeline():
+    '''Fetch, parse, insert and detect conflicts in new logs concurrently.
+
+    Each stage runs in its own thread and hands batches to the next through a
+    bounded queue, so network waits on the Reports API overlap database writes
+    and conflict detection. A stage that falls behind fills its input queue,
+    which blocks the stages before it all the way back to the fetch stage.
+
+    The write stage coalesces queued pages into one transaction of up to
+    batch_rows logs and commits them with the ingestion checkpoint, so a
+    failed run resumes like Logupdater.updateLogs_database. The detect stage
+    checks each committed batch with IncrementalDetector, which advances the
+    persisted detection watermark.
+
+    When a stage fails, the stages before it stop, and the stages after it
+    finish the batches already handed to them, so everything fetched before
+    the failure is committed and checked.
+
+    Attributes:
+        db_pool: ConnectionPool
+        reportsAPI_service: googleapiclient.discovery.Resource
+        queue_size: int, maximum batches waiting between two stages
+        batch_rows: int, logs committed per database transaction
+        engine_cache: EngineCache | None, engine to detect conflicts with,
+            a new engine is loaded if None
+        stages: dict, StageMetrics by stage name
+        conflicts: int, conflicts found in the run
+    '''
+
+    STAGES = ["fetch", "parse", "write", "detect"]
+
+    def __init__(self, db_pool, reportsAPI_service, queue_size=4, batch_rows=1000, engine_cache=None):
+        self.db_pool = db_pool
+        self.reportsAPI_service = reportsAPI_service
+        self.queue_size = queue_size
+        self.batch_rows = batch_rows
+        self.engine_cache = engine_cache
+        self.stages = {name: StageMetrics() for name in self.STAGES}
+        self.queues = {name: queue.Queue(maxsize=queue_size) for name in self.STAGES[1:]}
+        self.conflicts = 0
+        self._last_failed = -1 # Index of the last stage that failed
+        self._errors = []
+
+    def metrics(self):
+        '''Return per-stage throughput and queue depth'''
+        return {name: self.stages[name].to_dict(self.queues.get(name)) for name in self.STAGES}
+
+    def run(self):
+        '''Ingest all new logs and detect conflicts in them
+
+        Returns: int, number of ingested logs
+
+        Raises: the first exception raised by any stage
+        '''
+        with self.db_pool.connection() as db:
+            start_time, page_token, watermark = Logupdater.resume_point(db)
+            if start_time is None:
+                return 0
+            engine = self.engine_cache.get(db) if self.engine_cache else load_engine(db)
+            detector = IncrementalDetector(engine, chunk_size=self.batch_rows)
+
+        threads = [
+            threading.Thread(target=self._stage, args=("fetch", self._fetch, start_time, page_token)),
+            threading.Thread(target=self._stage, args=("parse", self._parse, watermark)),
+            threading.Thread(target=self._stage, args=("write", self._write, start_time)),
+            threading.Thread(target=self._stage, args=("detect", self._detect, detector)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return self.stages["write"].rows
+
+    def _stage(self, name, target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            index = self.STAGES.index(name)
+            self._errors.append(e)
+            self._last_failed = max(self._last_failed, index)
+            if index + 1 < len(self.STAGES):
+                self._put(self.STAGES[index + 1], _END)
+
+    def _failed_from(self, name):
+        '''Return True if stage name or one after it failed'''
+        return self._last_failed >= self.STAGES.index(name)
+
+    def _put(self, name, item):
+        '''Block until stage name accepts item, or it or a later stage failed'''
+        while not self._failed_from(name):
+            try:
+                self.queues[name].put(item, timeout=0.1)
+                depth = self.queues[name].qsize()
+                if depth > self.stages[name].max_queue_depth:
+                    self.stages[name].max_queue_depth = depth
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, name, block=True):
+        '''Return next item for stage, _END if a later stage failed, None if not blocking and empty'''
+        index = self.STAGES.index(name)
+        while not (index + 1 < len(self.STAGES) and self._failed_from(self.STAGES[index + 1])):
+            try:
+                return self.queues[name].get(block, timeout=0.1)
+            except queue.Empty:
+                if not block:
+                    return None
+        return _END
+
+    def _fetch(self, start_time, page_token):
+        metrics = self.stages["fetch"]
+        pages = fetchDriveLogPages(start_time, self.reportsAPI_service, page_token)
+        while not self._failed_from("parse"):
+            T0 = time.perf_counter()
+            page = next(pages, None)
+            metrics.busy_seconds += time.perf_counter() - T0
+            if page is None:
+                break
+            metrics.items += 1
+            metrics.rows += len(page[0])
+            self._put("parse", page)
+        self._put("parse", _END)
+
+    def _parse(self, watermark):
+        metrics = self.stages["parse"]
+        while True:
+            page = self._get("parse")
+            if page is _END:
+                break
+            T0 = time.perf_counter()
+            activities, next_page_token = page
+            activity_logs = parseDriveActivities(activities)
+            watermark = Logupdater.latest_log_time(activity_logs, watermark)
+            metrics.busy_seconds += time.perf_counter() - T0
+            metrics.items += 1
+            metrics.rows += len(activity_logs)
+            self._put("write", (activity_logs, next_page_token, watermark))
+        self._put("write", _END)
+
+    def _write(self, start_time):
+        with self.db_pool.connection() as db:
+            self._write_batches(db, start_time)
+        self._put("detect", _END)
+
+    def _write_batches(self, db, start_time):
+        metrics = self.stages["write"]
+        done = False
+        while not done:
+            # Coalesce whatever is already queued into one transaction
+            batch = self._get("write")
+            if batch is _END:
+                break
+            activity_logs, next_page_token, watermark = batch
+            activity_logs = list(activity_logs)
+            while len(activity_logs) < self.batch_rows:
+                batch = self._get("write", block=False)
+                if batch is None:
+                    break
+                if batch is _END:
+                    done = True
+                    break
+                activity_logs += batch[0]
+                next_page_token, watermark = batch[1], batch[2]
+
+            T0 = time.perf_counter()
+            Logupdater.commit_logs(db, activity_logs, start_time, next_page_token, watermark)
+            metrics.busy_seconds += time.perf_counter() - T0
+            metrics.items += 1
+            metrics.rows += len(activity_logs)
+            self._put("detect", activity_logs)
+
+    def _detect(self, detector):
+        with self.db_pool.connection() as db:
+            self._detect_batches(db, detector)
+
+    def _detect_batches(self, db, detector):
+        metrics = self.stages["detect"]
+        while True:
+            activity_logs = self._get("detect")
+            if activity_logs is _END:
+                break
+            T0 = time.perf_counter()
+            # Wait for a concurrent detection run instead of skipping the batch
+            result = detector.detect_new(db, timeout=60)
+            metrics.busy_seconds += time.perf_counter() - T0
+            metrics.items += 1
+            if result is not None:
+                metrics.rows += result[0]
+                self.conflicts += result[1]
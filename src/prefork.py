@@ -0,0 +1,228 @@
+import gc, json, multiprocessing, os, random, signal, socket, sys, threading, time, traceback
+
+class ChangeSignal():
+    '''Constraint change counter shared by preforked worker processes
+
+    Created before forking, in shared memory. A worker whose engine cache
+    finds constraint changes on its own bumps the generation, so the other
+    workers refresh on their next request instead of waiting for their
+    refresh interval.
+    '''
+
+    def __init__(self):
+        self._generation = multiprocessing.Value('Q', 0)
+
+    @property
+    def generation(self):
+        return self._generation.value
+
+    def bump(self, seen):
+        '''Advance the generation if still seen, so that workers catching up
+        on the same change don't signal it again
+
+        Returns: int, the current generation
+        '''
+        with self._generation.get_lock():
+            if self._generation.value == seen:
+                self._generation.value += 1
+            return self._generation.value
+
+class WorkerStats():
+    '''Stats of preforked worker processes, shared through snapshot files
+
+    Created before forking, on a directory shared by the workers. Each
+    worker writes the values of the registered stats functions to
+    <pid>.json in the directory every interval seconds once started, and
+    before reading those of the others, so a reader sees its own current
+    stats and the others' at most interval seconds old. Snapshots of
+    workers that exited are removed when read.
+
+    Attributes:
+        directory: str
+        interval: float, seconds between snapshots
+    '''
+
+    def __init__(self, directory, interval=5):
+        self.directory = directory
+        self.interval = interval
+        self._stats = {} # name: function() -> JSON-serializable value
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, name, stats):
+        '''Share the value of stats() as name'''
+        self._stats[name] = stats
+
+    def start(self):
+        '''Start writing snapshots of this process, e.g. after fork'''
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="worker-stats", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self):
+        '''Write the stats of this process'''
+        path = os.path.join(self.directory, str(os.getpid()) + ".json")
+        with open(path + ".tmp", "w") as file:
+            json.dump({name: stats() for name, stats in self._stats.items()}, file, default=str)
+        # Readers never see a partly written snapshot
+        os.replace(path + ".tmp", path)
+
+    def read(self, name):
+        '''Return the stats registered as name of every live worker
+
+        Returns: dict, pid: value
+        '''
+        self.write()
+        values = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            pid = int(filename[:-len(".json")])
+            path = os.path.join(self.directory, filename)
+            if not self._alive(pid):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as file:
+                    snapshot = json.load(file)
+            except FileNotFoundError:
+                continue
+            if name in snapshot:
+                values[pid] = snapshot[name]
+        return values
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                print("Writing worker stats failed: " + str(e))
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+def run_workers(workers, worker_main, preload=None):
+    '''Fork worker processes after preloading shared state, and supervise them
+
+    preload runs once in this process with garbage collection disabled.
+    Everything it builds is then frozen out of garbage collection
+    (gc.freeze), so that collections in the workers never write to those
+    objects and their memory pages stay shared copy-on-write. Workers that
+    exit with an error are replaced; SIGTERM or SIGINT stops all workers.
+
+    Args:
+        workers: int, number of worker processes
+        worker_main: function(), runs in each worker, which exits when it returns
+        preload: function() | None
+
+    Returns: dict, pid: exit status of workers that exited on their own
+    '''
+    gc.disable()
+    if preload is not None:
+        preload()
+    gc.freeze()
+
+    children, exited = {}, {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            gc.enable()
+            status = 0
+            try:
+                worker_main()
+            except BaseException:
+                status = 1
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        children[pid] = True
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    previous = signal.signal(signal.SIGTERM, stop), signal.signal(signal.SIGINT, stop)
+    try:
+        for _ in range(workers):
+            spawn()
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            children.pop(pid, None)
+            if os.waitstatus_to_exitcode(status) != 0 and not stopping:
+                # Don't spin if workers fail on start
+                time.sleep(1)
+                spawn()
+            else:
+                exited[pid] = os.waitstatus_to_exitcode(status)
+    finally:
+        signal.signal(signal.SIGTERM, previous[0])
+        signal.signal(signal.SIGINT, previous[1])
+        gc.unfreeze()
+        gc.enable()
+    return exited
+
+def serve_preforked(app, host="127.0.0.1", port=5000, workers=4, preload=None, after_fork=None):
+    '''Serve a WSGI app from preforked worker processes sharing one socket
+
+    Each worker runs a threaded werkzeug server on the listening socket
+    opened before forking, so the kernel spreads connections between them.
+
+    Args:
+        app: WSGI application
+        host: str
+        port: int
+        workers: int
+        preload: function() | None, builds state shared by all workers
+        after_fork: function() | None, runs first in each worker, e.g. to
+            restart threads, which don't survive fork
+    '''
+    from werkzeug.serving import make_server
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    listener.set_inheritable(True)
+
+    def worker_main():
+        if after_fork is not None:
+            after_fork()
+        server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+        server.serve_forever()
+
+    print("Serving on http://%s:%d with %d workers" % (host, port, workers))
+    try:
+        return run_workers(workers, worker_main, preload)
+    finally:
+        listener.close()
@@ -0,0 +1,237 @@
+import json, sys, threading, time
+from collections import Counter
+from src.detection import Activity
+
+# Levels of the constraint tree, from the root
+LEVELS = ["document", "action", "actor", "condition"]
+
+class StackSampler():
+    '''Sample the stacks of threads running detection at a fixed interval
+
+    Attributes:
+        interval: float, seconds between samples
+        stacks: Counter, collapsed stack ("file:function;...", root first):
+            samples, updated under the lock; read it through snapshot()
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._threads = Counter() # ident: nesting depth of active detection
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="detection-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def enter(self):
+        '''Mark the current thread as running detection'''
+        with self._lock:
+            self._threads[threading.get_ident()] += 1
+
+    def exit(self):
+        with self._lock:
+            ident = threading.get_ident()
+            self._threads[ident] -= 1
+            if self._threads[ident] <= 0:
+                del self._threads[ident]
+
+    def snapshot(self):
+        '''Return a copy of stacks'''
+        with self._lock:
+            return Counter(self.stacks)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                idents = list(self._threads)
+            frames = sys._current_frames()
+            collapsed = [self._collapse(frames[ident]) for ident in idents if ident in frames]
+            with self._lock:
+                self.stacks.update(collapsed)
+
+    @staticmethod
+    def _collapse(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(code.co_filename.rsplit("/", 1)[-1] + ":" + code.co_name)
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+class EngineProfiler():
+    '''Opt-in hot spot profiling of ConflictDetectionEngine checks
+
+    Attached to an engine with engine.profiler = EngineProfiler(), checks go
+    through an instrumented walk of the constraint tree that gives the same
+    results, counting at each level how often a child node is looked up
+    (probes) and found (hits), and which constraints flag conflicts. Parsing
+    logs into Activity and matching them against the tree are timed per
+    batch. Engines without a profiler only test that it is None once per
+    batch, so profiling costs nothing while disabled.
+
+    Counters are accumulated per batch and merged under a lock, so one
+    profiler can serve engines used by several threads. The counters of
+    profilers in several processes are combined with merge.
+
+    Attributes:
+        activities: int, activities checked
+        conflicts: int, activities flagged
+        parse_seconds: float, time spent parsing logs into Activity
+        match_seconds: float, time spent walking the constraint tree
+        probes: Counter, level: child lookups at that level
+        hits: Counter, level: lookups that found a child, or, at the
+            condition level, matching conditions
+        constraints: Counter, (doc_id, action type, actor): conflicts flagged
+        sampler: StackSampler | None, samples stacks while checks run
+    '''
+
+    def __init__(self, sample_interval=None, start=True):
+        '''Args:
+            sample_interval: float | None, seconds between stack samples,
+                None not to sample
+            start: bool, start sampling now; False to call start later,
+                e.g. in a forked process, as threads don't survive fork
+        '''
+        self.activities = 0
+        self.conflicts = 0
+        self.parse_seconds = 0.0
+        self.match_seconds = 0.0
+        self.probes = Counter()
+        self.hits = Counter()
+        self.constraints = Counter()
+        self.started = time.time()
+        self.sampler = None
+        self._lock = threading.Lock()
+        if sample_interval:
+            self.sampler = StackSampler(sample_interval)
+            if start:
+                self.sampler.start()
+
+    def start(self):
+        '''Start stack sampling, if sampled'''
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def close(self):
+        '''Stop stack sampling'''
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def check_conflicts(self, engine, logs):
+        '''Flag which logs are conflicts, as engine.check_conflicts, recording hot spots'''
+        if self.sampler is not None:
+            self.sampler.enter()
+        try:
+            T0 = time.perf_counter()
+            activities = [Activity(log) for log in logs]
+            T1 = time.perf_counter()
+            probes, hits, constraints = Counter(), Counter(), Counter()
+            results = [self._check(engine.constraint_tree, activity, probes, hits, constraints) for activity in activities]
+            T2 = time.perf_counter()
+        finally:
+            if self.sampler is not None:
+                self.sampler.exit()
+
+        with self._lock:
+            self.activities += len(activities)
+            self.conflicts += sum(results)
+            self.parse_seconds += T1 - T0
+            self.match_seconds += T2 - T1
+            self.probes.update(probes)
+            self.hits.update(hits)
+            self.constraints.update(constraints)
+        return results
+
+    @staticmethod
+    def _check(tree, activity, probes, hits, constraints):
+        '''Walk the tree like DocumentNode.check, counting lookups'''
+        node = tree
+        for level, key in zip(LEVELS, (activity.doc_id, activity.actiontype, activity.actor)):
+            probes[level] += 1
+            node = node.constraints.get(key)
+            if node is None:
+                return False
+            hits[level] += 1
+        probes["condition"] += 1
+        if node.check(activity):
+            hits["condition"] += 1
+            constraints[(activity.doc_id, activity.actiontype, activity.actor)] += 1
+            return True
+        return False
+
+    def state(self):
+        '''Return the profile counters as a JSON-serializable dict, see merge'''
+        with self._lock:
+            state = {
+                'since': self.started,
+                'activities': self.activities,
+                'conflicts': self.conflicts,
+                'parse_seconds': self.parse_seconds,
+                'match_seconds': self.match_seconds,
+                'probes': dict(self.probes),
+                'hits': dict(self.hits),
+                'constraints': [list(key) + [count] for key, count in self.constraints.items()],
+            }
+        state['stacks'] = dict(self.sampler.snapshot()) if self.sampler is not None else None
+        return state
+
+    def report(self, top=20):
+        '''Return profile counters as a JSON-serializable dict
+
+        Args:
+            top: int, number of constraints and stacks listed
+        '''
+        return self.merge([self.state()], top)
+
+    @staticmethod
+    def merge(states, top=20):
+        '''Return the report of the profilers with states, e.g. of several processes
+
+        Args:
+            states: list of dicts from state
+            top: int, number of constraints and stacks listed
+        '''
+        probes, hits, constraints, stacks = Counter(), Counter(), Counter(), None
+        for state in states:
+            probes.update(state['probes'])
+            hits.update(state['hits'])
+            constraints.update({tuple(row[:3]): row[3] for row in state['constraints']})
+            if state['stacks'] is not None:
+                stacks = (stacks or Counter()) + Counter(state['stacks'])
+        report = {
+            'since': min(state['since'] for state in states),
+            'activities': sum(state['activities'] for state in states),
+            'conflicts': sum(state['conflicts'] for state in states),
+            'parse_seconds': round(sum(state['parse_seconds'] for state in states), 6),
+            'match_seconds': round(sum(state['match_seconds'] for state in states), 6),
+            'levels': [{'level': level,
+                        'probes': probes[level],
+                        'hits': hits[level],
+                        'hit_rate': round(hits[level] / probes[level], 4) if probes[level] else None}
+                       for level in LEVELS],
+            'hot_constraints': [{'doc_id': doc_id, 'action_type': action_type, 'actor': actor, 'conflicts': count}
+                                for (doc_id, action_type, actor), count in constraints.most_common(top)],
+        }
+        if stacks is not None:
+            report['stack_samples'] = sum(stacks.values())
+            report['hot_stacks'] = [{'stack': stack, 'samples': count} for stack, count in stacks.most_common(top)]
+        return report
+
+    def export(self, filename, top=20):
+        '''Write report to a JSON file, and sampled stacks, if any, next to it
+        in the collapsed format of flame graph tools (filename + ".stacks")'''
+        with open(filename, "w") as file:
+            json.dump(self.report(top), file, indent=2)
+        if self.sampler is not None:
+            with open(filename + ".stacks", "w") as file:
+                for stack, count in self.sampler.snapshot().items():
+                    file.write(stack + " " + str(count) + "\n")
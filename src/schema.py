@@ -0,0 +1,365 @@
+'''Versioned schema of the ACCORD database.
+
+Each migration brings the schema from the previous version to its own and is
+applied once, in order; applied versions are recorded in schema_version. A
+migration step is either an SQL statement or a function taking a
+DatabaseQuery, for data changes that need Python. SQLite databases follow
+SQLITE_MIGRATIONS, which has the same versions in SQLite's dialect.
+Run this module to migrate the database configured in db.yaml:
+
+    python3 -m src.schema
+'''
+import datetime
+
+# MySQL error codes for objects that already exist. Databases set up from a
+# dump or by hand before migrations existed may already have some of them.
+ALREADY_EXISTS_ERRORS = {
+    1050, # table exists
+    1060, # duplicate column name
+    1061, # duplicate key name
+    1359, # trigger exists
+}
+
+def split_constraint_attributes(db):
+    '''Copy multi-valued action_constraints columns into their child tables'''
+    from src.sqlconnector import parse_constraint_list
+    db.cursor.execute("SELECT id, doc_name, doc_id, constraint_target, allowed_value FROM action_constraints")
+    for constraint_id, doc_names, doc_ids, actors, values in db.cursor.fetchall():
+        db.add_constraint_attributes(constraint_id, parse_constraint_list(doc_ids), parse_constraint_list(doc_names),
+                                     parse_constraint_list(actors), parse_constraint_list(values))
+
+def partition_activity_log(db):
+    '''Partition activity_log by month of activity_time, through next month
+
+    The first partition is the month of the oldest log, or next month if
+    there are none yet. Like any lowest RANGE partition, it also takes logs
+    older than its month.
+    '''
+    from src.sqlconnector import next_month
+    db.cursor.execute("SELECT MIN(activity_time) FROM activity_log")
+    first = db.cursor.fetchone()[0]
+    until = next_month(datetime.datetime.utcnow().strftime("%Y-%m"))
+    month = first[:7] if first else until
+    partitions = []
+    while month <= until:
+        partitions.append("PARTITION p" + month.replace("-", "") + " VALUES LESS THAN ('" + next_month(month) + "')")
+        month = next_month(month)
+    partitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    # The partitioning column must be part of the primary key
+    db.cursor.execute("ALTER TABLE activity_log DROP PRIMARY KEY, ADD PRIMARY KEY (id, activity_time)")
+    db.cursor.execute("ALTER TABLE activity_log PARTITION BY RANGE COLUMNS (activity_time) (" + ", ".join(partitions) + ")")
+
+MIGRATIONS = [
+    (1, "Base tables", [
+        """CREATE TABLE IF NOT EXISTS activity_log (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            activity_time VARCHAR(32) NOT NULL,
+            action VARCHAR(255) NOT NULL,
+            doc_id VARCHAR(128) NOT NULL,
+            doc_name VARCHAR(255),
+            actor_id VARCHAR(64),
+            actor_name VARCHAR(255) NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS lastlogdate (
+            id INT PRIMARY KEY,
+            date VARCHAR(32) NOT NULL
+        )""",
+        "INSERT IGNORE INTO lastlogdate (id, date) VALUES (1, '1970-01-01T00:00:00.000000Z')",
+        """CREATE TABLE IF NOT EXISTS action_constraints (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            doc_name TEXT,
+            doc_id TEXT,
+            action VARCHAR(64),
+            action_type VARCHAR(64),
+            constraint_target VARCHAR(255),
+            action_value VARCHAR(255),
+            comparator VARCHAR(16),
+            constraint_owner VARCHAR(255),
+            allowed_value TEXT,
+            time_stamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS conflicts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            conflictTime VARCHAR(32) NOT NULL,
+            conflictType VARCHAR(255) NOT NULL,
+            resolution VARCHAR(16)
+        )""",
+    ]),
+    (2, "Ingestion checkpoint and detection watermark", [
+        """CREATE TABLE IF NOT EXISTS log_checkpoint (
+            id INT PRIMARY KEY,
+            start_time VARCHAR(32) NOT NULL,
+            page_token VARCHAR(255),
+            watermark VARCHAR(32)
+        )""",
+        """CREATE TABLE IF NOT EXISTS detection_watermark (
+            id INT PRIMARY KEY,
+            last_log_id BIGINT NOT NULL
+        )""",
+    ]),
+    (3, "Indexes for log range scans, constraint fetches and conflict upserts", [
+        "CREATE INDEX activity_log_time ON activity_log (activity_time, id)",
+        "CREATE INDEX activity_log_doc_action_actor ON activity_log (doc_id, action, actor_name)",
+        "CREATE INDEX action_constraints_time ON action_constraints (time_stamp)",
+        "CREATE INDEX action_constraints_owner ON action_constraints (constraint_owner)",
+        # Keep the first of any duplicate conflicts before enforcing uniqueness
+        """DELETE c1 FROM conflicts c1 JOIN conflicts c2
+            ON c1.conflictTime = c2.conflictTime AND c1.conflictType = c2.conflictType AND c1.id > c2.id""",
+        "ALTER TABLE conflicts ADD UNIQUE KEY conflicts_time_type (conflictTime, conflictType)",
+    ]),
+    (4, "Normalized constraint documents, actors and values", [
+        """CREATE TABLE IF NOT EXISTS constraint_docs (
+            constraint_id INT NOT NULL,
+            doc_id VARCHAR(128) NOT NULL,
+            doc_name VARCHAR(255),
+            PRIMARY KEY (constraint_id, doc_id),
+            INDEX constraint_docs_doc (doc_id, constraint_id, doc_name),
+            FOREIGN KEY (constraint_id) REFERENCES action_constraints (id) ON DELETE CASCADE
+        )""",
+        """CREATE TABLE IF NOT EXISTS constraint_actors (
+            constraint_id INT NOT NULL,
+            actor VARCHAR(255) NOT NULL,
+            PRIMARY KEY (constraint_id, actor),
+            INDEX constraint_actors_actor (actor, constraint_id),
+            FOREIGN KEY (constraint_id) REFERENCES action_constraints (id) ON DELETE CASCADE
+        )""",
+        """CREATE TABLE IF NOT EXISTS constraint_values (
+            constraint_id INT NOT NULL,
+            position INT NOT NULL,
+            value VARCHAR(255) NOT NULL,
+            PRIMARY KEY (constraint_id, position),
+            FOREIGN KEY (constraint_id) REFERENCES action_constraints (id) ON DELETE CASCADE
+        )""",
+        split_constraint_attributes,
+    ]),
+    (5, "Monthly partitions of activity_log", [
+        partition_activity_log,
+    ]),
+    (6, "Constraint change times and deletion log", [
+        """ALTER TABLE action_constraints
+            ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)""",
+        "CREATE INDEX action_constraints_updated ON action_constraints (updated_at)",
+        """CREATE TABLE IF NOT EXISTS deleted_constraints (
+            constraint_id INT PRIMARY KEY,
+            deleted_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+            INDEX deleted_constraints_time (deleted_at)
+        )""",
+        """CREATE TRIGGER action_constraints_deleted AFTER DELETE ON action_constraints
+            FOR EACH ROW REPLACE INTO deleted_constraints (constraint_id) VALUES (OLD.id)""",
+    ]),
+    (7, "Detection job results", [
+        """CREATE TABLE IF NOT EXISTS detection_job_conflicts (
+            job_id VARCHAR(32) NOT NULL,
+            log_id INT NOT NULL,
+            PRIMARY KEY (job_id, log_id)
+        )""",
+    ]),
+    (8, "Detection jobs and scheduler leases shared by processes", [
+        """CREATE TABLE IF NOT EXISTS detection_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            since_time VARCHAR(32) NOT NULL,
+            until_time VARCHAR(32),
+            status VARCHAR(16) NOT NULL,
+            total_rows INT,
+            rows_scanned INT NOT NULL DEFAULT 0,
+            conflicts INT NOT NULL DEFAULT 0,
+            error TEXT,
+            submitted VARCHAR(32) NOT NULL,
+            started VARCHAR(32),
+            finished VARCHAR(32),
+            cancel_requested BOOLEAN NOT NULL DEFAULT FALSE
+        )""",
+        """CREATE TABLE IF NOT EXISTS scheduler_leases (
+            name VARCHAR(64) PRIMARY KEY,
+            owner VARCHAR(255),
+            last_run DOUBLE
+        )""",
+        "INSERT IGNORE INTO scheduler_leases (name) VALUES ('accord_log_ingestion')",
+    ]),
+    (9, "Detection job heartbeats", [
+        "ALTER TABLE detection_jobs ADD COLUMN heartbeat DOUBLE",
+    ]),
+]
+
+SQLITE_MIGRATIONS = [
+    (1, "Base tables", [
+        """CREATE TABLE IF NOT EXISTS activity_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            activity_time VARCHAR(32) NOT NULL,
+            action VARCHAR(255) NOT NULL,
+            doc_id VARCHAR(128) NOT NULL,
+            doc_name VARCHAR(255),
+            actor_id VARCHAR(64),
+            actor_name VARCHAR(255) NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS lastlogdate (
+            id INTEGER PRIMARY KEY,
+            date VARCHAR(32) NOT NULL
+        )""",
+        "INSERT OR IGNORE INTO lastlogdate (id, date) VALUES (1, '1970-01-01T00:00:00.000000Z')",
+        """CREATE TABLE IF NOT EXISTS action_constraints (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            doc_name TEXT,
+            doc_id TEXT,
+            action VARCHAR(64),
+            action_type VARCHAR(64),
+            constraint_target VARCHAR(255),
+            action_value VARCHAR(255),
+            comparator VARCHAR(16),
+            constraint_owner VARCHAR(255),
+            allowed_value TEXT,
+            time_stamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """CREATE TABLE IF NOT EXISTS conflicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conflictTime VARCHAR(32) NOT NULL,
+            conflictType VARCHAR(255) NOT NULL,
+            resolution VARCHAR(16)
+        )""",
+    ]),
+    (2, "Ingestion checkpoint and detection watermark", [
+        """CREATE TABLE IF NOT EXISTS log_checkpoint (
+            id INTEGER PRIMARY KEY,
+            start_time VARCHAR(32) NOT NULL,
+            page_token VARCHAR(255),
+            watermark VARCHAR(32)
+        )""",
+        """CREATE TABLE IF NOT EXISTS detection_watermark (
+            id INTEGER PRIMARY KEY,
+            last_log_id BIGINT NOT NULL
+        )""",
+    ]),
+    (3, "Indexes for log range scans, constraint fetches and conflict upserts", [
+        "CREATE INDEX IF NOT EXISTS activity_log_time ON activity_log (activity_time, id)",
+        "CREATE INDEX IF NOT EXISTS activity_log_doc_action_actor ON activity_log (doc_id, action, actor_name)",
+        "CREATE INDEX IF NOT EXISTS action_constraints_time ON action_constraints (time_stamp)",
+        "CREATE INDEX IF NOT EXISTS action_constraints_owner ON action_constraints (constraint_owner)",
+        """DELETE FROM conflicts WHERE id NOT IN
+            (SELECT MIN(id) FROM conflicts GROUP BY conflictTime, conflictType)""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS conflicts_time_type ON conflicts (conflictTime, conflictType)",
+    ]),
+    (4, "Normalized constraint documents, actors and values", [
+        """CREATE TABLE IF NOT EXISTS constraint_docs (
+            constraint_id INTEGER NOT NULL REFERENCES action_constraints (id) ON DELETE CASCADE,
+            doc_id VARCHAR(128) NOT NULL,
+            doc_name VARCHAR(255),
+            PRIMARY KEY (constraint_id, doc_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS constraint_docs_doc ON constraint_docs (doc_id, constraint_id, doc_name)",
+        """CREATE TABLE IF NOT EXISTS constraint_actors (
+            constraint_id INTEGER NOT NULL REFERENCES action_constraints (id) ON DELETE CASCADE,
+            actor VARCHAR(255) NOT NULL,
+            PRIMARY KEY (constraint_id, actor)
+        )""",
+        "CREATE INDEX IF NOT EXISTS constraint_actors_actor ON constraint_actors (actor, constraint_id)",
+        """CREATE TABLE IF NOT EXISTS constraint_values (
+            constraint_id INTEGER NOT NULL REFERENCES action_constraints (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            value VARCHAR(255) NOT NULL,
+            PRIMARY KEY (constraint_id, position)
+        )""",
+        split_constraint_attributes,
+    ]),
+    # SQLite has no partitioning; months of logs are ranges of activity_log_time
+    (5, "Monthly partitions of activity_log", []),
+    # Columns can't be added with a non-constant default, so triggers set it
+    (6, "Constraint change times and deletion log", [
+        "ALTER TABLE action_constraints ADD COLUMN updated_at TIMESTAMP",
+        "UPDATE action_constraints SET updated_at = time_stamp",
+        "CREATE INDEX IF NOT EXISTS action_constraints_updated ON action_constraints (updated_at)",
+        """CREATE TRIGGER IF NOT EXISTS action_constraints_inserted AFTER INSERT ON action_constraints
+            BEGIN UPDATE action_constraints SET updated_at = STRFTIME('%Y-%m-%d %H:%M:%f', 'now') WHERE id = NEW.id; END""",
+        """CREATE TRIGGER IF NOT EXISTS action_constraints_updated AFTER UPDATE OF
+            doc_name, doc_id, action, action_type, constraint_target, action_value, comparator, constraint_owner, allowed_value
+            ON action_constraints
+            BEGIN UPDATE action_constraints SET updated_at = STRFTIME('%Y-%m-%d %H:%M:%f', 'now') WHERE id = NEW.id; END""",
+        """CREATE TABLE IF NOT EXISTS deleted_constraints (
+            constraint_id INTEGER PRIMARY KEY,
+            deleted_at TIMESTAMP NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS deleted_constraints_time ON deleted_constraints (deleted_at)",
+        """CREATE TRIGGER IF NOT EXISTS action_constraints_deleted AFTER DELETE ON action_constraints
+            BEGIN REPLACE INTO deleted_constraints (constraint_id, deleted_at) VALUES (OLD.id, STRFTIME('%Y-%m-%d %H:%M:%f', 'now')); END""",
+    ]),
+    (7, "Detection job results", [
+        """CREATE TABLE IF NOT EXISTS detection_job_conflicts (
+            job_id VARCHAR(32) NOT NULL,
+            log_id INTEGER NOT NULL,
+            PRIMARY KEY (job_id, log_id)
+        )""",
+    ]),
+    (8, "Detection jobs and scheduler leases shared by processes", [
+        """CREATE TABLE IF NOT EXISTS detection_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            since_time VARCHAR(32) NOT NULL,
+            until_time VARCHAR(32),
+            status VARCHAR(16) NOT NULL,
+            total_rows INT,
+            rows_scanned INT NOT NULL DEFAULT 0,
+            conflicts INT NOT NULL DEFAULT 0,
+            error TEXT,
+            submitted VARCHAR(32) NOT NULL,
+            started VARCHAR(32),
+            finished VARCHAR(32),
+            cancel_requested INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS scheduler_leases (
+            name VARCHAR(64) PRIMARY KEY,
+            owner VARCHAR(255),
+            last_run REAL
+        )""",
+        "INSERT OR IGNORE INTO scheduler_leases (name) VALUES ('accord_log_ingestion')",
+    ]),
+    (9, "Detection job heartbeats", [
+        "ALTER TABLE detection_jobs ADD COLUMN heartbeat REAL",
+    ]),
+]
+
+def current_version(db):
+    '''Return the latest schema version applied to the database, 0 if none'''
+    db.cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+        version INT PRIMARY KEY,
+        description VARCHAR(255),
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )""")
+    db.cursor.execute("SELECT MAX(version) FROM schema_version")
+    result = db.cursor.fetchone()
+    return result[0] if result and result[0] else 0
+
+def migrate(db, target=None):
+    '''Apply migrations newer than the database's schema version
+
+    Args:
+        db: DatabaseQuery
+        target: int | None, version to stop at, latest if None
+
+    Returns: int, schema version after migrating
+    '''
+    version = current_version(db)
+    migrations = SQLITE_MIGRATIONS if db.DIALECT == "sqlite" else MIGRATIONS
+    for migration_version, description, statements in migrations:
+        if migration_version <= version or (target is not None and migration_version > target):
+            continue
+        for statement in statements:
+            try:
+                if callable(statement):
+                    statement(db)
+                else:
+                    db.cursor.execute(statement)
+            except Exception as e:
+                if not e.args or e.args[0] not in ALREADY_EXISTS_ERRORS:
+                    raise
+        db.cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s,%s)", (migration_version, description))
+        db.commit()
+        version = migration_version
+    return version
+
+if __name__ == '__main__':
+    import yaml
+    from src.dbpool import create_pool
+    with open('db.yaml') as config_file:
+        db_config = yaml.load(config_file, Loader=yaml.SafeLoader)
+    db_pool = create_pool(dict(db_config, db_pool_size=1))
+    with db_pool.connection() as db:
+        print("Schema version", migrate(db))
+    db_pool.close()
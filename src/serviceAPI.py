@@ -3,7 +3,27 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from google.auth.exceptions import MutualTLSChannelError, UserAccessTokenError
-import os.path
+import os.path, threading
+import requests
+
+# If modifying these scopes, delete the file token.json.
+REPORTS_SCOPES = ['https://www.googleapis.com/auth/admin.reports.audit.readonly']
+
+_shared_request = None
+_shared_request_lock = threading.Lock()
+
+def shared_request():
+    '''Return the HTTP transport shared by token refreshes outside API calls,
+    keeping connections to the token endpoint open between refreshes
+
+    API calls, and the refreshes they trigger themselves, go through the
+    httplib2 connection of their service, which is not shared.
+    '''
+    global _shared_request
+    with _shared_request_lock:
+        if _shared_request is None:
+            _shared_request = Request(session=requests.Session())
+        return _shared_request
 
 def get_creds(SCOPES, filename):
     '''Initialize Credentials from file
@@ -26,7 +46,7 @@ def get_creds(SCOPES, filename):
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            creds.refresh(shared_request())
         else:
             flow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', SCOPES)
@@ -37,14 +57,31 @@ def get_creds(SCOPES, filename):
 
     return creds
 
-def create_reportsAPI_service(token_file):
-    '''Create Admin Reports API v1 service with admin's credentials'''
-    # If modifying these scopes, delete the file token.json.
-    SCOPES = ['https://www.googleapis.com/auth/admin.reports.audit.readonly']
+def build_reportsAPI_service(token_file):
+    '''Build Admin Reports API v1 service with admin's credentials
+
+    Returns: (service, google.oauth2.credentials.Credentials)
+    '''
+    creds = get_creds(REPORTS_SCOPES, token_file)
+    # Discovery documents bundled with the client library, not fetched
+    return build('admin', 'reports_v1', credentials=creds, cache_discovery=False, static_discovery=True), creds
+
+def create_reportsAPI_service(token_file, cache=None):
+    '''Create Admin Reports API v1 service with admin's credentials
+
+    Args:
+        token_file: str, JSON tokens file path
+        cache: ServiceCache | None, return the service built before for
+            token_file if any, keeping its token refreshed
+
+    Returns: service, None if it can't be created
+    '''
     service = None
     try:
-        creds = get_creds(SCOPES, token_file)
-        service = build('admin', 'reports_v1', credentials=creds)
+        if cache is None:
+            service, creds = build_reportsAPI_service(token_file)
+        else:
+            service = cache.get(token_file, build_reportsAPI_service)
     except MutualTLSChannelError:
         print("Unable to create Reports API service")
     except ValueError as ve:
@@ -0,0 +1,150 @@
+import os, threading, time
+from datetime import datetime, timedelta
+from src.metrics import CACHE_HITS
+
+class ServiceCache():
+    '''Keep built Google API services per credential, with their tokens
+    refreshed ahead of expiry.
+
+    A service is built once per token file and builder, and rebuilt only if
+    the token file is changed by something else. Builds run outside the cache
+    lock, so a slow build, such as an interactive sign in, only holds up
+    requests for the same service. A background thread refreshes tokens
+    refresh_margin seconds before they expire, through the request transport
+    shared by all refreshes, and saves them to their token file, so requests
+    never wait on a token refresh. API calls go through the HTTP connection of
+    their service. Services not requested for idle_timeout
+    seconds are dropped, as are the services of users not seen for as long.
+
+    Attributes:
+        request: google.auth.transport.Request, transport used for background refreshes
+        refresh_margin: float, seconds before expiry a token is refreshed
+        idle_timeout: float, seconds after which unused services and users are dropped
+        interval: float, seconds between background checks
+        stats: dict, cache hits, builds, token refreshes and refresh errors,
+            evicted services and users
+    '''
+
+    def __init__(self, request, refresh_margin=300, idle_timeout=3600, interval=60):
+        self.request = request
+        self.refresh_margin = refresh_margin
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.stats = {'hits': 0, 'builds': 0, 'refreshes': 0, 'refresh_errors': 0, 'evicted_services': 0, 'evicted_users': 0}
+        self._entries = {} # (token file path, builder): entry dict
+        self._users = {} # username: {'services': {name: service}, 'last_used': float}
+        self._building = {} # (token file path, builder): lock held while building
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, token_file, builder):
+        '''Return the service built by builder with the credentials in token_file
+
+        Args:
+            token_file: str, JSON tokens file path
+            builder: function(token_file) -> (service, credentials)
+
+        Raises: what builder raises
+        '''
+        key = (os.path.abspath(token_file), builder)
+        with self._lock:
+            service = self._hit(key)
+            if service is not None:
+                return service
+            building = self._building.setdefault(key, threading.Lock())
+
+        # Concurrent requests for the same service wait for one build
+        with building:
+            with self._lock:
+                service = self._hit(key)
+            if service is None:
+                service, creds = builder(token_file)
+                with self._lock:
+                    self._entries[key] = {'service': service, 'creds': creds, 'mtime': self._mtime(key[0]), 'last_used': time.monotonic()}
+                    self.stats['builds'] += 1
+        self.start()
+        return service
+
+    def _hit(self, key):
+        '''Return the cached service of key if still current, else None; call with _lock held'''
+        entry = self._entries.get(key)
+        if entry is None or entry['mtime'] != self._mtime(key[0]):
+            return None
+        entry['last_used'] = time.monotonic()
+        self.stats['hits'] += 1
+        CACHE_HITS.inc(cache="service")
+        return entry['service']
+
+    def set_user_service(self, username, name, service):
+        '''Record service as the name service of a signed in user'''
+        with self._lock:
+            user = self._users.setdefault(username, {'services': {}, 'last_used': None})
+            user['services'][name] = service
+            user['last_used'] = time.monotonic()
+
+    def remove_user(self, username):
+        '''Forget the services of a user, e.g. on sign out'''
+        with self._lock:
+            self._users.pop(username, None)
+
+    def start(self):
+        '''Start the background refresh thread if not running'''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="service-cache", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        '''Stop the background refresh thread'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def maintain(self, now=None):
+        '''Refresh tokens close to expiry and drop idle services and users
+
+        Args:
+            now: float | None, time.monotonic() time, for tests
+        '''
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if now - entry['last_used'] > self.idle_timeout]:
+                del self._entries[key]
+                self._building.pop(key, None)
+                self.stats['evicted_services'] += 1
+            for username in [username for username, user in self._users.items() if now - user['last_used'] > self.idle_timeout]:
+                del self._users[username]
+                self.stats['evicted_users'] += 1
+            entries = list(self._entries.items())
+
+        # Refresh outside the lock so that cached services stay available
+        deadline = datetime.utcnow() + timedelta(seconds=self.refresh_margin)
+        for (token_file, builder), entry in entries:
+            creds = entry['creds']
+            if creds.expiry is None or creds.expiry > deadline or not creds.refresh_token:
+                continue
+            try:
+                # The service holds the same credentials, so it uses the new token at once
+                creds.refresh(self.request)
+                with open(token_file, 'w') as token:
+                    token.write(creds.to_json())
+                entry['mtime'] = self._mtime(token_file)
+                self.stats['refreshes'] += 1
+            except Exception as e:
+                # The client library refreshes the token itself on the next request
+                self.stats['refresh_errors'] += 1
+                print("Token refresh failed for " + token_file + ": " + str(e))
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.maintain()
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
@@ -1,53 +1,351 @@
-import datetime
+import datetime, tempfile, json, os, csv, gzip
+from itertools import islice
+from src.metrics import timed, DB_FETCH_SECONDS, CONFLICT_PERSIST_SECONDS
+
+try:
+    from MySQLdb.cursors import SSCursor
+except ImportError:
+    SSCursor = None
+
+def start_of_next_day(date):
+    '''Return midnight after the day of an ISO date or datetime string
+
+    Used to compare timestamp columns directly instead of their DATE(), so
+    that the comparison can use an index.
+    '''
+    day = datetime.date.fromisoformat(date[:10]) + datetime.timedelta(days=1)
+    return day.isoformat() + " 00:00:00"
+
+def next_month(month):
+    '''Return the month after a "YYYY-MM" month string'''
+    year, month = int(month[:4]), int(month[5:7])
+    return "%04d-%02d" % (year + month // 12, month % 12 + 1)
+
+def parse_constraint_list(value):
+    '''Parse a multi-valued action_constraints column into a list of str
+
+    Accepts JSON arrays as written by add_action_constraint, comma separated
+    values, or lists.
+    '''
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    value = value.strip()
+    if value.startswith('['):
+        return [str(v) for v in json.loads(value)]
+    return [v.strip() for v in value.split(',') if v.strip()]
 
 class DatabaseQuery:
     '''Perform common operations on ACCORD database tables.
 
     All of these methods may raise a MySQLError
 
+    The stream_* methods read through an unbuffered server-side cursor and
+    yield lists of rows. Consume or close a stream before running another
+    query on the same connection.
+
+    Subclasses for other databases override the methods and the dialect
+    specific SQL below that MySQL runs differently.
+
     Attributes:
-        db: flask_mysqldb.MySQL.connection, database connection
+        db: MySQLdb connection
         cursor: MySQLdb.Cursor, cursor for database
+        prepared: dict | None, names of statements prepared on the connection
+            by query text, None to run every query unprepared. Preparing
+            requires a connection that allows multiple statements.
     '''
 
-    def __init__(self, mydb, mycursor):
+    DIALECT = "mysql"
+    # Appended to LIKE predicates whose pattern escapes wildcards with "\"
+    LIKE_ESCAPE = ""
+    # Document filters longer than this are joined as a temporary table
+    TEMP_TABLE_THRESHOLD = 500
+    # Stores a conflict unless it is already stored, keeping its resolution
+    INSERT_CONFLICT = "INSERT INTO conflicts (conflictTime,conflictType,resolution) VALUES (%s,%s,%s) ON DUPLICATE KEY UPDATE conflictTime = conflictTime"
+
+    def __init__(self, mydb, mycursor, prepared=None):
         self.db = mydb
         self.cursor = mycursor
+        self.prepared = prepared
+        self._doc_filter = None
+
+    def execute_prepared(self, query, params=None):
+        '''Execute query as a statement prepared once per connection
+
+        The parameters are bound to user variables and the statement executed
+        with them, as separate single statements; results are then read from
+        the cursor as usual. Statements stay
+        prepared for the life of the connection: only pass fixed query text,
+        not queries built from caller input.
+
+        Args:
+            query: str, query with %s placeholders
+            params: tuple | None
+        '''
+        if self.prepared is None:
+            self.cursor.execute(query, params)
+            return
+
+        name = self.prepared.get(query)
+        if name is None:
+            name = "accord_stmt_" + str(len(self.prepared))
+            self.cursor.execute("PREPARE " + name + " FROM %s", (query.replace("%s", "?"),))
+            self.prepared[query] = name
+
+        if params:
+            variables = ["@" + name + "_" + str(i) for i in range(len(params))]
+            assignments = ", ".join(variable + " = %s" for variable in variables)
+            self.cursor.execute("SET " + assignments, params)
+            self.cursor.execute("EXECUTE " + name + " USING " + ", ".join(variables))
+        else:
+            self.cursor.execute("EXECUTE " + name)
+
+    def commit(self):
+        '''Commit the current transaction'''
+        self.db.commit()
+
+    def acquire_lock(self, name, timeout=0):
+        '''Try to take a named lock held for the life of the connection
+
+        Args:
+            name: str
+            timeout: int, seconds to wait for the lock
+
+        Returns: bool, True if the lock was acquired
+        '''
+        self.cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+        result = self.cursor.fetchone()
+        return result is not None and result[0] == 1
+
+    def release_lock(self, name):
+        '''Release a named lock taken with acquire_lock'''
+        self.cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        self.cursor.fetchone()
+
+    def claim_lease(self, name, owner, now, interval):
+        '''Take the turn of a periodic task shared by processes, if due
 
-    def update_log_date(self, date):
+        The task is due if no process took its turn in the last interval
+        seconds. Committed, so that other processes see the turn taken.
+
+        Args:
+            name: str, row of scheduler_leases
+            owner: str, process taking the turn
+            now: float, time.time()
+            interval: float, seconds between turns, 0 to take one now
+
+        Returns: bool, True if this process takes the turn
+        '''
+        self.cursor.execute("UPDATE scheduler_leases SET owner = %s, last_run = %s WHERE name = %s AND (last_run IS NULL OR last_run <= %s)",
+                            (owner, now, name, now - interval))
+        self.db.commit()
+        return self.cursor.rowcount == 1
+
+    def update_log_date(self, date, commit=True):
         '''Update date on logs in lastlogdate table'''
         self.cursor.execute("UPDATE lastlogdate SET date = %s WHERE id>0", (date,))
-        self.db.commit()
+        if commit:
+            self.db.commit()
 
     def extract_lastLog_date(self):
         '''Return date of most recent log from database'''
         self.cursor.execute("SELECT date FROM lastlogdate WHERE id > 0")
         result = self.cursor.fetchone()
-        if(len(result) > 0):
+        if(result != None and len(result) > 0):
             return result[0]
         else:
             return None
 
-    def add_activity_logs(self, logs):
+    def extract_log_checkpoint(self):
+        '''Return progress of an interrupted log ingestion run
+
+        Returns: tuple (start_time, page_token, watermark) or None if the
+            previous run completed
+        '''
+        self.cursor.execute("SELECT start_time, page_token, watermark FROM log_checkpoint WHERE id = 1")
+        result = self.cursor.fetchone()
+        if result and result[1]:
+            return tuple(result)
+        else:
+            return None
+
+    def save_log_checkpoint(self, start_time, page_token, watermark):
+        '''Record log ingestion progress in log_checkpoint table.
+
+        Not committed, so that it can be committed with the logs of the page.
+
+        Args:
+            start_time: str, start time the ingestion run queries from
+            page_token: str, token of the next page to fetch
+            watermark: str | None, most recent activity time ingested in the run
+        '''
+        self.cursor.execute("REPLACE INTO log_checkpoint (id, start_time, page_token, watermark) VALUES (1,%s,%s,%s)", (start_time, page_token, watermark))
+
+    def clear_log_checkpoint(self):
+        '''Mark log ingestion run as complete. Not committed.'''
+        self.cursor.execute("DELETE FROM log_checkpoint WHERE id = 1")
+
+    def add_activity_logs(self, logs, commit=True, batch_size=1000):
         '''Parse logs and insert into activity_log table.
 
+        Rows are sent as multi-row INSERTs of batch_size rows each.
+
         Args:
             logs: str list, with activity fields separated by ","
+            commit: bool, commit after each batch, False to leave the
+                transaction open for the caller
+            batch_size: int, rows per INSERT statement
         '''
+        rows = []
         for log in reversed(logs):
             log = log.split(',')
             if len(log) < 6:
                 continue
+            rows.append(tuple(log[:6]))
+
+        query = "INSERT INTO activity_log (activity_time, action, doc_id, doc_name, actor_id, actor_name) VALUES (%s,%s,%s,%s,%s,%s)"
+        for i in range(0, len(rows), batch_size):
+            self.cursor.executemany(query, rows[i:i + batch_size])
+            if commit:
+                self.db.commit()
+
+    def load_activity_logs(self, filename, batch_size=100000):
+        '''Bulk load a CSV log file into activity_log table with LOAD DATA.
+
+        The file has the format written by extractDriveLog: a header row, then
+        one log per line. Rows are loaded in file order, batch_size lines per
+        statement, each batch committed. Requires local_infile to be enabled
+        on both the server and the connection.
+
+        Args:
+            filename: str, path to CSV log file
+            batch_size: int, lines per LOAD DATA statement
+
+        Returns: int, number of loaded logs
+        '''
+        query = """
+        LOAD DATA LOCAL INFILE %s INTO TABLE activity_log
+        FIELDS TERMINATED BY ',' LINES TERMINATED BY '\\n'
+        (activity_time, action, doc_id, doc_name, actor_id, actor_name)
+        """
+        total = 0
+        with open(filename) as log_file:
+            log_file.readline() # Skip header row
+            while True:
+                lines = list(islice(log_file, batch_size))
+                if not lines:
+                    break
+                with tempfile.NamedTemporaryFile("w", suffix=".csv") as batch_file:
+                    batch_file.writelines(line if line.endswith("\n") else line + "\n" for line in lines)
+                    batch_file.flush()
+                    self.cursor.execute(query, (batch_file.name,))
+                self.db.commit()
+                total += self.cursor.rowcount
+        return total
+
+    def log_partitions(self):
+        '''Return the months activity_log is partitioned into
+
+        activity_log is partitioned by RANGE COLUMNS on activity_time, one
+        partition "pYYYYMM" per month plus "pmax" for later logs, so queries
+        on a time range only read the partitions of its months. The first
+        partition also holds every log older than its month.
+
+        Returns: list of str, "YYYY-MM" months, oldest first
+        '''
+        query = """
+        SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'activity_log' AND PARTITION_NAME LIKE 'p______'
+        ORDER BY PARTITION_ORDINAL_POSITION
+        """
+        self.cursor.execute(query)
+        return [name[1:5] + "-" + name[5:7] for name, in self.cursor.fetchall()]
 
-            time = log[0]
-            action = log[1]
-            docID = log[2]
-            docName = log[3]
-            actorID = log[4]
-            actorName = log[5]
-            self.cursor.execute("INSERT INTO activity_log (activity_time, action, doc_id, doc_name, actor_id, actor_name) VALUES (%s,%s,%s,%s,%s,%s)", (time, action, docID, docName, actorID, actorName))
+    def ensure_log_partitions(self, until_month):
+        '''Add monthly activity_log partitions up to and including until_month
 
+        New partitions are split off pmax. Added ahead of the logs, while
+        pmax is empty, this copies no rows; logs already in pmax are copied
+        into the new partitions.
+
+        Args:
+            until_month: str, "YYYY-MM"
+
+        Returns: list of str, added months
+        '''
+        months = self.log_partitions()
+        if not months:
+            return []
+        added = []
+        month = next_month(months[-1])
+        while month <= until_month:
+            added.append(month)
+            month = next_month(month)
+        if added:
+            partitions = ["PARTITION p" + month.replace("-", "") + " VALUES LESS THAN ('" + next_month(month) + "')" for month in added]
+            partitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+            self.cursor.execute("ALTER TABLE activity_log REORGANIZE PARTITION pmax INTO (" + ", ".join(partitions) + ")")
+        return added
+
+    def _drop_log_month(self, month):
+        '''Remove all logs of month, without writing them anywhere'''
+        self.cursor.execute("ALTER TABLE activity_log DROP PARTITION p" + month.replace("-", ""))
+
+    def _stream_log_month(self, month, chunk_size):
+        '''Yield the logs _drop_log_month removes: the rows of the month's
+        partition, oldest first'''
+        query = """
+        SELECT id, activity_time, action, doc_id, doc_name, actor_id, actor_name FROM activity_log PARTITION (p{partition})
+        ORDER BY activity_time, id
+        """.format(partition=month.replace("-", ""))
+        return self._stream(query, None, chunk_size)
+
+    def archive_log_month(self, month, directory):
+        '''Move logs of month from activity_log to a compressed archive file
+
+        The file, activity_log-YYYY-MM.csv.gz in directory, is a CSV file with
+        a header row and one log per row, oldest first. It is complete and
+        synced to disk before the month's partition is dropped. The archive
+        of the first partition also holds any older logs, such as history
+        ingested or backfilled after the partitions were created. An
+        existing archive is never replaced: logs of a month archived before,
+        e.g. backfilled later, go to activity_log-YYYY-MM.N.csv.gz, with the
+        first N from 2 that is free.
+
+        Args:
+            month: str, "YYYY-MM"
+            directory: str
+
+        Returns: (str, int), path of the archive file and number of logs
+        '''
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "activity_log-" + month + ".csv.gz")
+        number = 1
+        while os.path.exists(path):
+            number += 1
+            path = os.path.join(directory, "activity_log-" + month + "." + str(number) + ".csv.gz")
+        count = 0
+        with open(path + ".tmp", "wb") as raw_file:
+            with gzip.open(raw_file, "wt", newline="") as archive_file:
+                writer = csv.writer(archive_file)
+                writer.writerow(["ID", "Activity_Time", "Action", "Doc_ID", "Doc_Name", "Actor_ID", "Actor_Name"])
+                for rows in self._stream_log_month(month, 10000):
+                    writer.writerows(rows)
+                    count += len(rows)
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(path + ".tmp", path)
+        self._drop_log_month(month)
         self.db.commit()
+        return path, count
+
+    def archive_logs_before(self, month, directory):
+        '''Archive every month of logs before month with archive_log_month
+
+        Returns: list of (str, int), archive file paths and numbers of logs
+        '''
+        return [self.archive_log_month(old_month, directory) for old_month in self.log_partitions() if old_month < month]
 
     def extract_logs_date(self,dateTime):
         '''Return all logs happening after provided dateTime
@@ -58,7 +356,7 @@ class DatabaseQuery:
         Returns: list, first row is column labels
         '''
         query = "SELECT activity_time, action, doc_id, doc_name, actor_id, actor_name FROM activity_log WHERE activity_time > %s"
-        self.cursor.execute(query, (dateTime,))
+        self.execute_prepared(query, (dateTime,))
 
         myresult = self.cursor.fetchall()
         logs = [["Activity Time","Action","Document ID","Document Name","Actor ID","Actor Name"]]
@@ -69,6 +367,249 @@ class DatabaseQuery:
         else:
             return None
 
+    def _stream(self, query, params, chunk_size):
+        '''Yield result rows of query in lists of up to chunk_size tuples'''
+        cursor = self.db.cursor(SSCursor)
+        try:
+            # MySQLdb formats the query with params unless they are None
+            cursor.execute(query, params or None)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def stream_logs_date(self, dateTime, chunk_size=1000, until=None, with_id=False):
+        '''Yield logs happening after provided dateTime, oldest first,
+        without column labels
+
+        Args:
+            dateTime: str, date
+            chunk_size: int, logs per yielded list
+            until: str | None, only logs up to this time
+            with_id: bool, start each row with the log id
+
+        Yields: list of tuples ([id,] activity_time, action, doc_id, doc_name, actor_id, actor_name)
+        '''
+        columns = ("id, " if with_id else "") + "activity_time, action, doc_id, doc_name, actor_id, actor_name"
+        if until is None:
+            query = "SELECT " + columns + " FROM activity_log WHERE activity_time > %s ORDER BY activity_time"
+            return self._stream(query, (dateTime,), chunk_size)
+        query = "SELECT " + columns + " FROM activity_log WHERE activity_time > %s AND activity_time <= %s ORDER BY activity_time"
+        return self._stream(query, (dateTime, until), chunk_size)
+
+    def extract_max_log_id(self):
+        '''Return id of the most recently inserted log, 0 if none'''
+        self.cursor.execute("SELECT MAX(id) FROM activity_log")
+        result = self.cursor.fetchone()
+        return result[0] if result and result[0] else 0
+
+    @timed(DB_FETCH_SECONDS, query="logs_after_id")
+    def extract_logs_after_id(self, log_id, limit, until_id=None, doc_ids=None, actions=None):
+        '''Return logs inserted after the log with provided id, in insertion order
+
+        Filters are applied in the query, so logs that can't match a
+        constraint are never transferred. Beyond TEMP_TABLE_THRESHOLD
+        documents, the document filter is a join with a temporary table of
+        their ids instead of an IN list.
+
+        Args:
+            log_id: int
+            limit: int, maximum number of logs
+            until_id: int | None, only logs with id up to until_id
+            doc_ids: list of str | None, only logs on these documents
+            actions: list of (str, bool) | None, only logs whose action
+                equals, when True, or starts with, when False, one of these
+
+        Returns: list of tuples (id, activity_time, action, doc_id, doc_name, actor_id, actor_name)
+        '''
+        if until_id is None and doc_ids is None and actions is None:
+            query = "SELECT id, activity_time, action, doc_id, doc_name, actor_id, actor_name FROM activity_log WHERE id > %s ORDER BY id LIMIT %s"
+            self.execute_prepared(query, (log_id, limit))
+            return self.cursor.fetchall()
+
+        join, where, params = "", ["a.id > %s"], [log_id]
+        if until_id is not None:
+            where.append("a.id <= %s")
+            params.append(until_id)
+        if doc_ids is not None and len(doc_ids) > self.TEMP_TABLE_THRESHOLD:
+            if self._doc_filter is not doc_ids:
+                self.fill_doc_filter(doc_ids)
+            join = " JOIN doc_filter f ON f.doc_id = a.doc_id"
+        elif doc_ids is not None:
+            where.append("a.doc_id IN (" + ",".join(["%s"] * len(doc_ids)) + ")")
+            params += doc_ids
+        if actions is not None:
+            predicates = []
+            for action, exact in actions:
+                if exact:
+                    predicates.append("a.action = %s")
+                    params.append(action)
+                else:
+                    predicates.append("a.action LIKE %s" + self.LIKE_ESCAPE)
+                    params.append(action.replace('%', '\\%').replace('_', '\\_') + '%')
+            where.append("(" + " OR ".join(predicates) + ")")
+        query = ("SELECT a.id, a.activity_time, a.action, a.doc_id, a.doc_name, a.actor_id, a.actor_name FROM activity_log a" + join +
+                 " WHERE " + " AND ".join(where) + " ORDER BY a.id LIMIT %s")
+        self.cursor.execute(query, tuple(params) + (limit,))
+        return self.cursor.fetchall()
+
+    def fill_doc_filter(self, doc_ids):
+        '''Replace the ids in this connection's temporary doc_filter table'''
+        self.cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS doc_filter (doc_id VARCHAR(128) PRIMARY KEY)")
+        self.cursor.execute("DELETE FROM doc_filter")
+        self.cursor.executemany("INSERT INTO doc_filter (doc_id) VALUES (%s)", [(doc_id,) for doc_id in doc_ids])
+        self._doc_filter = doc_ids
+
+    @timed(DB_FETCH_SECONDS, query="logs_for_constraint")
+    def extract_logs_for_constraint(self, doc_ids, action, actors, exact=True):
+        '''Return logs on any of doc_ids by any of actors with matching action
+
+        Served by the (doc_id, action, actor_name) index on activity_log.
+
+        Args:
+            doc_ids: list of str
+            action: str, action, or action prefix when exact is False
+            actors: list of str, actor emails
+            exact: bool
+
+        Returns: list of logs, each a list of activity_time, action, doc_id,
+            doc_name, actor_id, actor_name
+        '''
+        if not doc_ids or not actors:
+            return []
+        query = "SELECT activity_time, action, doc_id, doc_name, actor_id, actor_name FROM activity_log WHERE doc_id IN (" + ",".join(["%s"] * len(doc_ids)) + ")"
+        if exact:
+            query += " AND action = %s"
+        else:
+            query += " AND action LIKE %s" + self.LIKE_ESCAPE
+            action = action.replace('%', '\\%').replace('_', '\\_') + '%'
+        query += " AND actor_name IN (" + ",".join(["%s"] * len(actors)) + ")"
+        self.cursor.execute(query, (*doc_ids, action, *actors))
+        return [list(result) for result in self.cursor.fetchall()]
+
+    def count_logs_date(self, dateTime, until=None):
+        '''Return number of logs happening after provided dateTime, and up to until'''
+        if until is None:
+            self.execute_prepared("SELECT COUNT(*) FROM activity_log WHERE activity_time > %s", (dateTime,))
+        else:
+            self.execute_prepared("SELECT COUNT(*) FROM activity_log WHERE activity_time > %s AND activity_time <= %s", (dateTime, until))
+        return self.cursor.fetchone()[0]
+
+    def extract_conflict_logs_date(self, dateTime):
+        '''Return logs flagged as conflicts happening after provided dateTime
+
+        Args:
+            dateTime: str, date
+
+        Returns: list, oldest first, first row is column labels
+        '''
+        query = """
+        SELECT a.activity_time, a.action, a.doc_id, a.doc_name, a.actor_id, a.actor_name
+        FROM activity_log a JOIN conflicts c ON c.conflictTime = a.activity_time AND c.conflictType = a.action
+        WHERE a.activity_time > %s
+        ORDER BY a.activity_time
+        """
+        self.cursor.execute(query, (dateTime,))
+        logs = [["Activity Time","Action","Document ID","Document Name","Actor ID","Actor Name"]]
+        for result in self.cursor.fetchall():
+            logs.append(list(result))
+        return logs
+
+    def _extract_page(self, query, dateTime, cursor, limit, prefix=""):
+        '''Run a keyset-paginated query ordered by (activity_time, id)
+
+        query has a {where} placeholder for the page predicate, selects
+        activity_time and id as its first two columns, and ends with a
+        LIMIT placeholder.
+        '''
+        if cursor is None:
+            where = prefix + "activity_time > %s"
+            params = (dateTime, limit + 1)
+        else:
+            where = "(" + prefix + "activity_time > %s OR (" + prefix + "activity_time = %s AND " + prefix + "id > %s))"
+            params = (cursor[0], cursor[0], cursor[1], limit + 1)
+        self.execute_prepared(query.format(where=where), params)
+        rows = self.cursor.fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1][0], rows[-1][1])
+        return [list(row) for row in rows], next_cursor
+
+    @timed(DB_FETCH_SECONDS, query="logs_page")
+    def extract_logs_page(self, dateTime, cursor=None, limit=500):
+        '''Return one page of logs happening after provided dateTime
+
+        Pages are ordered by (activity_time, id) and continue after the
+        cursor, so every page costs one index range scan of limit rows.
+
+        Args:
+            dateTime: str, date
+            cursor: (activity_time, id) | None, last log of the previous page
+            limit: int, maximum logs on the page
+
+        Returns: (list, cursor | None), logs as lists of activity_time, id,
+            action, doc_id, doc_name, actor_id, actor_name, and the cursor
+            of the next page, None on the last page
+        '''
+        query = """
+        SELECT activity_time, id, action, doc_id, doc_name, actor_id, actor_name
+        FROM activity_log
+        WHERE {where}
+        ORDER BY activity_time, id
+        LIMIT %s
+        """
+        return self._extract_page(query, dateTime, cursor, limit)
+
+    @timed(DB_FETCH_SECONDS, query="conflict_logs_page")
+    def extract_conflict_logs_page(self, dateTime, cursor=None, limit=500):
+        '''Return one page of logs flagged as conflicts after provided dateTime
+
+        Args and Returns: as extract_logs_page, with the conflict id appended
+            to each log
+        '''
+        query = """
+        SELECT a.activity_time, a.id, a.action, a.doc_id, a.doc_name, a.actor_id, a.actor_name, c.id
+        FROM activity_log a JOIN conflicts c ON c.conflictTime = a.activity_time AND c.conflictType = a.action
+        WHERE {where}
+        ORDER BY a.activity_time, a.id
+        LIMIT %s
+        """
+        return self._extract_page(query, dateTime, cursor, limit, prefix="a.")
+
+    def stream_conflict_logs_date(self, dateTime, chunk_size=1000):
+        '''Yield logs flagged as conflicts after provided dateTime, in the
+        order of extract_conflict_logs_page, without holding them all
+
+        Yields: lists of tuples shaped as the logs of extract_conflict_logs_page
+        '''
+        query = """
+        SELECT a.activity_time, a.id, a.action, a.doc_id, a.doc_name, a.actor_id, a.actor_name, c.id
+        FROM activity_log a JOIN conflicts c ON c.conflictTime = a.activity_time AND c.conflictType = a.action
+        WHERE a.activity_time > %s
+        ORDER BY a.activity_time, a.id
+        """
+        return self._stream(query, (dateTime,), chunk_size)
+
+    def extract_detection_watermark(self):
+        '''Return id of the last log checked for conflicts, 0 if none'''
+        self.cursor.execute("SELECT last_log_id FROM detection_watermark WHERE id = 1")
+        result = self.cursor.fetchone()
+        if result:
+            return result[0]
+        else:
+            return 0
+
+    def update_detection_watermark(self, log_id, commit=True):
+        '''Record id of the last log checked for conflicts'''
+        self.cursor.execute("REPLACE INTO detection_watermark (id, last_log_id) VALUES (1,%s)", (log_id,))
+        if commit:
+            self.db.commit()
+
     def fetch_action_constraints(self,date):
         '''Return action constraints added after provided date.
 
@@ -83,9 +624,9 @@ class DatabaseQuery:
         query = """
         SELECT doc_name, doc_id, action, action_type, constraint_target, action_value, comparator, constraint_owner, allowed_value, time_stamp
         FROM action_constraints
-        WHERE DATE(time_stamp) > %s
+        WHERE time_stamp >= %s
         """
-        self.cursor.execute(query, (today_start,))
+        self.execute_prepared(query, (start_of_next_day(today_start),))
         myresult = self.cursor.fetchall()
 
         myresult = myresult[::-1]
@@ -98,6 +639,20 @@ class DatabaseQuery:
         else:
             return None
 
+    def stream_action_constraints_date(self, date, chunk_size=1000):
+        '''Yield action constraints added after provided date, newest first,
+        without column labels
+
+        Yields: list of tuples in the column order of fetch_action_constraints
+        '''
+        query = """
+        SELECT doc_name, doc_id, action, action_type, constraint_target, action_value, comparator, constraint_owner, allowed_value, time_stamp
+        FROM action_constraints
+        WHERE time_stamp >= %s
+        ORDER BY time_stamp DESC
+        """
+        return self._stream(query, (start_of_next_day(date),), chunk_size)
+
     def extract_action_constraints(self, constraint_owner):
         '''Return action constraints satisfying predicate about constraint owner
 
@@ -107,6 +662,7 @@ class DatabaseQuery:
         Returns: list of action constraints, first row is column labels
         '''
         query = "SELECT doc_name,doc_id,action,action_type,constraint_target,action_value,comparator,constraint_owner,allowed_value FROM action_constraints WHERE constraint_owner "+constraint_owner
+        # Not prepared: every predicate would be another statement on the connection
         self.cursor.execute(query)
         myresult = self.cursor.fetchall()
         constraints = [["Doc_Name","Doc_ID","Action","Action Type","Constraint Target","Action Value","Comparator","Constraint Owner","Allowed Values"]]
@@ -118,19 +674,318 @@ class DatabaseQuery:
         else:
             return None
 
-    def add_conflict_resolution(self, conflictTime, conflictType):
+    def add_action_constraint(self, constraint, commit=True):
+        '''Insert an action constraint with its documents, actors and values
+
+        Args:
+            constraint: list, action constraint in detection format
+            commit: bool, False to leave the transaction open
+
+        Returns: int, id of the new constraint
+        '''
+        doc_names, doc_ids, action, action_type, actors, action_value, comparator, owner, values = constraint
+        query = "INSERT INTO action_constraints (doc_name,doc_id,action,action_type,constraint_target,action_value,comparator,constraint_owner,allowed_value) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+        self.cursor.execute(query, (json.dumps(list(doc_names)), json.dumps(list(doc_ids)), action, action_type, json.dumps(list(actors)),
+                                    action_value, comparator, owner, json.dumps(list(values))))
+        constraint_id = self.cursor.lastrowid
+        self.add_constraint_attributes(constraint_id, doc_ids, doc_names, actors, values)
+        if commit:
+            self.db.commit()
+        return constraint_id
+
+    def add_constraint_attributes(self, constraint_id, doc_ids, doc_names, actors, values):
+        '''Insert rows of constraint_docs, constraint_actors and constraint_values. Not committed.'''
+        doc_names = list(doc_names) + [None] * (len(doc_ids) - len(doc_names))
+        docs = dict(zip(doc_ids, doc_names))
+        self.cursor.executemany("INSERT INTO constraint_docs (constraint_id, doc_id, doc_name) VALUES (%s,%s,%s)",
+                                [(constraint_id, doc_id, doc_name) for doc_id, doc_name in docs.items()])
+        self.cursor.executemany("INSERT INTO constraint_actors (constraint_id, actor) VALUES (%s,%s)",
+                                [(constraint_id, actor) for actor in dict.fromkeys(actors)])
+        self.cursor.executemany("INSERT INTO constraint_values (constraint_id, position, value) VALUES (%s,%s,%s)",
+                                [(constraint_id, position, value) for position, value in enumerate(values)])
+
+    def _owner_filter(self, column, owner_domain):
+        '''Return SQL predicate and parameters matching owners in a domain'''
+        return column + " LIKE %s" + self.LIKE_ESCAPE, ("%@" + owner_domain.replace('%', '\\%').replace('_', '\\_'),)
+
+    def _constraint_attribute(self, table, column, doc_ids, owner_domain=None):
+        '''Return {constraint_id: [values]} of an attribute table, for constraints on doc_ids
+        owned in owner_domain'''
+        order = " ORDER BY t.constraint_id, t.position" if table == "constraint_values" else ""
+        where, params = [], ()
+        if doc_ids is not None:
+            where.append("t.constraint_id IN (SELECT constraint_id FROM constraint_docs WHERE doc_id IN (" + ",".join(["%s"] * len(doc_ids)) + "))")
+            params += tuple(doc_ids)
+        if owner_domain is not None:
+            owner, owner_params = self._owner_filter("constraint_owner", owner_domain)
+            where.append("t.constraint_id IN (SELECT id FROM action_constraints WHERE " + owner + ")")
+            params += owner_params
+        query = "SELECT t.constraint_id, t." + column + " FROM " + table + " t"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        self.cursor.execute(query + order, params)
+        attribute = {}
+        for constraint_id, value in self.cursor.fetchall():
+            attribute.setdefault(constraint_id, []).append(value)
+        return attribute
+
+    def stream_constraints_by_doc(self, doc_ids=None, chunk_size=1000, owner_domain=None):
+        '''Yield action constraints from the normalized tables grouped by document
+
+        Constraints on a document are in the order they were added. Each
+        constraint is in detection format, with only the document it is
+        grouped under.
+
+        Args:
+            doc_ids: list of str | None, only load constraints on these
+                documents, all constraints if None
+            chunk_size: int, rows read per round trip
+            owner_domain: str | None, only load constraints whose owner's
+                email is in this domain
+
+        Yields: (str, list), document id and its constraints
+        '''
+        if doc_ids is not None and not doc_ids:
+            return
+        actors = self._constraint_attribute("constraint_actors", "actor", doc_ids, owner_domain)
+        values = self._constraint_attribute("constraint_values", "value", doc_ids, owner_domain)
+
+        query = """
+        SELECT d.doc_id, d.doc_name, c.id, c.action, c.action_type, c.action_value, c.comparator, c.constraint_owner
+        FROM constraint_docs d JOIN action_constraints c ON c.id = d.constraint_id
+        """
+        where, params = [], ()
+        if doc_ids is not None:
+            where.append("d.doc_id IN (" + ",".join(["%s"] * len(doc_ids)) + ")")
+            params += tuple(doc_ids)
+        if owner_domain is not None:
+            owner, owner_params = self._owner_filter("c.constraint_owner", owner_domain)
+            where.append(owner)
+            params += owner_params
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY d.doc_id, c.id"
+
+        doc_id, constraints = None, []
+        for rows in self._stream(query, params, chunk_size):
+            for row_doc_id, doc_name, constraint_id, action, action_type, action_value, comparator, owner in rows:
+                if row_doc_id != doc_id:
+                    if constraints:
+                        yield doc_id, constraints
+                    doc_id, constraints = row_doc_id, []
+                constraints.append([[doc_name], [row_doc_id], action, action_type, actors.get(constraint_id, []),
+                                    action_value, comparator, owner, values.get(constraint_id, [])])
+        if constraints:
+            yield doc_id, constraints
+
+    def extract_constraint_changes(self, since=None, owner_domain=None):
+        '''Return ids and change times of constraints added or updated since a time
+
+        Changes to the documents, actors or values of a constraint must also
+        update its action_constraints row to be returned.
+
+        Args:
+            since: str | None, "YYYY-MM-DD HH:MM:SS.ffffff", all constraints if None
+            owner_domain: str | None, only constraints whose owner's email is
+                in this domain
+
+        Returns: list of tuples (id, updated_at)
+        '''
+        where, params = [], ()
+        if since is not None:
+            where.append("updated_at >= %s")
+            params += (since,)
+        if owner_domain is not None:
+            owner, owner_params = self._owner_filter("constraint_owner", owner_domain)
+            where.append(owner)
+            params += owner_params
+        query = "SELECT id, updated_at FROM action_constraints"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        self.cursor.execute(query, params)
+        return self.cursor.fetchall()
+
+    def extract_deleted_constraints(self, since=None):
+        '''Return ids and deletion times of constraints deleted since a time
+
+        Args and Returns: as extract_constraint_changes
+        '''
+        if since is None:
+            self.cursor.execute("SELECT constraint_id, deleted_at FROM deleted_constraints")
+        else:
+            self.cursor.execute("SELECT constraint_id, deleted_at FROM deleted_constraints WHERE deleted_at >= %s", (since,))
+        return self.cursor.fetchall()
+
+    def extract_constraint_docs(self, constraint_ids=None, owner_domain=None):
+        '''Return {constraint id: [document ids]} of constraints, all if None,
+        or all owned in owner_domain'''
+        if constraint_ids is None and owner_domain is not None:
+            owner, params = self._owner_filter("c.constraint_owner", owner_domain)
+            self.cursor.execute("SELECT d.constraint_id, d.doc_id FROM constraint_docs d JOIN action_constraints c ON c.id = d.constraint_id WHERE " + owner, params)
+        elif constraint_ids is None:
+            self.cursor.execute("SELECT constraint_id, doc_id FROM constraint_docs")
+        elif not constraint_ids:
+            return {}
+        else:
+            self.cursor.execute("SELECT constraint_id, doc_id FROM constraint_docs WHERE constraint_id IN (" + ",".join(["%s"] * len(constraint_ids)) + ")",
+                                tuple(constraint_ids))
+        docs = {}
+        for constraint_id, doc_id in self.cursor.fetchall():
+            docs.setdefault(constraint_id, []).append(doc_id)
+        return docs
+
+    def add_conflict_resolution(self, conflictTime, conflictType, commit=True):
         '''Insert placeholder resolution "False" if there aren't matching conflicts
 
         Args:
             conflictTime: str
             conflictType: str
+            commit: bool, False to leave the transaction open
+        '''
+        self.execute_prepared(self.INSERT_CONFLICT, (conflictTime, conflictType, "False"))
+        if commit:
+            self.db.commit()
+
+    @timed(CONFLICT_PERSIST_SECONDS)
+    def add_conflicts(self, conflicts, commit=True, batch_size=1000):
+        '''Insert placeholder resolution "False" for each new conflict.
+
+        Relies on the unique key on (conflictTime, conflictType): conflicts
+        already stored keep their resolution. All conflicts are written in
+        multi-row statements of batch_size rows and committed once.
+
+        Args:
+            conflicts: list of (conflictTime, conflictType) tuples
+            commit: bool, False to leave the transaction open
+            batch_size: int, rows per INSERT statement
+        '''
+        rows = [(conflictTime, conflictType, "False") for conflictTime, conflictType in conflicts]
+        for i in range(0, len(rows), batch_size):
+            self.cursor.executemany(self.INSERT_CONFLICT, rows[i:i + batch_size])
+        if commit:
+            self.db.commit()
+
+    def add_job_conflicts(self, job_id, log_ids, commit=True):
+        '''Record logs a detection job found conflicting
+
+        Args:
+            job_id: str
+            log_ids: list of int, activity_log ids
+            commit: bool, False to leave the transaction open
+        '''
+        self.cursor.executemany("INSERT INTO detection_job_conflicts (job_id, log_id) VALUES (%s,%s)",
+                                [(job_id, log_id) for log_id in log_ids])
+        if commit:
+            self.db.commit()
+
+    @timed(DB_FETCH_SECONDS, query="job_conflicts_page")
+    def extract_job_conflicts_page(self, job_id, after_id=0, limit=500):
+        '''Return one page of the logs a detection job found conflicting
+
+        Args:
+            job_id: str
+            after_id: int, id of the last log of the previous page, 0 for the first
+            limit: int, maximum logs on the page
+
+        Returns: (list, int | None), logs as lists of id, activity_time,
+            action, doc_id, doc_name, actor_id, actor_name in insertion
+            order, and the after_id of the next page, None on the last page
+        '''
+        query = """
+        SELECT a.id, a.activity_time, a.action, a.doc_id, a.doc_name, a.actor_id, a.actor_name
+        FROM detection_job_conflicts j JOIN activity_log a ON a.id = j.log_id
+        WHERE j.job_id = %s AND j.log_id > %s
+        ORDER BY j.log_id
+        LIMIT %s
+        """
+        self.execute_prepared(query, (job_id, after_id, limit + 1))
+        rows = self.cursor.fetchall()
+        next_id = rows[limit - 1][0] if len(rows) > limit else None
+        return [list(row) for row in rows[:limit]], next_id
+
+    def add_detection_job(self, job_id, since, until, submitted, heartbeat, commit=True):
+        '''Record a queued detection job in detection_jobs
+
+        Args:
+            heartbeat: float, time.time() of submission
         '''
-        # Check if a record with the same conflictTime and conflictType already exists
-        check_query = "SELECT COUNT(*) FROM conflicts WHERE conflictTime = %s AND conflictType = %s"
-        self.cursor.execute(check_query, (conflictTime, conflictType))
-        count = self.cursor.fetchone()[0]
+        self.cursor.execute("INSERT INTO detection_jobs (id, since_time, until_time, status, submitted, heartbeat) VALUES (%s,%s,%s,'queued',%s,%s)",
+                            (job_id, since, until, submitted, heartbeat))
+        if commit:
+            self.db.commit()
 
-        if(count == 0):
-            resolution = "False"
-            self.cursor.execute("INSERT INTO conflicts (conflictTime,conflictType,resolution) VALUES (%s,%s,%s)", (conflictTime,conflictType,resolution))
+    def extract_detection_job(self, job_id):
+        '''Return a detection job
+
+        Returns: tuple (id, since, until, status, total_rows, rows_scanned,
+            conflicts, error, submitted, started, finished, cancel_requested,
+            heartbeat) or None if unknown
+        '''
+        self.cursor.execute("""SELECT id, since_time, until_time, status, total_rows, rows_scanned, conflicts, error,
+            submitted, started, finished, cancel_requested, heartbeat FROM detection_jobs WHERE id = %s""", (job_id,))
+        return self.cursor.fetchone()
+
+    def update_detection_job(self, job_id, commit=True, **columns):
+        '''Set columns of a detection job, e.g. status="done"'''
+        assignments = ", ".join(column + " = %s" for column in columns)
+        self.cursor.execute("UPDATE detection_jobs SET " + assignments + " WHERE id = %s", tuple(columns.values()) + (job_id,))
+        if commit:
+            self.db.commit()
+
+    def start_detection_job(self, job_id, started):
+        '''Mark a queued detection job running
+
+        Returns: bool, False if it is no longer queued, e.g. cancelled
+        '''
+        self.cursor.execute("UPDATE detection_jobs SET status = 'running', started = %s WHERE id = %s AND status = 'queued'", (started, job_id))
+        self.db.commit()
+        return self.cursor.rowcount == 1
+
+    def cancel_detection_job(self, job_id, finished):
+        '''Request a detection job to stop. A queued job is cancelled at
+        once; a running one stops after its current chunk.'''
+        self.cursor.execute("""UPDATE detection_jobs SET cancel_requested = 1,
+            finished = CASE WHEN status = 'queued' THEN %s ELSE finished END,
+            status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END
+            WHERE id = %s""", (finished, job_id))
+        self.db.commit()
+
+    def touch_detection_jobs(self, job_ids, heartbeat):
+        '''Record that the process running jobs is alive'''
+        self.cursor.executemany("UPDATE detection_jobs SET heartbeat = %s WHERE id = %s", [(heartbeat, job_id) for job_id in job_ids])
+        self.db.commit()
+
+    def fail_stale_detection_jobs(self, stale_before, finished, error):
+        '''Mark queued and running jobs whose heartbeat is older than
+        stale_before failed, as their process exited
+
+        Returns: int, number of jobs marked failed
+        '''
+        self.cursor.execute("""UPDATE detection_jobs SET status = 'failed', error = %s, finished = %s
+            WHERE status IN ('queued', 'running') AND COALESCE(heartbeat, 0) < %s""", (error, finished, stale_before))
+        self.db.commit()
+        return self.cursor.rowcount
+
+    def extract_job_cancel_requested(self, job_id):
+        '''Return True if a detection job was asked to stop'''
+        self.cursor.execute("SELECT cancel_requested FROM detection_jobs WHERE id = %s", (job_id,))
+        result = self.cursor.fetchone()
+        return bool(result and result[0])
+
+    def expire_detection_jobs(self, max_jobs, commit=True):
+        '''Delete the oldest finished detection jobs beyond max_jobs, with their results
+
+        Returns: list of str, ids of deleted jobs
+        '''
+        self.cursor.execute("SELECT COUNT(*) FROM detection_jobs")
+        excess = self.cursor.fetchone()[0] - max_jobs
+        if excess <= 0:
+            return []
+        self.cursor.execute("SELECT id FROM detection_jobs WHERE status NOT IN ('queued', 'running') ORDER BY submitted LIMIT %s", (excess,))
+        expired = [row[0] for row in self.cursor.fetchall()]
+        for job_id in expired:
+            self.cursor.execute("DELETE FROM detection_job_conflicts WHERE job_id = %s", (job_id,))
+            self.cursor.execute("DELETE FROM detection_jobs WHERE id = %s", (job_id,))
+        if commit:
             self.db.commit()
+        return expired
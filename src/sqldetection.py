@@ -0,0 +1,206 @@
+import time
+from datetime import datetime, timedelta, timezone
+from src.metrics import DETECTION_SECONDS, CONFLICTS_FOUND
+
+# Columns of activity_log carried through the detection query
+LOG_COLUMNS = ["id", "activity_time", "action", "doc_id", "doc_name", "actor_id", "actor_name"]
+
+def action_key(action_type):
+    '''Return the key of an action type as computed from logs in SQL, None if
+    no activity has the action type
+
+    Permission changes are keyed "Per:Add", "Per:Remove" and "Per:Update",
+    moves "Mov", and any other "Can <action>" by the logged action.
+    '''
+    if action_type in ("Add Permission", "Remove Permission", "Update Permission"):
+        return "Per:" + action_type.split(" ")[0]
+    elif action_type == "Can Move":
+        return "Mov"
+    elif action_type.startswith("Can "):
+        return action_type[len("Can "):]
+    else:
+        return None
+
+def condition_value(value):
+    '''Return (value, low, high) comparable in SQL to the true value of logs
+
+    Times are compared as "YYYY-MM-DDTHH:MM:SS.mmm" UTC strings, the
+    precision of Reports API activity times. For times with sub-millisecond
+    parts, low and high are the milliseconds around them, which gt and lt
+    compare to, and value is None as no activity time equals them.
+    '''
+    if not isinstance(value, datetime):
+        return value, value, value
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    remainder = timedelta(microseconds=value.microsecond % 1000)
+    low = value - remainder
+    high = low + timedelta(milliseconds=1) if remainder else low
+    low, high = [time.strftime("%Y-%m-%dT%H:%M:%S.") + "%03d" % (time.microsecond // 1000) for time in (low, high)]
+    return (None if remainder else low), low, high
+
+def _after(expression, separator):
+    '''SQL for the text after the first separator, all of it if there is none'''
+    return "SUBSTR({0}, INSTR({0}, '{1}') + 1)".format(expression, separator)
+
+def _before(expression, separator):
+    '''SQL for the text before the first separator, all of it if there is none'''
+    return "CASE WHEN INSTR({0}, '{1}') > 0 THEN SUBSTR({0}, 1, INSTR({0}, '{1}') - 1) ELSE {0} END".format(expression, separator)
+
+class SQLDetectionEngine():
+    '''Detect conflicts inside the database instead of in Python.
+
+    The constraints of a ConflictDetectionEngine are compiled into temporary
+    tables of the connection: detection_rules maps (document, action key,
+    actor) to the condition that applies, as the constraint tree resolves it,
+    and detection_conditions and detection_condition_values hold the
+    comparators and values. One query then parses the action of each log in
+    SQL, joins the logs with the rules and evaluates in, not in, gt and lt
+    like ConditionNode, so only conflicting logs leave the database.
+
+    The parsing follows Activity, using only INSTR, SUBSTR and CASE so that it
+    runs on MySQL and SQLite. Logs that Activity cannot parse raise there but
+    are simply not conflicts here. Each temporary table is referenced once in
+    the query, as MySQL requires.
+
+    Attributes:
+        engine: ConflictDetectionEngine whose constraints are compiled
+    '''
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def compile(self):
+        '''Return rows of detection_rules, detection_conditions and
+        detection_condition_values for the engine's constraints'''
+        conditions, rules, values = {}, [], []
+        for doc_id, action_node in self.engine.constraint_tree.constraints.items():
+            for action_type, actor_node in action_node.constraints.items():
+                key = action_key(action_type)
+                if key is None:
+                    continue
+                for actor, condition_node in actor_node.constraints.items():
+                    for comparator, true_values in condition_node.conditions:
+                        condition = (comparator or "", tuple(condition_value(value) for value in true_values))
+                        if condition not in conditions:
+                            conditions[condition] = len(conditions) + 1
+                            values += [(conditions[condition], position) + value for position, value in enumerate(condition[1])]
+                        rules.append((doc_id, key, actor, conditions[condition]))
+        return rules, [(condition_id, comparator) for (comparator, _), condition_id in conditions.items()], values
+
+    def load(self, db):
+        '''Create and fill the temporary constraint tables on db's connection'''
+        # Compare text byte for byte, like Python does
+        binary = " CHARACTER SET utf8mb4 COLLATE utf8mb4_bin" if db.DIALECT == "mysql" else ""
+        tables = {
+            "detection_rules": """(
+                doc_id VARCHAR(128){0} NOT NULL,
+                action_key VARCHAR(64){0} NOT NULL,
+                actor VARCHAR(255){0} NOT NULL,
+                condition_id INT NOT NULL,
+                PRIMARY KEY (doc_id, actor, action_key, condition_id)
+            )""",
+            "detection_conditions": """(
+                id INT NOT NULL PRIMARY KEY,
+                comparator VARCHAR(16) NOT NULL
+            )""",
+            "detection_condition_values": """(
+                condition_id INT NOT NULL,
+                position INT NOT NULL,
+                value VARCHAR(255){0},
+                low VARCHAR(255){0},
+                high VARCHAR(255){0},
+                PRIMARY KEY (condition_id, position)
+            )""",
+        }
+        for table, columns in tables.items():
+            db.cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS " + table + " " + columns.format(binary))
+            db.cursor.execute("DELETE FROM " + table)
+
+        rules, conditions, values = self.compile()
+        db.cursor.executemany("INSERT INTO detection_rules (doc_id, action_key, actor, condition_id) VALUES (%s,%s,%s,%s)", rules)
+        db.cursor.executemany("INSERT INTO detection_conditions (id, comparator) VALUES (%s,%s)", conditions)
+        db.cursor.executemany("INSERT INTO detection_condition_values (condition_id, position, value, low, high) VALUES (%s,%s,%s,%s,%s)", values)
+
+    @staticmethod
+    def query(until=False):
+        '''Return the detection query on logs after a time, and up to a
+        second time if until is True'''
+        columns = ", ".join(LOG_COLUMNS)
+        is_permission = "SUBSTR(action, 1, 3) = 'Per'"
+        # Logs joined with the rules on their document and actor, with the
+        # text after the first "-" of permission changes
+        logs = """
+        SELECT {a_columns}, r.action_key AS rule_action_key, r.condition_id,
+            CASE WHEN SUBSTR(a.action, 1, 3) = 'Per' THEN {rest} END AS rest1
+        FROM activity_log a JOIN detection_rules r ON r.doc_id = a.doc_id AND r.actor = a.actor_name
+        WHERE a.activity_time > %s{until}
+        """.format(a_columns=", ".join("a." + column for column in LOG_COLUMNS), rest=_after("a.action", "-"),
+                   until=" AND a.activity_time <= %s" if until else "")
+        # "to:<new>", "from:<previous>" and "for:<target>" parts
+        carried = columns + ", rule_action_key, condition_id"
+        parts = "SELECT {0}, {1} AS part1, {2} AS rest2 FROM ({3}) l1".format(carried, _before("rest1", "-"), _after("rest1", "-"), logs)
+        parts = "SELECT {0}, part1, {1} AS part2, {2} AS rest3 FROM ({3}) l2".format(carried, _before("rest2", "-"), _after("rest2", "-"), parts)
+        parts = "SELECT {0}, {1} AS value1, {2} AS value2, {3} AS value3 FROM ({4}) l3".format(
+            carried, _after("part1", ":"), _after("part2", ":"), _after(_before("rest3", "-"), ":"), parts)
+        # Action key and true value of each log, as in Activity
+        activities = """
+        SELECT {carried},
+            CASE WHEN {is_permission} THEN
+                CASE WHEN {new} = 'none' THEN 'Per:Remove' WHEN {previous} = 'none' THEN 'Per:Add' ELSE 'Per:Update' END
+            WHEN SUBSTR(action, 1, 3) = 'Mov' THEN 'Mov'
+            ELSE action END AS action_key,
+            CASE WHEN {is_permission} THEN {target} WHEN action = 'Edit' THEN SUBSTR(activity_time, 1, 23) END AS true_value
+        FROM ({parts}) l4
+        """.format(carried=carried, is_permission=is_permission, new=_before("value1", ":"), previous=_before("value2", ":"),
+                   target=_before("value3", ":"), parts=parts)
+        # Values of the condition that the true value matches
+        conflicts = """
+        SELECT l.id
+        FROM ({activities}) l
+        JOIN detection_conditions c ON c.id = l.condition_id
+        LEFT JOIN detection_condition_values v ON v.condition_id = c.id AND (
+            (c.comparator IN ('in', 'not in') AND v.value = l.true_value)
+            OR (c.comparator = 'gt' AND l.true_value > v.low)
+            OR (c.comparator = 'lt' AND l.true_value < v.high))
+        WHERE l.action_key = l.rule_action_key
+        GROUP BY l.id, c.id, c.comparator
+        HAVING c.comparator = ''
+            OR (c.comparator = 'not in' AND COUNT(v.condition_id) = 0)
+            OR (c.comparator IN ('in', 'gt', 'lt') AND COUNT(v.condition_id) > 0)
+        """.format(activities=activities)
+        return """
+        SELECT a.activity_time, a.action, a.doc_id, a.doc_name, a.actor_id, a.actor_name
+        FROM activity_log a JOIN (SELECT DISTINCT id FROM ({conflicts}) m1) m ON m.id = a.id
+        ORDER BY a.id
+        """.format(conflicts=conflicts)
+
+    def iter_conflicts(self, db, since, until=None, chunk_size=1000):
+        '''Yield logs after since, and up to until, that are conflicts
+
+        Args:
+            db: DatabaseQuery
+            since: str, activity time
+            until: str | None, activity time
+            chunk_size: int, logs per yielded list
+
+        Yields: list of tuples (activity_time, action, doc_id, doc_name,
+            actor_id, actor_name), in insertion order
+        '''
+        self.load(db)
+        params = (since,) if until is None else (since, until)
+        return db._stream(self.query(until is not None), params, chunk_size)
+
+    def detect(self, db, since, until=None):
+        '''Store conflicts in logs after since, and up to until
+
+        Returns: int, number of conflicting logs
+        '''
+        T0 = time.perf_counter()
+        conflicts = []
+        for rows in self.iter_conflicts(db, since, until):
+            conflicts += [(row[0], row[1]) for row in rows]
+        db.add_conflicts(conflicts)
+        DETECTION_SECONDS.observe(time.perf_counter() - T0, mode="sql")
+        CONFLICTS_FOUND.inc(len(conflicts), mode="sql")
+        return len(conflicts)
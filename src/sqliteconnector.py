@@ -0,0 +1,196 @@
+import time, sqlite3, threading
+from itertools import islice
+from src.sqlconnector import DatabaseQuery, next_month
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class ProcessLock:
+    '''Named lock shared by the connections of this process, used in place of
+    a lock file where fcntl is unavailable (Windows). Closing it releases the
+    lock, as closing a lock file does.
+    '''
+
+    _locks = {}
+    _guard = threading.Lock()
+
+    def __init__(self, path):
+        with self._guard:
+            self.lock = self._locks.setdefault(path, threading.Lock())
+        self.held = False
+
+    def acquire(self, timeout=0):
+        self.held = self.lock.acquire(True, timeout) if timeout > 0 else self.lock.acquire(False)
+        return self.held
+
+    def close(self):
+        if self.held:
+            self.held = False
+            self.lock.release()
+
+class SQLiteCursor(sqlite3.Cursor):
+    '''Cursor accepting the %s placeholders of the MySQL queries'''
+
+    def execute(self, query, params=()):
+        if params:
+            query = query.replace("%s", "?").replace("%%", "%")
+        return super().execute(query, params)
+
+    def executemany(self, query, rows):
+        return super().executemany(query.replace("%s", "?").replace("%%", "%"), rows)
+
+class SQLiteConnection(sqlite3.Connection):
+    '''sqlite3 connection with the parts of the MySQLdb connection interface
+    that DatabaseQuery and ConnectionPool use
+
+    Attributes:
+        locks: dict, open lock files (or ProcessLocks) by name, see
+            SQLiteQuery.acquire_lock
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.locks = {}
+
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+    def ping(self):
+        super().execute("SELECT 1")
+
+    def close(self):
+        for lock_file in self.locks.values():
+            lock_file.close()
+        self.locks = {}
+        super().close()
+
+def sqlite_connector(db_config):
+    '''Return a function opening SQLite connections configured by db.yaml
+
+    The database file is sqlite_path (default accord.db). Connections use
+    write-ahead logging, so readers don't block the writer, and wait up to
+    sqlite_busy_timeout seconds (default 30) for the write lock.
+    '''
+    path = db_config.get('sqlite_path', 'accord.db')
+    busy_timeout = db_config.get('sqlite_busy_timeout', 30)
+
+    def connect():
+        connection = sqlite3.connect(path, timeout=busy_timeout, factory=SQLiteConnection, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = WAL")
+        # With WAL, a commit is durable once the log is synced at checkpoints
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        return connection
+    return connect
+
+class SQLiteQuery(DatabaseQuery):
+    '''DatabaseQuery on an SQLite database, for local and embedded deployments.
+
+    Takes connections from sqlite_connector. SQLite caches compiled
+    statements per connection itself, so prepared is unused. Named locks are
+    file locks next to the database file, which hold across processes like
+    MySQL's GET_LOCK; without fcntl (Windows) they fall back to ProcessLock,
+    which only excludes connections of the same process. Streams read through a separate cursor, as SQLite
+    cursors step through results without buffering them. activity_log is
+    not partitioned: a month of logs is a range of the activity_time index,
+    and archiving it deletes that range.
+    '''
+
+    DIALECT = "sqlite"
+    LIKE_ESCAPE = " ESCAPE '\\'"
+    INSERT_CONFLICT = "INSERT OR IGNORE INTO conflicts (conflictTime,conflictType,resolution) VALUES (%s,%s,%s)"
+
+    def execute_prepared(self, query, params=None):
+        self.cursor.execute(query, params or ())
+
+    def acquire_lock(self, name, timeout=0):
+        if name in self.db.locks:
+            return True
+        database = self.db.execute("PRAGMA database_list").fetchone()[2]
+        path = (database or "accord") + "-" + name + ".lock"
+        if fcntl is None:
+            lock = ProcessLock(path)
+            if not lock.acquire(timeout):
+                return False
+            self.db.locks[name] = lock
+            return True
+        lock_file = open(path, "a")
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.db.locks[name] = lock_file
+                return True
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    lock_file.close()
+                    return False
+                time.sleep(0.05)
+
+    def release_lock(self, name):
+        lock_file = self.db.locks.pop(name, None)
+        if lock_file is not None:
+            lock_file.close()
+
+    def log_partitions(self):
+        months = []
+        query = "SELECT MIN(activity_time) FROM activity_log WHERE activity_time >= %s"
+        month = ""
+        while True:
+            # One index seek per month with logs
+            self.cursor.execute(query, (month,))
+            first = self.cursor.fetchone()[0]
+            if first is None:
+                return months
+            months.append(first[:7])
+            month = next_month(first[:7])
+
+    def ensure_log_partitions(self, until_month):
+        return []
+
+    def _drop_log_month(self, month):
+        self.cursor.execute("DELETE FROM activity_log WHERE activity_time >= %s AND activity_time < %s", (month, next_month(month)))
+
+    def _stream_log_month(self, month, chunk_size):
+        query = """
+        SELECT id, activity_time, action, doc_id, doc_name, actor_id, actor_name FROM activity_log
+        WHERE activity_time >= %s AND activity_time < %s
+        ORDER BY activity_time, id
+        """
+        return self._stream(query, (month, next_month(month)), chunk_size)
+
+    def load_activity_logs(self, filename, batch_size=100000):
+        '''Bulk load a CSV log file into activity_log table.
+
+        SQLite has no LOAD DATA: rows are inserted with executemany,
+        batch_size lines per transaction. Args and Returns as
+        DatabaseQuery.load_activity_logs.
+        '''
+        query = "INSERT INTO activity_log (activity_time, action, doc_id, doc_name, actor_id, actor_name) VALUES (%s,%s,%s,%s,%s,%s)"
+        total = 0
+        with open(filename) as log_file:
+            log_file.readline() # Skip header row
+            while True:
+                lines = list(islice(log_file, batch_size))
+                if not lines:
+                    break
+                rows = [tuple(line.rstrip("\n").split(',')[:6]) for line in lines]
+                rows = [row for row in rows if len(row) == 6]
+                self.cursor.executemany(query, rows)
+                self.db.commit()
+                total += len(rows)
+        return total
+
+    def _stream(self, query, params, chunk_size):
+        cursor = self.db.cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
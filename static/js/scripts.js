@@ -20,22 +20,34 @@ $(document).ready(function(){
         // Convert selected date to ISO string format
         var isoDate = new Date(selectedDate).toISOString();
 
-        // Fetch drive log with selected date as parameter
+        // Stream drive log with selected date as parameter, showing the first rows as they arrive
         try {
-            let logResponse = await fetch('/fetch_drive_log?time=' + isoDate);
-            let logData = await logResponse.json();
-            console.log('Log Data:', logData);
-
-            // Clear existing table rows
+            let logData = [];
+            let pageSize = 20;
             $('#log-table-body').empty();
+            let logResponse = await fetch('/fetch_drive_log?time=' + encodeURIComponent(isoDate), {
+                headers: { 'Accept': 'application/x-ndjson' }
+            });
+            if (!logResponse.ok) {
+                throw new Error('Network response was not ok');
+            }
+            await readNDJSON(logResponse, function(chunk) {
+                let shown = logData.length;
+                logData = logData.concat(chunk.logs);
+                if (shown < pageSize) {
+                    $('#log-table').show();
+                    displayLogData(logData, 1, pageSize);
+                }
+                $('#fetch-message').show().text(`Fetched ${logData.length} rows from ${selectedDate}...`);
+            });
+            console.log('Log Data:', logData);
 
-            // Populate table with log data if available
+            // Paginate log data if available
             if (logData.length > 0) {
                 $('#log-table').show();
                 $('#fetch-message').show().text(`Fetched ${logData.length} rows from ${selectedDate}`);
                 
                 // Calculate pagination
-                var pageSize = 20;
                 var pageCount = Math.ceil(logData.length / pageSize);
                 var currentPage = 1;
 
@@ -115,11 +127,12 @@ $(document).ready(function(){
 
     // Function to detect conflicts
     function callDetectConflictsDemo(currentDate) {
-        // Send HTTP POST request to detect conflicts endpoint
+        // Send HTTP POST request to detect conflicts endpoint, conflicts are streamed as they are read
         fetch('/detect_conflicts_demo', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/x-www-form-urlencoded',
+                'Accept': 'application/x-ndjson',
             },
             body: `current_date=${currentDate}`, // Sending current_date as a form parameter
         })
@@ -127,33 +140,28 @@ $(document).ready(function(){
             if (!response.ok) {
                 throw new Error('Network response was not ok');
             }
-            return response.json(); // Expecting JSON response
-        })
-        .then(data => {
-            // Hide loader after fetch completes
-            $('#loader').hide();
-
-            // Display detection time label
-            $('#detectionTimeLabel').text(`Detection Time: ${data.detectTimeLabel}`);
-
-            // Check if logs are available
-            if (data.logs.length > 0) {
-                // Update the table with the returned logs
-                data.logs.forEach(function(log, index) {
-                    const row = $("<tr>");
-                    row.append($("<td>").text(data.conflictID[index])); // Add conflict ID
-                    for (let i = 0; i < 4; i++) {
-                        row.append($("<td>").text(log[i])); // Append first four columns from log data
-                    }
-                    $("#logs-table tbody").append(row); // Append the row to the table body
-                });
-
-                // Show the modal with logs
-                $('#logsModal').modal('show');
-            } else {
-                // Display message if no logs found
-                $('#no-logs-message').show();
-            }
+            let shown = 0;
+            return readNDJSON(response, function(data) {
+                if (data.detectTimeLabel !== undefined) {
+                    // First line: hide loader and display detection time label
+                    $('#loader').hide();
+                    $('#detectionTimeLabel').text(`Detection Time: ${data.detectTimeLabel}`);
+                    // Hover for the time of each phase
+                    $('#detectionTimeLabel').attr('title', formatTimings(data.timings));
+                    return;
+                }
+                // Update the table with the returned logs, showing the modal with the first ones
+                appendConflictRows(data);
+                if (shown === 0 && data.logs.length > 0) {
+                    $('#logsModal').modal('show');
+                }
+                shown += data.logs.length;
+            }).then(() => {
+                if (shown === 0) {
+                    // Display message if no logs found
+                    $('#no-logs-message').show();
+                }
+            });
         })
         .catch(error => {
             console.error('Error detecting conflicts:', error);
@@ -164,12 +172,59 @@ $(document).ready(function(){
     }
 
 
+    // Append a chunk of conflicts to the conflicts table
+    function appendConflictRows(data) {
+        const rows = data.logs.map(function(log, index) {
+            const row = $("<tr>");
+            row.append($("<td>").text(data.conflictID[index])); // Add conflict ID
+            for (let i = 0; i < 4; i++) {
+                row.append($("<td>").text(log[i])); // Append first four columns from log data
+            }
+            return row;
+        });
+        $("#logs-table tbody").append(rows); // Append the rows to the table body at once
+    }
+
     $('.nav-tabs a').on('click', function (e) {
         e.preventDefault();
         $(this).tab('show');
     });
 });
 
+// Format a detection time breakdown as one "phase: seconds" line per phase
+function formatTimings(timings) {
+    if (!timings) {
+        return '';
+    }
+    return Object.entries(timings.phases)
+        .map(([phase, seconds]) => `${phase.replace('_', ' ')}: ${seconds.toFixed(4)} s`)
+        .join('\n');
+}
+
+// Call onLine with each object of a newline-delimited JSON response as it arrives
+async function readNDJSON(response, onLine) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+        let lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(line => {
+            if (line.trim()) {
+                onLine(JSON.parse(line));
+            }
+        });
+        if (done) {
+            break;
+        }
+    }
+    if (buffer.trim()) {
+        onLine(JSON.parse(buffer));
+    }
+}
+
 // Function to display log data based on pagination
 function displayLogData(logData, page, pageSize) {
     var startIndex = (page - 1) * pageSize;
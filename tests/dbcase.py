@@ -0,0 +1,45 @@
+import unittest, json, os, tempfile
+from src.dbpool import create_pool
+from src.schema import migrate
+
+LOG_INSERT = "INSERT INTO activity_log (activity_time, action, doc_id, doc_name, actor_id, actor_name) VALUES (%s,%s,%s,%s,%s,%s)"
+
+def load_sample(name):
+    '''Return tests/sample_<name>.txt: "constraints" or "logs"'''
+    with open("tests/sample_" + name + ".txt") as file:
+        return json.load(file)
+
+class SQLiteTestCase(unittest.TestCase):
+    '''Test case on a migrated SQLite database in a temporary directory
+
+    Attributes:
+        directory: TemporaryDirectory, holding the database file
+        pool: ConnectionPool of pool_size connections on the database
+        constraints: list, sample constraints, not stored
+        logs: list, sample logs, not stored
+    '''
+
+    pool_size = 1
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.pool = create_pool({'db_backend': 'sqlite', 'sqlite_path': os.path.join(self.directory.name, "accord.db"), 'db_pool_size': self.pool_size})
+        self.constraints = load_sample("constraints")
+        self.logs = load_sample("logs")
+        with self.pool.connection() as db:
+            migrate(db)
+
+    def tearDown(self):
+        self.pool.close()
+        self.directory.cleanup()
+
+    def add_constraints(self, constraints):
+        with self.pool.connection() as db:
+            for constraint in constraints:
+                db.add_action_constraint(constraint)
+
+    def add_logs(self, logs):
+        # Some sample actions contain commas, which the log string format can't carry
+        with self.pool.connection() as db:
+            db.cursor.executemany(LOG_INSERT, logs)
+            db.commit()
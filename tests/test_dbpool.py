@@ -0,0 +1,135 @@
+import unittest, time
+from tests.dbcase import SQLiteTestCase
+from src.dbpool import ConnectionPool
+from src.sqlconnector import DatabaseQuery
+
+class FakeCursor():
+    '''Cursor formatting queries like MySQLdb: query % params unless params is None'''
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, query, params=None):
+        if params is not None:
+            query = query % params
+        self.executed.append(query)
+
+    def fetchall(self):
+        return []
+
+class FakeConnection():
+    '''Connection that fails to ping and roll back once broken'''
+
+    def __init__(self):
+        self.broken = False
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor()
+
+    def ping(self):
+        if self.broken:
+            raise ConnectionError("Lost connection")
+
+    def rollback(self):
+        if self.broken:
+            raise ConnectionError("Lost connection")
+
+    def close(self):
+        self.closed = True
+
+class TestConnectionPool(SQLiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.connections = []
+
+    def connect(self):
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+    def testA_timeout(self):
+        pool = ConnectionPool(self.connect, size=1, timeout=0.05)
+        with pool.connection():
+            T0 = time.perf_counter()
+            with self.assertRaises(TimeoutError):
+                with pool.connection():
+                    pass
+            self.assertGreaterEqual(time.perf_counter() - T0, 0.05)
+            metrics = pool.metrics()
+            self.assertEqual((metrics['in_use'], metrics['idle'], metrics['utilization']), (1, 0, 1.0))
+        with pool.connection():
+            pass
+        metrics = pool.metrics()
+        self.assertEqual((metrics['checkouts'], metrics['waits'], metrics['timeouts'], metrics['connects']), (3, 1, 1, 1))
+        self.assertEqual((metrics['open'], metrics['in_use'], metrics['idle']), (1, 0, 1))
+        self.assertGreaterEqual(metrics['wait_seconds'], 0.05)
+
+    def testB_broken(self):
+        pool = ConnectionPool(self.connect, size=1, recycle=0)
+        # Broken while in use: discarded when returned
+        with pool.connection() as db:
+            db.db.broken = True
+        self.assertTrue(self.connections[0].closed)
+        # Broken while idle: replaced when checked out again
+        with pool.connection() as db:
+            self.assertIs(db.db, self.connections[1])
+        self.connections[1].broken = True
+        with pool.connection() as db:
+            self.assertIs(db.db, self.connections[2])
+        self.assertTrue(self.connections[1].closed)
+        metrics = pool.metrics()
+        self.assertEqual((metrics['connects'], metrics['discarded'], metrics['open']), (3, 2, 1))
+
+    def testC_rollback(self):
+        with self.pool.connection() as db:
+            db.add_action_constraint(self.constraints[0], commit=False)
+        with self.pool.connection() as db:
+            # Only the column labels
+            self.assertEqual(len(db.extract_action_constraints("LIKE '%'")), 1)
+            db.add_action_constraint(self.constraints[0])
+        with self.pool.connection() as db:
+            self.assertEqual(len(db.extract_action_constraints("LIKE '%'")), 2)
+
+    def testD_unprepared(self):
+        pool = ConnectionPool(self.connect, size=1)
+        with pool.connection() as db:
+            self.assertEqual(len(db.extract_action_constraints("LIKE '%'")), 1)
+            self.assertEqual(db.prepared, {})
+            self.assertTrue(db.cursor.executed[0].endswith("LIKE '%'"))
+        query = DatabaseQuery(FakeConnection(), FakeCursor())
+        query.execute_prepared("SELECT 1 LIKE '%'")
+        self.assertEqual(query.cursor.executed, ["SELECT 1 LIKE '%'"])
+
+    def testE_connections(self):
+        pool = ConnectionPool(self.connect, size=2, timeout=0.05)
+        with pool.connection():
+            # One connection is free, but both are needed together
+            with self.assertRaises(TimeoutError):
+                with pool.connections(2):
+                    pass
+            self.assertEqual(pool.metrics()['in_use'], 1)
+        with pool.connections(2) as (db1, db2):
+            self.assertIsNot(db1.db, db2.db)
+            self.assertEqual(pool.metrics()['in_use'], 2)
+        self.assertEqual(pool.metrics()['idle'], 2)
+        with self.assertRaises(ValueError):
+            with pool.connections(3):
+                pass
+
+    def testF_prepared(self):
+        pool = ConnectionPool(self.connect, size=1)
+        checkouts = []
+        for _ in range(2):
+            with pool.connection() as db:
+                db.extract_logs_date("2024-01-01")
+                checkouts.append(db.cursor.executed)
+        run = ["SET @accord_stmt_0_0 = 2024-01-01", "EXECUTE accord_stmt_0 USING @accord_stmt_0_0"]
+        # Prepared on the first checkout of the connection only
+        self.assertTrue(checkouts[0][0].startswith("PREPARE accord_stmt_0 FROM SELECT"))
+        self.assertEqual(checkouts[0][1:], run)
+        self.assertEqual(checkouts[1], run)
+        self.assertEqual(len(self.connections), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,6 @@
 import unittest
 import json
-from src.detection import detectmain
+from src.detection import detectmain, check_constraint, ConflictDetectionEngine
 
 class TestDetectMain(unittest.TestCase):
     def testA_empty(self):
@@ -62,6 +62,46 @@ class TestDetectMain(unittest.TestCase):
         logs = [['2024-07-24T17:38:17.755Z', 'Permission Change-to:can_viewcan_comment-from:can_edit-for:bob@accord.foundation', '1qiUmGMg5ueyv_MnfcacVktQdx_6xjCeD8b0dH1OAydo', 'doc1', '114128337804353370964', 'carol@accord.foundation']]
         self.assertEqual(detectmain(logs, constraints), [False])
 
+    def testI_iter_conflicts_chunks(self):
+        with open("tests/sample_constraints.txt") as file:
+            constraints = json.load(file)
+        with open("tests/sample_logs.txt") as file:
+            logs = json.load(file)
+        engine = ConflictDetectionEngine(constraints)
+        chunks = (map(tuple, logs[i:i + 10]) for i in range(0, len(logs), 10))
+        expected = [tuple(log) for log, conflict in zip(logs, detectmain(logs, constraints)) if conflict]
+        self.assertEqual(list(engine.iter_conflicts(chunks)), expected)
+
+    def testJ_load_grouped(self):
+        with open("tests/sample_constraints.txt") as file:
+            constraints = json.load(file)
+        with open("tests/sample_logs.txt") as file:
+            logs = json.load(file)
+        # Split constraints into one per document, grouped as stored in constraint_docs
+        doc_groups = {}
+        for constraint in constraints:
+            for doc_name, doc_id in zip(constraint[0], constraint[1]):
+                doc_groups.setdefault(doc_id, []).append([[doc_name], [doc_id]] + constraint[2:])
+        engine = ConflictDetectionEngine()
+        engine.load_grouped(sorted(doc_groups.items()))
+        self.assertEqual(engine.check_conflicts(logs), detectmain(logs, constraints))
+
 
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
+
+class TestCheckConstraint(unittest.TestCase):
+    CONSTRAINT = [['Testing'], ['1pKjYSud0_oqWIcU30a_9LftSJ-4abJ2T5YJKvAtSzUs'], 'Edit', 'Can Edit', ['drew@accord.foundation'], 'FALSE', '', 'admin@accord.foundation', []]
+
+    def testA_valid(self):
+        check_constraint(self.CONSTRAINT)
+        check_constraint(self.CONSTRAINT[:8] + [''])
+
+    def testB_invalid(self):
+        invalid = [None, {'constraint': self.CONSTRAINT}, self.CONSTRAINT[:5],
+                   ['Testing'] + self.CONSTRAINT[1:], self.CONSTRAINT[:3] + [None] + self.CONSTRAINT[4:],
+                   self.CONSTRAINT[:4] + [['drew@accord.foundation', 1]] + self.CONSTRAINT[5:],
+                   self.CONSTRAINT[:1] + [[]] + self.CONSTRAINT[2:], self.CONSTRAINT[:4] + [[]] + self.CONSTRAINT[5:]]
+        for constraint in invalid:
+            with self.subTest(constraint=constraint):
+                self.assertRaises(ValueError, check_constraint, constraint)
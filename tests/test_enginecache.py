@@ -0,0 +1,56 @@
+import unittest
+from tests.dbcase import SQLiteTestCase
+from src.enginecache import EngineCache
+from src.incremental import load_engine
+
+class TestEngineCache(SQLiteTestCase):
+    '''A refreshed cached engine must flag the same logs as a freshly loaded one'''
+
+    def setUp(self):
+        super().setUp()
+        # The last constraints of the sample are the ones with conflicts
+        self.add_constraints(self.constraints[:340])
+
+    def assertCurrent(self, db, cache):
+        self.assertEqual(cache.get(db).check_conflicts(self.logs), load_engine(db).check_conflicts(self.logs))
+
+    def testA_unchanged(self):
+        cache = EngineCache()
+        with self.pool.connection() as db:
+            engine = cache.get(db)
+            self.assertIs(cache.get(db), engine)
+            self.assertEqual(cache.stats['loads'], 1)
+            self.assertEqual(cache.stats['refreshes'], 0)
+
+    def testB_added(self):
+        cache = EngineCache()
+        with self.pool.connection() as db:
+            previous = cache.get(db)
+            before = previous.check_conflicts(self.logs)
+            for constraint in self.constraints[340:]:
+                db.add_action_constraint(constraint)
+            self.assertCurrent(db, cache)
+            self.assertNotEqual(cache.engine.check_conflicts(self.logs), before)
+            self.assertEqual(cache.stats['refreshes'], 1)
+            # Requests still holding the previous engine are unaffected
+            self.assertEqual(previous.check_conflicts(self.logs), before)
+
+    def testC_updated_and_deleted(self):
+        cache = EngineCache()
+        with self.pool.connection() as db:
+            for constraint in self.constraints[340:]:
+                db.add_action_constraint(constraint)
+            before = cache.get(db).check_conflicts(self.logs)
+            db.cursor.execute("SELECT id FROM action_constraints ORDER BY id")
+            ids = [row[0] for row in db.cursor.fetchall()]
+            db.cursor.execute("DELETE FROM action_constraints WHERE id IN (%s,%s)", (ids[349], ids[360]))
+            db.cursor.execute("UPDATE action_constraints SET comparator = 'in' WHERE id = %s", (ids[351],))
+            db.commit()
+            self.assertCurrent(db, cache)
+            self.assertLess(sum(cache.engine.check_conflicts(self.logs)), sum(before))
+            self.assertEqual(cache.stats['loads'], 1)
+            self.assertIs(cache.get(db), cache.engine)
+
+
+if __name__ == "__main__":
+    unittest.main()
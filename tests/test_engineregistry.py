@@ -0,0 +1,51 @@
+import unittest, os
+from tests.dbcase import SQLiteTestCase
+from src.detection import detectmain
+from src.engineregistry import EngineRegistry, engine_size, tenant_of
+
+class TestEngineRegistry(SQLiteTestCase):
+    '''Each tenant's engine must flag the logs its own constraints flag, also
+    after eviction and restore'''
+
+    def setUp(self):
+        super().setUp()
+        # Alternate the sample constraints between two tenants
+        self.tenants = ["a.example", "b_c.example"]
+        for i, constraint in enumerate(self.constraints):
+            constraint[7] = "owner@" + self.tenants[i % 2]
+        self.stored, self.added = self.constraints[:-10], self.constraints[-10:]
+        self.add_constraints(self.stored)
+
+    def assertTenant(self, engine, tenant, constraints):
+        own = [constraint for constraint in constraints if tenant_of(constraint[7]) == tenant]
+        self.assertEqual(engine.check_conflicts(self.logs), detectmain(self.logs, own))
+
+    def testA_tenants(self):
+        registry = EngineRegistry()
+        with self.pool.connection() as db:
+            engines = {tenant: registry.get(db, tenant) for tenant in self.tenants}
+            for tenant, engine in engines.items():
+                self.assertTenant(engine, tenant, self.stored)
+            self.assertIs(registry.get(db, "a.example"), engines["a.example"])
+        self.assertEqual(registry.stats['tenants'], 2)
+        self.assertEqual(registry.stats['bytes'], sum(engine_size(engine) for engine in engines.values()))
+        self.assertNotEqual(engines["a.example"].check_conflicts(self.logs), engines["b_c.example"].check_conflicts(self.logs))
+
+    def testB_evict_and_restore(self):
+        registry = EngineRegistry(budget_bytes=1, snapshot_dir=os.path.join(self.directory.name, "snapshots"))
+        with self.pool.connection() as db:
+            registry.get(db, "a.example")
+            registry.get(db, "b_c.example")
+            # Only the engine just used is kept
+            self.assertEqual(registry.stats['evictions'], 1)
+            self.assertEqual(registry.stats['tenants'], 1)
+
+            for constraint in self.added:
+                db.add_action_constraint(constraint)
+            engine = registry.get(db, "a.example")
+            self.assertEqual(registry.stats['restores'], 1)
+            self.assertTenant(engine, "a.example", self.stored + self.added)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import json
+from tests.dbcase import SQLiteTestCase
+from src.detection import Activity, detectmain
+from src.incremental import constraint_action_filter, RetroactiveDetector
+
+class TestConstraintActionFilter(unittest.TestCase):
+    def testA_matches_activity_action_types(self):
+        with open("tests/sample_logs.txt") as file:
+            logs = json.load(file)
+        action_types = ["Can Create", "Can Delete", "Can Edit", "Time Limit Edit", "Can Move", "Can Rename",
+                        "Add Permission", "Remove Permission", "Update Permission"]
+        for log in logs:
+            activity_type = Activity(log).actiontype
+            for action_type in action_types:
+                action, exact = constraint_action_filter(action_type)
+                matched = log[1] == action if exact else log[1].startswith(action)
+                same_type = activity_type == ("Can Edit" if action_type == "Time Limit Edit" else action_type)
+                if same_type:
+                    self.assertTrue(matched, (log[1], action_type))
+                if matched and not action_type.endswith("Permission"):
+                    self.assertTrue(same_type, (log[1], action_type))
+
+class TestRetroactiveDetector(SQLiteTestCase):
+    '''A new constraint must flag the past logs detectmain flags for it, once'''
+
+    def testA_detect_constraint(self):
+        self.add_logs(self.logs)
+        detector = RetroactiveDetector()
+        stored = set()
+        with self.pool.connection() as db:
+            for constraint in self.constraints:
+                expected = [tuple(log) for log, conflict in zip(self.logs, detectmain(self.logs, [constraint])) if conflict]
+                found = detector.detect_constraint(db, constraint)
+                self.assertEqual(sorted(tuple(log) for log in found), sorted(expected))
+                stored.update((log[0], log[1]) for log in expected)
+            self.assertTrue(stored)
+
+            # Detecting again merges into the stored conflicts
+            for constraint in self.constraints[-20:]:
+                detector.detect_constraint(db, constraint)
+            db.cursor.execute("SELECT conflictTime, conflictType FROM conflicts")
+            self.assertEqual(sorted(db.cursor.fetchall()), sorted(stored))
+
+
+if __name__ == "__main__":
+    unittest.main()
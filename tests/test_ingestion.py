@@ -0,0 +1,251 @@
+import unittest
+from tests.dbcase import SQLiteTestCase
+from src.activitylogs import Logupdater
+from src.ingestion import IngestionScheduler
+from src.pipeline import IngestionPipeline
+
+def drive_activity(time, doc_id, email):
+    '''Return a Reports API drive activity with one primary edit event'''
+    return {'id': {'time': time},
+            'actor': {'email': email, 'profileId': "1"},
+            'events': [{'name': "edit", 'parameters': [{'name': "doc_id", 'value': doc_id},
+                                                       {'name': "doc_title", 'value': "Doc"},
+                                                       {'name': "primary_event", 'boolValue': True}]}]}
+
+class FakeReportsService():
+    '''Reports API service serving pages of drive activities
+
+    The token of page i is str(i). Listing page fail_on raises, as a failed
+    API call does.
+
+    Attributes:
+        requested: list, page token of each list call
+        start_time: str, start time of the last list call
+    '''
+
+    def __init__(self, pages, fail_on=None):
+        self.pages = pages
+        self.fail_on = fail_on
+        self.requested = []
+
+    def activities(self):
+        return self
+
+    def list(self, userKey, applicationName, startTime, pageToken):
+        self.requested.append(pageToken)
+        self.start_time = startTime
+        self._page = int(pageToken) if pageToken else 0
+        return self
+
+    def execute(self):
+        if self._page == self.fail_on:
+            raise ConnectionError("Backend error")
+        results = {'items': self.pages[self._page]}
+        if self._page + 1 < len(self.pages):
+            results['nextPageToken'] = str(self._page + 1)
+        return results
+
+def activity_pages(count, per_page):
+    return [[drive_activity("2024-01-%02dT00:00:%02d.000Z" % (page + 1, i), "doc" + str(i), "alice@accord.foundation")
+             for i in range(per_page)] for page in range(count)]
+
+class TestLogupdater(SQLiteTestCase):
+    '''An interrupted ingestion run must resume from the page that failed'''
+
+    def testA_resume(self):
+        pages = activity_pages(5, 3)
+        service = FakeReportsService(pages, fail_on=3)
+        with self.assertRaises(Exception):
+            Logupdater(self.pool, service).updateLogs_database()
+        with self.pool.connection() as db:
+            self.assertEqual(db.extract_log_checkpoint(), ('1970-01-01T00:00:00.000000Z', "3", "2024-01-03T00:00:02.000Z"))
+            self.assertEqual(db.extract_lastLog_date(), '1970-01-01T00:00:00.000000Z')
+            self.assertEqual(db.count_logs_date("2000-01-01"), 9)
+
+        service.fail_on = None
+        service.requested = []
+        self.assertEqual(Logupdater(self.pool, service).updateLogs_database(), 6)
+        self.assertEqual(service.requested, ["3", "4"])
+        self.assertEqual(service.start_time, '1970-01-01T00:00:00.000000Z')
+        with self.pool.connection() as db:
+            self.assertIsNone(db.extract_log_checkpoint())
+            self.assertEqual(db.extract_lastLog_date(), "2024-01-05T00:00:02.000000Z")
+            self.assertEqual(db.count_logs_date("2000-01-01"), 15)
+
+        # The next run starts from the last log date
+        service.requested = []
+        Logupdater(self.pool, service).updateLogs_database()
+        self.assertEqual(service.requested[0], None)
+        self.assertEqual(service.start_time, "2024-01-05T00:00:02.000000Z")
+
+class TestIngestionScheduler(SQLiteTestCase):
+    '''Passes must not overlap, and must report their rows, errors and lag'''
+
+    # A pass holds two connections, the test one more
+    pool_size = 3
+
+    def setUp(self):
+        super().setUp()
+        self.scheduler = IngestionScheduler(self.pool)
+
+    def testA_stats(self):
+        self.scheduler.reportsAPI_service = FakeReportsService(activity_pages(5, 3))
+        self.assertEqual(self.scheduler.run_once(), 15)
+        stats = self.scheduler.status()
+        self.assertEqual(stats['last_run_rows'], 15)
+        self.assertIsNone(stats['last_error'])
+        self.assertGreater(stats['rows_per_sec'], 0)
+        self.assertAlmostEqual(stats['lag_seconds'], IngestionScheduler.lag_seconds("2024-01-05T00:00:02.000000Z"), delta=5)
+        self.assertFalse(stats['running'])
+        self.assertEqual(stats['skipped_runs'], 0)
+
+    def testB_no_overlap(self):
+        self.assertIsNone(self.scheduler.run_once())
+        self.scheduler.reportsAPI_service = FakeReportsService(activity_pages(1, 3))
+        # A pass in this process
+        with self.scheduler._pass_lock:
+            self.assertIsNone(self.scheduler.run_once())
+        # A pass in another process sharing the database
+        with self.pool.connection() as db:
+            self.assertTrue(db.acquire_lock(IngestionScheduler.LOCK_NAME))
+            self.assertIsNone(self.scheduler.run_once())
+            db.release_lock(IngestionScheduler.LOCK_NAME)
+        self.assertEqual(self.scheduler.status()['skipped_runs'], 3)
+        self.assertEqual(self.scheduler.run_once(), 3)
+
+    def testC_error(self):
+        pages = activity_pages(2, 3)
+        del pages[1][0]['events']
+        self.scheduler.reportsAPI_service = FakeReportsService(pages)
+        self.assertEqual(self.scheduler.run_once(), 0)
+        stats = self.scheduler.status()
+        self.assertTrue(stats['last_error'].startswith("Error in the key or index"))
+        self.assertEqual(stats['last_run_rows'], 0)
+        with self.pool.connection() as db:
+            self.assertEqual(db.extract_log_checkpoint()[1], "1")
+
+        # An API failure is reported with its exception message
+        self.scheduler.reportsAPI_service = FakeReportsService(pages, fail_on=1)
+        self.assertIsNone(self.scheduler.run_once(force=True))
+        self.assertIn("Backend error", self.scheduler.status()['last_error'])
+
+    def testD_lease(self):
+        # The scheduler of another process sharing the database
+        other = IngestionScheduler(self.pool)
+        service = FakeReportsService(activity_pages(1, 3))
+        self.scheduler.reportsAPI_service = other.reportsAPI_service = service
+        self.assertEqual(self.scheduler.run_once(), 3)
+        # Polled once per interval, whichever process polls
+        self.assertIsNone(other.run_once())
+        self.assertIsNone(self.scheduler.run_once())
+        self.assertEqual(len(service.requested), 1)
+        self.assertEqual(other.status()['skipped_runs'], 0)
+        # Triggered passes run at once
+        self.assertIsNotNone(other.run_once(force=True))
+        self.assertEqual(len(service.requested), 2)
+
+        status = IngestionScheduler.merge_status([self.scheduler.status(), other.status()])
+        self.assertEqual(status['last_run'], other.status()['last_run'])
+        self.assertFalse(status['running'])
+        self.assertEqual(status['skipped_runs'], 0)
+
+    def testE_partition_error(self):
+        def maintain_partitions(db):
+            raise OSError("Archive directory not writable")
+        self.scheduler.maintain_partitions = maintain_partitions
+        self.scheduler.reportsAPI_service = FakeReportsService(activity_pages(1, 3))
+        # The logs were committed, so the pass succeeded
+        self.assertEqual(self.scheduler.run_once(), 3)
+        stats = self.scheduler.status()
+        self.assertIsNone(stats['last_error'])
+        self.assertIsNotNone(stats['last_run'])
+        self.assertEqual(stats['last_run_rows'], 3)
+        self.assertEqual(stats['partition_error'], "Archive directory not writable")
+
+class BrokenEngine():
+    '''Engine failing when detection reads its constraints'''
+
+    def constrained_action_types(self):
+        raise RuntimeError("Engine failure")
+
+class BrokenEngineCache():
+    def get(self, db):
+        return BrokenEngine()
+
+class TestIngestionPipeline(SQLiteTestCase):
+    '''The pipeline must commit and check all new logs, resume after a failed
+    stage, and pass the stage's error up'''
+
+    # The write and detect stages hold a connection each
+    pool_size = 2
+
+    def setUp(self):
+        super().setUp()
+        # Flags alice's edits of doc1, one per page
+        self.add_constraints([[["Doc"], ["doc1"], "Edit", "Can Edit", ["alice@accord.foundation"], "TRUE", "", "owner@accord.foundation", []]])
+
+    def testA_run(self):
+        pipeline = IngestionPipeline(self.pool, FakeReportsService(activity_pages(5, 3)), batch_rows=4)
+        self.assertEqual(pipeline.run(), 15)
+        self.assertEqual(pipeline.conflicts, 5)
+        metrics = pipeline.metrics()
+        self.assertEqual([metrics[stage]['rows'] for stage in ["fetch", "parse", "write"]], [15, 15, 15])
+        self.assertEqual(metrics['fetch']['items'], 5)
+        with self.pool.connection() as db:
+            self.assertEqual(db.count_logs_date("2000-01-01"), 15)
+            self.assertEqual(db.extract_detection_watermark(), 15)
+            self.assertIsNone(db.extract_log_checkpoint())
+            self.assertEqual(db.extract_lastLog_date(), "2024-01-05T00:00:02.000000Z")
+
+    def testB_resume(self):
+        pages = activity_pages(5, 3)
+        service = FakeReportsService(pages, fail_on=3)
+        # One page per transaction
+        with self.assertRaises(Exception):
+            IngestionPipeline(self.pool, service, batch_rows=1).run()
+        with self.pool.connection() as db:
+            self.assertEqual(db.extract_log_checkpoint()[1:], ("3", "2024-01-03T00:00:02.000Z"))
+            self.assertEqual(db.count_logs_date("2000-01-01"), 9)
+            self.assertEqual(db.extract_lastLog_date(), '1970-01-01T00:00:00.000000Z')
+
+        service.fail_on = None
+        service.requested = []
+        pipeline = IngestionPipeline(self.pool, service)
+        self.assertEqual(pipeline.run(), 6)
+        self.assertEqual(service.requested, ["3", "4"])
+        with self.pool.connection() as db:
+            self.assertEqual(db.count_logs_date("2000-01-01"), 15)
+            self.assertIsNone(db.extract_log_checkpoint())
+            db.cursor.execute("SELECT COUNT(*) FROM conflicts")
+            self.assertEqual(db.cursor.fetchone()[0], 5)
+
+    def testC_stage_errors(self):
+        missing_events = activity_pages(2, 3)
+        del missing_events[1][0]['events']
+        bad_time = activity_pages(2, 3)
+        bad_time[1][0]['id']['time'] = "yesterday"
+        cases = [
+            ("fetch", FakeReportsService(activity_pages(2, 3), fail_on=1), None, "Backend error"),
+            ("parse", FakeReportsService(missing_events), None, "events"),
+            ("write", FakeReportsService(bad_time), None, "yesterday"),
+            ("detect", FakeReportsService(activity_pages(2, 3)), BrokenEngineCache(), "Engine failure"),
+        ]
+        for stage, service, engine_cache, message in cases:
+            with self.subTest(stage=stage):
+                with self.pool.connection() as db:
+                    db.clear_log_checkpoint()
+                    db.commit()
+                with self.assertRaises(Exception) as raised:
+                    IngestionPipeline(self.pool, service, engine_cache=engine_cache).run()
+                self.assertIn(message, str(raised.exception))
+
+    def testD_backpressure(self):
+        pipeline = IngestionPipeline(self.pool, FakeReportsService(activity_pages(20, 3)), queue_size=1, batch_rows=1)
+        self.assertEqual(pipeline.run(), 60)
+        self.assertEqual(pipeline.conflicts, 20)
+        for stage, metrics in pipeline.metrics().items():
+            self.assertLessEqual(metrics['max_queue_depth'], 1, stage)
+
+
+if __name__ == "__main__":
+    unittest.main()
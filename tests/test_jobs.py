@@ -0,0 +1,162 @@
+import unittest, threading, time
+from tests.dbcase import SQLiteTestCase
+from src.enginecache import EngineCache
+from src.detection import detectmain
+from src.jobs import JobManager
+
+class BlockingEngineCache(EngineCache):
+    '''EngineCache holding jobs up after they start, until released'''
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def get(self, db, timer=None):
+        self.started.set()
+        self.release.wait(5)
+        return super().get(db)
+
+class TestJobs(SQLiteTestCase):
+    '''A detection job must find the same conflicts as detectmain, in pages'''
+
+    # Each running job holds two connections, progress requests one more
+    pool_size = 3
+
+    def setUp(self):
+        super().setUp()
+        self.add_constraints(self.constraints)
+        self.add_logs(self.logs)
+        self.jobs = JobManager(self.pool, EngineCache(), workers=1, chunk_size=50)
+
+    def tearDown(self):
+        self.jobs.shutdown()
+        super().tearDown()
+
+    def testA_results(self):
+        job = self.jobs.submit("2000-01-01")
+        job.future.result()
+        self.assertEqual(job.status, "done")
+        self.assertEqual(job.rows_scanned, len(self.logs))
+        self.assertEqual(job.total_rows, len(self.logs))
+
+        expected = sorted(tuple(log) for log, conflict in zip(self.logs, detectmain(self.logs, self.constraints)) if conflict)
+        self.assertTrue(expected)
+        self.assertEqual(job.conflicts, len(expected))
+        pages, cursor = [], 0
+        while cursor is not None:
+            page, cursor = self.jobs.results(job, cursor, 7)
+            pages += page
+        self.assertEqual(sorted(tuple(log) for log in pages), expected)
+        with self.pool.connection() as db:
+            db.cursor.execute("SELECT COUNT(*) FROM conflicts")
+            self.assertEqual(db.cursor.fetchone()[0], len(expected))
+
+    def testB_cancel(self):
+        # The only worker is busy with the first job, so the second stays queued
+        running = self.jobs.submit("2000-01-01")
+        queued = self.jobs.submit("2000-01-01")
+        self.assertEqual(self.jobs.cancel(queued.id).status, "cancelled")
+        running.future.result()
+        self.assertEqual(queued.status, "cancelled")
+        self.assertEqual(queued.rows_scanned, 0)
+        self.assertIsNone(self.jobs.cancel("unknown"))
+
+        job = self.jobs.submit("2000-01-01")
+        job.cancel_requested.set()
+        job.future.result()
+        self.assertEqual(job.status, "cancelled")
+        self.assertIsNone(self.jobs.results(job)[1])
+
+    def testC_concurrent(self):
+        # Two workers, and connections for only one running job at a time
+        jobs = JobManager(self.pool, EngineCache(), workers=2, chunk_size=50)
+        try:
+            submitted = [jobs.submit("2000-01-01") for _ in range(2)]
+            for job in submitted:
+                job.future.result(timeout=10)
+            self.assertEqual([job.status for job in submitted], ["done", "done"])
+        finally:
+            jobs.shutdown()
+
+    def testD_expire(self):
+        self.jobs.max_jobs = 1
+        first = self.jobs.submit("2000-01-01")
+        first.future.result()
+        self.assertTrue(self.jobs.results(first)[0])
+        second = self.jobs.submit("2000-01-01")
+        self.assertIsNone(self.jobs.get(first.id))
+        self.assertEqual(self.jobs.results(first), ([], None))
+        second.future.result()
+        self.assertEqual(len(self.jobs.results(second, limit=1000)[0]), second.conflicts)
+
+    def testE_shared(self):
+        # Jobs run by another process sharing the database, held up once started
+        engine_cache = BlockingEngineCache()
+        other = JobManager(self.pool, engine_cache, workers=1, chunk_size=50)
+        try:
+            running = other.submit("2000-01-01")
+            queued = other.submit("2000-01-01")
+            self.assertTrue(engine_cache.started.wait(5))
+            self.assertEqual(self.jobs.get(queued.id).status, "queued")
+            self.assertEqual(self.jobs.cancel(queued.id).status, "cancelled")
+            # A running job can only be asked to stop after its current chunk
+            self.assertEqual(self.jobs.cancel(running.id).status, "running")
+            engine_cache.release.set()
+            running.future.result()
+            queued.future.result()
+            self.assertEqual((queued.status, queued.rows_scanned), ("cancelled", 0))
+            self.assertEqual((running.status, running.rows_scanned), ("cancelled", 0))
+            self.assertEqual(self.jobs.get(running.id).progress(), running.progress())
+            self.assertIsNone(self.jobs.get("unknown"))
+            self.assertIsNone(self.jobs.cancel("unknown"))
+        finally:
+            other.shutdown()
+
+    def testF_shared_results(self):
+        job = self.jobs.submit("2000-01-01")
+        job.future.result()
+        other = JobManager(self.pool, EngineCache())
+        try:
+            stored = other.get(job.id)
+            self.assertEqual(stored.progress(), job.progress())
+            pages, cursor = [], 0
+            while cursor is not None:
+                page, cursor = other.results(stored, cursor, 7)
+                pages += page
+            self.assertEqual(len(pages), job.conflicts)
+        finally:
+            other.shutdown()
+    def testG_stale(self):
+        # Jobs of a process that exited, which left them queued and running
+        with self.pool.connection() as db:
+            for job_id, status in [("exited1", "running"), ("exited2", "queued")]:
+                db.add_detection_job(job_id, "2000-01-01", None, "2024-01-01T00:00:00Z", time.time() - 1000, commit=False)
+                db.update_detection_job(job_id, status=status)
+        job = self.jobs.get("exited1")
+        self.assertEqual((job.status, job.error), ("failed", JobManager.STALE_ERROR))
+        self.assertIsNotNone(job.finished)
+        self.assertEqual(self.jobs.results(job), ([], None))
+        self.jobs.submit("2000-01-01").future.result()
+        with self.pool.connection() as db:
+            self.assertEqual(db.extract_detection_job("exited2")[3], "failed")
+
+        # Jobs of a live process keep their heartbeat while they wait
+        engine_cache = BlockingEngineCache()
+        jobs = JobManager(self.pool, engine_cache, workers=1, stale_after=0.3)
+        try:
+            running = jobs.submit("2000-01-01")
+            queued = jobs.submit("2000-01-01")
+            self.assertTrue(engine_cache.started.wait(5))
+            time.sleep(0.6)
+            self.assertEqual(jobs.get(running.id).status, "running")
+            self.assertEqual(jobs.get(queued.id).status, "queued")
+            engine_cache.release.set()
+            queued.future.result()
+            self.assertEqual(jobs.get(queued.id).status, "done")
+        finally:
+            jobs.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
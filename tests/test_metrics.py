@@ -0,0 +1,83 @@
+import unittest, time
+from tests.dbcase import SQLiteTestCase
+from src.incremental import IncrementalDetector, load_engine
+from src.detection import detectmain
+from src.metrics import Registry, render_families, merge_families, REGISTRY, DETECTION_SECONDS, CONFLICTS_FOUND, ENGINE_BUILD_SECONDS, PhaseTimer
+
+class TestMetrics(SQLiteTestCase):
+
+    def testA_render(self):
+        registry = Registry()
+        histogram = registry.histogram("test_seconds", "Test durations", ["kind"], buckets=(0.1, 1))
+        counter = registry.counter("test_total", "Test events")
+        for value in [0.05, 0.5, 0.5, 5]:
+            histogram.observe(value, kind='a"b')
+        counter.inc(3)
+        registry.register_stats("test_stage", "Test stages", lambda: {'fetch': {'rows': 2, 'rate': None}, 'write': {'rows': 1.5}}, label="stage")
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{kind="a\\"b",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{kind="a\\"b",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{kind="a\\"b",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{kind="a\\"b"} 4', lines)
+        self.assertIn('test_total 3', lines)
+        self.assertIn('test_stage_rows{stage="fetch"} 2', lines)
+        self.assertIn('test_stage_rows{stage="write"} 1.5', lines)
+        self.assertFalse([line for line in lines if "rate" in line and not line.startswith("#")])
+        with self.assertRaises(ValueError):
+            counter.inc(kind="a")
+
+    def testD_merge(self):
+        # The same metrics in two processes
+        processes = {}
+        for pid, values in [(1, [0.05, 5]), (2, [0.5])]:
+            registry = Registry()
+            histogram = registry.histogram("test_seconds", "Test durations", buckets=(0.1, 1))
+            for value in values:
+                histogram.observe(value)
+            registry.counter("test_total", "Test events").inc(pid)
+            registry.register_stats("test_pool", "Test pool", lambda: {'open': 2})
+            processes[pid] = registry.collect()
+        lines = render_families(merge_families(processes)).splitlines()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_seconds_count 3', lines)
+        self.assertIn('test_total 3', lines)
+        self.assertIn('test_pool_open{worker="1"} 2', lines)
+        self.assertIn('test_pool_open{worker="2"} 2', lines)
+        self.assertEqual(lines.count('# TYPE test_seconds histogram'), 1)
+
+    def testB_detection(self):
+        self.add_constraints(self.constraints)
+        self.add_logs(self.logs)
+        with self.pool.connection() as db:
+            builds = ENGINE_BUILD_SECONDS.count(kind="full")
+            runs = DETECTION_SECONDS.count(mode="incremental")
+            found = CONFLICTS_FOUND.value(mode="incremental")
+            timer = PhaseTimer()
+            checked, conflicts = IncrementalDetector(load_engine(db, timer=timer)).detect_new(db, timer=timer)
+        self.assertEqual(set(timer.to_dict()['phases']), {"constraint_fetch", "engine_build", "log_fetch", "parse", "check", "persist"})
+        self.assertEqual(ENGINE_BUILD_SECONDS.count(kind="full"), builds + 1)
+        self.assertEqual(DETECTION_SECONDS.count(mode="incremental"), runs + 1)
+        self.assertEqual(CONFLICTS_FOUND.value(mode="incremental"), found + conflicts)
+        self.assertIn('accord_db_fetch_seconds_count{query="logs_after_id"}', REGISTRY.render())
+
+    def testC_phases(self):
+        timer = PhaseTimer()
+        with timer.phase("outer"):
+            with timer.phase("inner"):
+                time.sleep(0.02)
+            for item in timer.iterate(range(3), "inner"):
+                pass
+        # Inner time is not counted in the outer phase
+        self.assertGreaterEqual(timer.seconds["inner"], 0.02)
+        self.assertLess(timer.seconds["outer"], 0.02)
+        self.assertEqual(list(timer.seconds), ["inner", "outer"])
+
+        timer = PhaseTimer()
+        self.assertEqual(detectmain(self.logs, self.constraints, timer), detectmain(self.logs, self.constraints))
+        self.assertEqual(list(timer.seconds), ["engine_build", "parse", "check"])
+
+
+if __name__ == "__main__":
+    unittest.main()
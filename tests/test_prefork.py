@@ -0,0 +1,88 @@
+import unittest, json, gc, os, multiprocessing
+from tests.dbcase import SQLiteTestCase
+from src.detection import detectmain
+from src.enginecache import EngineCache
+from src.metrics import Registry, merge_families
+from src.prefork import ChangeSignal, WorkerStats, run_workers
+
+class TestPrefork(SQLiteTestCase):
+    '''Workers must share the preloaded engine, and refresh it when another
+    worker finds constraint changes'''
+
+    def setUp(self):
+        super().setUp()
+        self.add_constraints(self.constraints[:-10])
+
+    def testA_change_signal(self):
+        signal = ChangeSignal()
+        checking = EngineCache(change_signal=signal)
+        waiting = EngineCache(refresh_interval=3600, change_signal=signal)
+        with self.pool.connection() as db:
+            checking.get(db)
+            stale = waiting.get(db)
+            self.assertIs(waiting.get(db), stale)
+
+            for constraint in self.constraints[-10:]:
+                db.add_action_constraint(constraint)
+            # Only the cache checking on every get finds the changes
+            checking.get(db)
+            self.assertEqual(signal.generation, 1)
+            engine = waiting.get(db)
+            self.assertEqual(engine.check_conflicts(self.logs), detectmain(self.logs, self.constraints))
+            # Catching up on a signalled change doesn't signal it again
+            self.assertEqual(signal.generation, 1)
+            self.assertEqual(signal.bump(0), 1)
+
+    def testB_workers(self):
+        shared = {}
+
+        def preload():
+            with self.pool.connection() as db:
+                shared['engine'] = EngineCache().get(db)
+            self.pool.close()
+
+        def worker_main():
+            # The engine was loaded before fork, and frozen out of collection
+            conflicts = shared['engine'].check_conflicts(self.logs)
+            with open(os.path.join(self.directory.name, str(os.getpid())), "w") as file:
+                json.dump({'conflicts': conflicts, 'frozen': gc.get_freeze_count()}, file)
+
+        exited = run_workers(3, worker_main, preload)
+        self.assertEqual(sorted(exited.values()), [0, 0, 0])
+        self.assertEqual(gc.get_freeze_count(), 0)
+        for pid in exited:
+            with open(os.path.join(self.directory.name, str(pid))) as file:
+                result = json.load(file)
+            self.assertEqual(result['conflicts'], detectmain(self.logs, self.constraints[:-10]))
+            self.assertGreater(result['frozen'], 0)
+
+    def testC_worker_stats(self):
+        registry = Registry()
+        requests = registry.counter("test_requests_total", "Test requests")
+        stats = WorkerStats(os.path.join(self.directory.name, "stats"), interval=3600)
+        stats.register('metrics', registry.collect)
+        os.mkdir(stats.directory)
+        barrier = multiprocessing.Barrier(3, timeout=10)
+
+        def worker_main():
+            requests.inc()
+            stats.write()
+            barrier.wait()
+            # Any worker reads the metrics of all of them
+            merged = merge_families(stats.read('metrics'))
+            with open(os.path.join(self.directory.name, str(os.getpid())), "w") as file:
+                json.dump(merged, file)
+            # Stay alive until all have read
+            barrier.wait()
+
+        exited = run_workers(3, worker_main)
+        self.assertEqual(sorted(exited.values()), [0, 0, 0])
+        for pid in exited:
+            with open(os.path.join(self.directory.name, str(pid))) as file:
+                self.assertEqual(json.load(file)[0]['samples'], [["test_requests_total", {}, 3]])
+        # Snapshots of exited workers are dropped
+        self.assertEqual(list(stats.read('metrics')), [os.getpid()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest, json, os, tempfile, threading
+from src.detection import ConflictDetectionEngine, detectmain
+from src.profiling import EngineProfiler
+
+class TestProfiling(unittest.TestCase):
+    '''A profiled engine must flag the same logs, and count every check'''
+
+    def setUp(self):
+        with open("tests/sample_constraints.txt") as file:
+            self.constraints = json.load(file)
+        with open("tests/sample_logs.txt") as file:
+            self.logs = json.load(file)
+
+    def testA_counts(self):
+        engine = ConflictDetectionEngine(self.constraints)
+        profiler = EngineProfiler()
+        engine.profiler = profiler
+        expected = detectmain(self.logs, self.constraints)
+        self.assertEqual(engine.check_conflicts(self.logs[:200]) + engine.check_conflicts(self.logs[200:]), expected)
+        self.assertEqual(list(engine.iter_conflicts([self.logs])), [log for log, conflict in zip(self.logs, expected) if conflict])
+
+        report = profiler.report(top=1000)
+        levels = {level['level']: level for level in report['levels']}
+        self.assertEqual(report['activities'], 2 * len(self.logs))
+        self.assertEqual(levels['document']['probes'], 2 * len(self.logs))
+        for parent, child in [('document', 'action'), ('action', 'actor'), ('actor', 'condition')]:
+            self.assertEqual(levels[parent]['hits'], levels[child]['probes'])
+        self.assertEqual(levels['condition']['hits'], 2 * sum(expected))
+        self.assertEqual(sum(constraint['conflicts'] for constraint in report['hot_constraints']), report['conflicts'])
+        self.assertGreater(report['parse_seconds'], 0)
+        self.assertGreater(report['match_seconds'], 0)
+
+    def testB_export(self):
+        engine = ConflictDetectionEngine(self.constraints)
+        profiler = EngineProfiler(sample_interval=0.001)
+        engine.profiler = profiler
+        for _ in range(100):
+            engine.check_conflicts(self.logs)
+        profiler.close()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "profile.json")
+            profiler.export(filename, top=3)
+            with open(filename) as file:
+                report = json.load(file)
+            self.assertEqual(len(report['hot_constraints']), 3)
+            self.assertGreater(report['stack_samples'], 0)
+            with open(filename + ".stacks") as file:
+                self.assertTrue(all("test_profiling.py:testB_export" in line for line in file))
+
+    def testC_report_while_sampling(self):
+        engine = ConflictDetectionEngine(self.constraints)
+        profiler = EngineProfiler(sample_interval=0.0001)
+        engine.profiler = profiler
+        done = threading.Event()
+
+        def detect():
+            while not done.is_set():
+                engine.check_conflicts(self.logs)
+
+        thread = threading.Thread(target=detect)
+        thread.start()
+        try:
+            # Reports copy the stacks while the sampler adds to them
+            with tempfile.TemporaryDirectory() as directory:
+                for _ in range(200):
+                    profiler.export(os.path.join(directory, "profile.json"))
+            snapshot = profiler.sampler.snapshot()
+            self.assertIsNot(snapshot, profiler.sampler.stacks)
+        finally:
+            done.set()
+            thread.join()
+            profiler.close()
+        self.assertGreater(profiler.report()['stack_samples'], 0)
+
+    def testD_merge(self):
+        # Profilers of two processes, one sampling only once started
+        engine = ConflictDetectionEngine(self.constraints)
+        profilers = [EngineProfiler(), EngineProfiler(sample_interval=0.001, start=False)]
+        try:
+            self.assertIsNone(profilers[1].sampler._thread)
+            profilers[1].start()
+            for profiler, logs in zip(profilers, [self.logs[:200], self.logs[200:]]):
+                engine.profiler = profiler
+                for _ in range(20):
+                    engine.check_conflicts(logs)
+        finally:
+            profilers[1].close()
+        states = [json.loads(json.dumps(profiler.state())) for profiler in profilers]
+        report = EngineProfiler.merge(states, top=1000)
+
+        engine.profiler = EngineProfiler()
+        for _ in range(20):
+            engine.check_conflicts(self.logs)
+        expected = engine.profiler.report(top=1000)
+        for key in ['activities', 'conflicts', 'levels']:
+            self.assertEqual(report[key], expected[key])
+        self.assertEqual(sorted(map(str, report['hot_constraints'])), sorted(map(str, expected['hot_constraints'])))
+        self.assertEqual(report['stack_samples'], profilers[1].report()['stack_samples'])
+        self.assertEqual(report['since'], profilers[0].started)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+# EXPLAIN checks that hot queries use the indexes the schema defines: on
+# MySQL, with a scratch database named by mysql_test_db in db.yaml, and on
+# SQLite (EXPLAIN QUERY PLAN), which runs everywhere.
+# Log archiving runs against a cursor emulating activity_log's partitions.
+import unittest, os, re, tempfile, gzip, csv
+import yaml
+from src.sqlconnector import DatabaseQuery
+from src.schema import migrate, MIGRATIONS
+from tests.dbcase import SQLiteTestCase
+
+
+def connect_test_db():
+    '''Return connection to the test database, or None if not configured'''
+    if not os.path.exists('db.yaml'):
+        return None
+    with open('db.yaml') as config_file:
+        db_config = yaml.load(config_file, Loader=yaml.SafeLoader)
+    if 'mysql_test_db' not in db_config:
+        return None
+    try:
+        from src.dbpool import mysql_connector
+        return mysql_connector(dict(db_config, mysql_db=db_config['mysql_test_db']))()
+    except Exception:
+        return None
+
+
+class ExplainCursor():
+    '''Cursor that runs EXPLAIN, or another prefix, on each query and keeps the plan rows'''
+    def __init__(self, cursor, prefix="EXPLAIN "):
+        self.cursor = cursor
+        self.prefix = prefix
+        self.plans = []
+
+    def execute(self, query, params=None):
+        self.cursor.execute(self.prefix + query, params)
+        columns = [column[0] for column in self.cursor.description]
+        self.plans.append([dict(zip(columns, row)) for row in self.cursor.fetchall()])
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+@unittest.skipIf(connect_test_db() is None, "mysql_test_db not configured")
+class TestSchema(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = connect_test_db()
+        cls.db = DatabaseQuery(cls.connection, cls.connection.cursor())
+        migrate(cls.db)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.close()
+
+    def explain(self, method, *args):
+        cursor = ExplainCursor(self.connection.cursor())
+        method(DatabaseQuery(self.connection, cursor), *args)
+        return cursor.plans[0][0]
+
+    def assertUsesIndex(self, plan, index):
+        # possible_keys only lists candidates: check the index chosen, and that it isn't scanned in full
+        self.assertEqual(plan['key'], index)
+        self.assertIn(plan['type'], ('range', 'ref'))
+
+    def testA_latest_version(self):
+        self.assertEqual(migrate(self.db), MIGRATIONS[-1][0])
+
+    def testB_log_range_scan(self):
+        plan = self.explain(DatabaseQuery.extract_logs_date, '2024-10-09T00:00:00.000Z')
+        self.assertUsesIndex(plan, 'activity_log_time')
+
+    def testC_constraint_fetch(self):
+        plan = self.explain(DatabaseQuery.fetch_action_constraints, '2024-10-09T00:00:00.000Z')
+        self.assertUsesIndex(plan, 'action_constraints_time')
+
+    def testD_logs_for_constraint(self):
+        plan = self.explain(DatabaseQuery.extract_logs_for_constraint, ['doc1', 'doc2'], 'Per', ['alice@accord.foundation'], False)
+        self.assertUsesIndex(plan, 'activity_log_doc_action_actor')
+
+    def testE_conflict_upsert_key(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SHOW INDEX FROM conflicts WHERE Key_name = 'conflicts_time_type'")
+        rows = cursor.fetchall()
+        self.assertEqual([(row[1], row[4]) for row in rows], [(0, 'conflictTime'), (0, 'conflictType')])
+
+
+class TestSQLitePlans(SQLiteTestCase):
+    '''Hot queries must search the indexes of SQLITE_MIGRATIONS, not scan tables'''
+
+    def explain(self, method, *args):
+        with self.pool.connection() as db:
+            cursor = ExplainCursor(db.db.cursor(), prefix="EXPLAIN QUERY PLAN ")
+            method(type(db)(db.db, cursor), *args)
+        return [row['detail'] for row in cursor.plans[0]]
+
+    def assertSearchesIndex(self, plan, table, index):
+        pattern = r"SEARCH %s( AS \w+)? USING (COVERING )?INDEX %s\b" % (table, index)
+        self.assertTrue([detail for detail in plan if re.match(pattern, detail)], plan)
+
+    def testB_log_range_scan(self):
+        plan = self.explain(DatabaseQuery.extract_logs_date, '2024-10-09T00:00:00.000Z')
+        self.assertSearchesIndex(plan, 'activity_log', 'activity_log_time')
+
+    def testC_constraint_fetch(self):
+        plan = self.explain(DatabaseQuery.fetch_action_constraints, '2024-10-09T00:00:00.000Z')
+        self.assertSearchesIndex(plan, 'action_constraints', 'action_constraints_time')
+
+    def testD_logs_for_constraint(self):
+        for exact in [True, False]:
+            with self.subTest(exact=exact):
+                plan = self.explain(DatabaseQuery.extract_logs_for_constraint, ['doc1', 'doc2'], 'Per', ['alice@accord.foundation'], exact)
+                self.assertSearchesIndex(plan, 'activity_log', 'activity_log_doc_action_actor')
+
+
+class PartitionedLogCursor():
+    '''Cursor on a MySQL activity_log partitioned by RANGE COLUMNS: a row
+    belongs to the first partition whose bound is above its activity_time,
+    so the first partition also holds older rows
+
+    Attributes:
+        bounds: dict, partition name: VALUES LESS THAN month, in order
+        rows: list of (id, activity_time, ...) tuples
+    '''
+
+    def __init__(self, bounds, rows):
+        self.bounds = bounds
+        self.rows = rows
+        self.result = []
+
+    def partition(self, row):
+        return next(name for name, bound in self.bounds.items() if row[1] < bound)
+
+    def execute(self, query, params=None):
+        partition = re.search(r"PARTITION \((p\w+)\)", query)
+        drop = re.search(r"DROP PARTITION (p\w+)", query)
+        if "information_schema.PARTITIONS" in query:
+            self.result = [(name,) for name in self.bounds if name != "pmax"]
+        elif drop:
+            self.rows = [row for row in self.rows if self.partition(row) != drop.group(1)]
+            del self.bounds[drop.group(1)]
+        elif partition:
+            self.result = sorted(row for row in self.rows if self.partition(row) == partition.group(1))
+        elif "activity_time >= %s AND activity_time < %s" in query:
+            self.result = sorted(row for row in self.rows if params[0] <= row[1] < params[1])
+        else:
+            raise NotImplementedError(query)
+
+    def fetchall(self):
+        result, self.result = self.result, []
+        return result
+
+    def fetchmany(self, size):
+        result, self.result = self.result[:size], self.result[size:]
+        return result
+
+    def close(self):
+        pass
+
+
+class PartitionedLogConnection():
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self, factory=None):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+
+class TestLogArchive(unittest.TestCase):
+    '''Archiving a month must write every log its partition drops'''
+
+    def testA_first_partition(self):
+        rows = [(1, "2024-02-10T00:00:00.000Z"), (2, "2019-05-01T00:00:00.000Z"), (3, "2024-01-15T00:00:00.000Z")]
+        rows = [row + ("Edit", "doc1", "Doc 1", "1", "alice@accord.foundation") for row in rows]
+        cursor = PartitionedLogCursor({'p202401': "2024-02", 'p202402': "2024-03", 'pmax': "9999"}, rows)
+        db = DatabaseQuery(PartitionedLogConnection(cursor), cursor)
+        with tempfile.TemporaryDirectory() as directory:
+            archived = db.archive_logs_before("2024-02", directory)
+            self.assertEqual([count for path, count in archived], [2])
+            with gzip.open(archived[0][0], "rt", newline="") as archive_file:
+                archive = list(csv.reader(archive_file))
+        self.assertEqual([row[1] for row in archive[1:]], ["2019-05-01T00:00:00.000Z", "2024-01-15T00:00:00.000Z"])
+        self.assertEqual(cursor.rows, rows[:1])
+        self.assertEqual(db.log_partitions(), ["2024-02"])
+
+
+if __name__ == "__main__":
+    unittest.main()
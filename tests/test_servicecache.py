@@ -0,0 +1,102 @@
+import unittest, os, tempfile, json, time, threading
+from datetime import datetime, timedelta
+from src.servicecache import ServiceCache
+
+class FakeCredentials():
+    '''Credentials with the attributes ServiceCache uses'''
+
+    def __init__(self, expiry):
+        self.expiry = expiry
+        self.refresh_token = "refresh"
+        self.token = "token0"
+        self.refreshed_with = []
+
+    def refresh(self, request):
+        self.refreshed_with.append(request)
+        self.token = "token" + str(len(self.refreshed_with))
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    def to_json(self):
+        return json.dumps({'token': self.token})
+
+class TestServiceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.token_file = os.path.join(self.directory.name, "token.json")
+        with open(self.token_file, "w") as file:
+            file.write("{}")
+        self.request = object()
+        self.cache = ServiceCache(self.request, refresh_margin=300, idle_timeout=60, interval=3600)
+        self.built = []
+
+    def tearDown(self):
+        self.cache.stop()
+        self.directory.cleanup()
+
+    def builder(self, token_file):
+        creds = FakeCredentials(datetime.utcnow() + timedelta(seconds=60))
+        self.built.append(creds)
+        return ("service", len(self.built)), creds
+
+    def testA_cached(self):
+        service = self.cache.get(self.token_file, self.builder)
+        self.assertIs(self.cache.get(self.token_file, self.builder), service)
+        self.assertEqual(len(self.built), 1)
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+        # Changed by something else: rebuilt
+        os.utime(self.token_file, ns=(0, 0))
+        self.assertEqual(self.cache.get(self.token_file, self.builder), ("service", 2))
+
+    def testB_refresh(self):
+        service = self.cache.get(self.token_file, self.builder)
+        self.cache.maintain()
+        creds = self.built[0]
+        self.assertEqual(creds.refreshed_with, [self.request])
+        with open(self.token_file) as file:
+            self.assertEqual(json.load(file), {'token': 'token1'})
+        # Its own save of the token file doesn't rebuild the service
+        self.assertIs(self.cache.get(self.token_file, self.builder), service)
+        # Not close to expiry any more
+        self.cache.maintain()
+        self.assertEqual(len(creds.refreshed_with), 1)
+        self.assertEqual(self.cache.stats['refreshes'], 1)
+
+    def testC_idle(self):
+        service = self.cache.get(self.token_file, self.builder)
+        self.cache.set_user_service("admin@accord.foundation", "reports", service)
+        self.cache.maintain(now=time.monotonic() + 120)
+        self.assertEqual(self.cache._users, {})
+        self.assertEqual(self.cache.stats['evicted_users'], 1)
+        self.assertEqual(self.cache.stats['evicted_services'], 1)
+        self.assertIsNot(self.cache.get(self.token_file, self.builder), service)
+
+    def testD_build_unlocked(self):
+        started, release = threading.Event(), threading.Event()
+        other_file = os.path.join(self.directory.name, "other.json")
+        with open(other_file, "w") as file:
+            file.write("{}")
+
+        def slow_builder(token_file):
+            started.set()
+            release.wait(5)
+            return self.builder(token_file)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get(self.token_file, slow_builder))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(started.wait(5))
+        # Another service is built while the first build waits
+        self.assertEqual(self.cache.get(other_file, self.builder), ("service", 1))
+        release.set()
+        for thread in threads:
+            thread.join()
+        # Both requests got the one service built
+        self.assertEqual(results, [("service", 2)] * 2)
+        self.assertEqual(self.cache.stats['builds'], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
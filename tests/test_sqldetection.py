@@ -0,0 +1,72 @@
+import unittest, random
+from tests.dbcase import SQLiteTestCase, LOG_INSERT
+from src.detection import detectmain, ConflictDetectionEngine
+from src.sqldetection import SQLDetectionEngine
+
+def random_case(rng, count):
+    '''Return random constraints and logs over a few documents, actors and actions'''
+    docs = ["doc" + str(i) for i in range(4)]
+    actors = ["alice@accord.foundation", "bob@accord.foundation", "Carol@accord.foundation"]
+    times = ["2024-01-0%dT0%d:00:00.%03dZ" % (rng.randint(1, 9), rng.randint(0, 9), rng.choice([0, 500])) for _ in range(10)]
+    constraints = []
+    for _ in range(count):
+        action_type = rng.choice(["Add Permission", "Remove Permission", "Update Permission", "Can Edit", "Time Limit Edit",
+                                  "Can Delete", "Can Move", "Can Rename"])
+        if action_type in ("Can Edit", "Time Limit Edit"):
+            comparator = rng.choice(["", "gt", "lt", "in", "not in"])
+            values = rng.sample(times, rng.randint(1, 3)) + rng.choice([[], ["2024-01-05T00:00:00.000250+00:00"]])
+        elif action_type.endswith("Permission"):
+            comparator = rng.choice(["", "in", "not in"])
+            values = rng.sample(actors, rng.randint(0, 2)) + ["-"]
+        elif action_type == "Can Move":
+            # Activity has no true value for moves
+            comparator, values = "", []
+        else:
+            # gt and lt would compare a missing true value
+            comparator = rng.choice(["", "in", "not in"])
+            values = []
+        constraints.append([[d for d in docs], rng.sample(docs, rng.randint(1, 2)), "", action_type,
+                            rng.sample(actors, rng.randint(1, 2)), "FALSE", comparator, "owner@accord.foundation", values])
+    logs = []
+    for i in range(count * 10):
+        action = rng.choice(["Edit", "Delete", "Rename", "Create", "Move:folder1",
+                             "Permission Change-to:can_view-from:none-for:" + rng.choice(actors),
+                             "Permission Change-to:none-from:can_edit-for:" + rng.choice(actors),
+                             "Permission Change-to:can_edit-from:can_viewcan_comment-for:" + rng.choice(actors)])
+        logs.append([rng.choice(times), action, rng.choice(docs), "Document", "1", rng.choice(actors)])
+    return constraints, logs
+
+class TestSQLDetection(SQLiteTestCase):
+    '''Differential tests: SQLDetectionEngine must flag exactly the logs detectmain flags'''
+
+    def assertSameConflicts(self, constraints, logs):
+        expected = [tuple(log) for log, conflict in zip(logs, detectmain(logs, constraints)) if conflict]
+        with self.pool.connection() as db:
+            db.cursor.execute("DELETE FROM activity_log")
+            db.cursor.executemany(LOG_INSERT, logs)
+            engine = SQLDetectionEngine(ConflictDetectionEngine(constraints))
+            found = [row for rows in engine.iter_conflicts(db, "2000-01-01", chunk_size=7) for row in rows]
+        self.assertEqual(found, expected)
+        return found
+
+    def testA_sample(self):
+        self.assertTrue(self.assertSameConflicts(self.constraints, self.logs))
+
+    def testB_random(self):
+        rng = random.Random(41)
+        for _ in range(30):
+            self.assertSameConflicts(*random_case(rng, rng.randint(1, 12)))
+
+    def testC_time_range(self):
+        constraints = [[["Doc"], ["doc1"], "Edit", "Can Edit", ["alice@accord.foundation"], "TRUE", "", "owner@accord.foundation", []]]
+        logs = [["2024-01-0%dT00:00:00.000Z" % day, "Edit", "doc1", "Doc", "1", "alice@accord.foundation"] for day in range(1, 6)]
+        with self.pool.connection() as db:
+            db.cursor.executemany(LOG_INSERT, logs)
+            engine = SQLDetectionEngine(ConflictDetectionEngine(constraints))
+            self.assertEqual(engine.detect(db, "2024-01-02", "2024-01-04T00:00:00.000Z"), 3)
+            db.cursor.execute("SELECT conflictTime FROM conflicts ORDER BY conflictTime")
+            self.assertEqual([row[0] for row in db.cursor.fetchall()], [log[0] for log in logs[1:4]])
+
+
+if __name__ == "__main__":
+    unittest.main()
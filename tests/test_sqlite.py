@@ -0,0 +1,157 @@
+import unittest, gzip, csv, os
+from unittest import mock
+from tests.dbcase import SQLiteTestCase
+from src.schema import migrate, SQLITE_MIGRATIONS
+from src.incremental import IncrementalDetector, load_engine
+from src.detection import detectmain
+
+class TestSQLite(SQLiteTestCase):
+
+    pool_size = 2
+
+    def testA_migrate(self):
+        with self.pool.connection() as db:
+            self.assertEqual(migrate(db), SQLITE_MIGRATIONS[-1][0])
+            self.assertEqual(db.extract_lastLog_date(), '1970-01-01T00:00:00.000000Z')
+            db.cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(db.cursor.fetchone()[0], "wal")
+
+    def testB_logs_pages(self):
+        logs = ["2024-01-01T00:00:%02d.000Z,Edit,doc1,Doc 1,1,alice@accord.foundation" % i for i in range(10, 0, -1)]
+        with self.pool.connection() as db:
+            db.add_activity_logs(logs, batch_size=3)
+            self.assertEqual(db.count_logs_date("2024-01-01"), 10)
+            page, cursor = db.extract_logs_page("2024-01-01", limit=4)
+            pages = [page]
+            while cursor is not None:
+                page, cursor = db.extract_logs_page("2024-01-01", cursor, limit=4)
+                pages.append(page)
+            self.assertEqual([len(page) for page in pages], [4, 4, 2])
+            self.assertEqual([log[0] for page in pages for log in page], sorted(log.split(',')[0] for log in logs))
+            self.assertEqual(sum(len(rows) for rows in db.stream_logs_date("2024-01-01", chunk_size=3)), 10)
+            self.assertEqual(len(db.extract_logs_for_constraint(["doc1"], "Ed", ["alice@accord.foundation"], exact=False)), 10)
+            self.assertEqual(db.extract_logs_for_constraint(["doc1"], "E_", ["alice@accord.foundation"], exact=False), [])
+
+    def testC_conflicts_idempotent(self):
+        with self.pool.connection() as db:
+            db.add_conflicts([("t1", "Edit"), ("t2", "Edit")])
+            db.cursor.execute("UPDATE conflicts SET resolution = 'True' WHERE conflictTime = 't1'")
+            db.add_conflicts([("t1", "Edit"), ("t3", "Edit")])
+            db.add_conflict_resolution("t3", "Edit")
+            db.cursor.execute("SELECT conflictTime, resolution FROM conflicts ORDER BY conflictTime")
+            self.assertEqual(db.cursor.fetchall(), [("t1", "True"), ("t2", "False"), ("t3", "False")])
+
+    def testD_detection(self):
+        constraints, logs = self.constraints, self.logs
+        self.add_constraints(constraints)
+        self.add_logs(logs)
+        with self.pool.connection() as db:
+            expected = len({(log[0], log[1]) for log, conflict in zip(logs, detectmain(logs, constraints)) if conflict})
+            # Logs on unconstrained documents or actions are filtered out in the query
+            checked, conflicts = IncrementalDetector(load_engine(db)).detect_new(db)
+            self.assertLess(checked, len(logs))
+            self.assertEqual(conflicts, expected)
+            self.assertEqual(db.extract_detection_watermark(), len(logs))
+            self.assertEqual(IncrementalDetector(load_engine(db)).detect_new(db), (0, 0))
+            page, _ = db.extract_conflict_logs_page("2000-01-01", limit=1000)
+            self.assertEqual([list(row) for rows in db.stream_conflict_logs_date("2000-01-01", chunk_size=7) for row in rows], page)
+
+            # Same conflicts with small chunks and the document filter in a temporary table
+            db.update_detection_watermark(0)
+            db.cursor.execute("DELETE FROM conflicts")
+            db.TEMP_TABLE_THRESHOLD = 1
+            self.assertEqual(IncrementalDetector(load_engine(db), chunk_size=7).detect_new(db), (checked, conflicts))
+            self.assertEqual(db.extract_detection_watermark(), len(logs))
+
+    def testE_locks(self):
+        with self.pool.connection() as db1, self.pool.connection() as db2:
+            self.assertTrue(db1.acquire_lock("test"))
+            self.assertFalse(db2.acquire_lock("test"))
+            db1.release_lock("test")
+            self.assertTrue(db2.acquire_lock("test"))
+            db2.release_lock("test")
+
+    def testF_archive(self):
+        logs = [month + "-15T00:00:00.000Z,Edit,doc1,Doc 1,1,alice@accord.foundation" for month in ["2023-12", "2024-01", "2024-01", "2024-03"]]
+        with self.pool.connection() as db:
+            db.add_activity_logs(logs)
+            self.assertEqual(db.log_partitions(), ["2023-12", "2024-01", "2024-03"])
+            archived = db.archive_logs_before("2024-02", self.directory.name)
+            self.assertEqual([count for path, count in archived], [1, 2])
+            self.assertEqual(db.log_partitions(), ["2024-03"])
+            self.assertEqual(db.count_logs_date("2023"), 1)
+            with gzip.open(archived[1][0], "rt", newline="") as archive_file:
+                rows = list(csv.reader(archive_file))
+            self.assertEqual(rows[0][:2], ["ID", "Activity_Time"])
+            self.assertEqual([row[1] for row in rows[1:]], ["2024-01-15T00:00:00.000Z"] * 2)
+
+    def testG_add_logs_batches(self):
+        # Newest first, as the Reports API returns them
+        logs = ["2024-01-01T00:00:%02d.000Z,Edit,doc1,Doc 1,1,alice@accord.foundation" % i for i in range(7, 0, -1)]
+        for batch_size in [1, 3, 7, 10]:
+            with self.subTest(batch_size=batch_size):
+                with self.pool.connection() as db:
+                    db.cursor.execute("DELETE FROM activity_log")
+                    db.add_activity_logs(logs + ["malformed,log"], batch_size=batch_size)
+                    db.cursor.execute("SELECT activity_time FROM activity_log ORDER BY id")
+                    self.assertEqual([row[0] for row in db.cursor.fetchall()], [log.split(',')[0] for log in reversed(logs)])
+
+        with self.pool.connection() as db1, self.pool.connection() as db2:
+            db1.cursor.execute("DELETE FROM activity_log")
+            db1.commit()
+            # Left open for the caller to commit, e.g. with a checkpoint
+            db1.add_activity_logs(logs, commit=False, batch_size=3)
+            db1.save_log_checkpoint("2024-01-01T00:00:00.000Z", "page2", logs[0].split(',')[0])
+            self.assertEqual(db2.count_logs_date("2024-01-01"), 0)
+            self.assertIsNone(db2.extract_log_checkpoint())
+            db1.commit()
+            self.assertEqual(db2.count_logs_date("2024-01-01"), 7)
+            self.assertEqual(db2.extract_log_checkpoint()[1], "page2")
+
+        # Uncommitted logs are rolled back when the connection is returned
+        with self.pool.connection() as db:
+            db.add_activity_logs(logs, commit=False)
+        with self.pool.connection() as db:
+            self.assertEqual(db.count_logs_date("2024-01-01"), 7)
+
+    def testH_load_logs(self):
+        filename = os.path.join(self.directory.name, "logs.csv")
+        lines = ["2024-01-01T00:00:%02d.000Z,Edit,doc1,Doc 1,1,alice@accord.foundation" % i for i in range(7)]
+        with open(filename, "w") as log_file:
+            log_file.write("Activity_Time,Action,Doc_ID,Doc_Name,Actor_ID,Actor_Name\n")
+            log_file.write("\n".join(lines[:4] + ["malformed,log"] + lines[4:] + ["", "malformed"]) + "\n")
+        with self.pool.connection() as db:
+            self.assertEqual(db.load_activity_logs(filename, batch_size=3), 7)
+            db.cursor.execute("SELECT activity_time FROM activity_log ORDER BY id")
+            self.assertEqual([row[0] for row in db.cursor.fetchall()], [line.split(',')[0] for line in lines])
+
+    def testI_archive_twice(self):
+        log = "2023-01-%02dT00:00:00.000Z,Edit,doc1,Doc 1,1,alice@accord.foundation"
+        with self.pool.connection() as db:
+            db.add_activity_logs([log % day for day in [1, 2, 3]])
+            first = db.archive_logs_before("2023-02", self.directory.name)
+            # Backfilled after its month was archived
+            db.add_activity_logs([log % 4])
+            second = db.archive_logs_before("2023-02", self.directory.name)
+            self.assertEqual(db.count_logs_date("2000"), 0)
+        self.assertEqual([count for path, count in first + second], [3, 1])
+        self.assertNotEqual(first[0][0], second[0][0])
+        archived = []
+        for path, count in first + second:
+            with gzip.open(path, "rt", newline="") as archive_file:
+                archived += [row[1] for row in list(csv.reader(archive_file))[1:]]
+        self.assertEqual(archived, [(log % day).split(",")[0] for day in [1, 2, 3, 4]])
+
+    def testJ_locks_without_fcntl(self):
+        with mock.patch("src.sqliteconnector.fcntl", None), self.pool.connection() as db1, self.pool.connection() as db2:
+            self.assertTrue(db1.acquire_lock("test"))
+            self.assertTrue(db1.acquire_lock("test"))
+            self.assertFalse(db2.acquire_lock("test", timeout=0.1))
+            db1.release_lock("test")
+            self.assertTrue(db2.acquire_lock("test"))
+            db2.release_lock("test")
+            self.assertTrue(db1.acquire_lock("test"))
+            db1.release_lock("test")
+
+if __name__ == "__main__":
+    unittest.main()